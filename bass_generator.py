@@ -1,39 +1,144 @@
 # --- START OF FILE generator/bass_generator.py (override対応・ヘルパー実装・修正版) ---
 import music21
 import logging
-from music21 import stream, note, chord as m21chord, harmony, pitch, tempo, meter, instrument as m21instrument, key, interval, scale
+from music21 import stream, note, chord as m21chord, harmony, tempo, meter, instrument as m21instrument, key, interval, scale
 import random
-from typing import List, Dict, Optional, Any, Tuple, Union, cast, Sequence # Sequence を追加
+from typing import List, Dict, Optional, Any, Tuple, Union, cast, Sequence, NamedTuple # Sequence を追加
 import copy # deepcopyのため
+import json
+from collections import OrderedDict
 
 try:
-    from utilities.core_music_utils import get_time_signature_object, sanitize_chord_label, MIN_NOTE_DURATION_QL, _ROOT_RE_STRICT
-    from utilities.humanizer import apply_humanization_to_part, HUMANIZATION_TEMPLATES
-    from utilities.scale_registry import ScaleRegistry
-    from .bass_utils import get_approach_note
+    import pretty_midi
+except ImportError:
+    pretty_midi = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from utilities.core_music_utils import (get_time_signature_object, sanitize_chord_label, MIN_NOTE_DURATION_QL, _ROOT_RE_STRICT,
+                                            normalize_chord_label, parse_chord_pcs, chord_pcs_from_chord_symbol, ChordPCs,
+                                            PATTERN_ROLE_CODES, compile_pattern_roles, seventh_pc_of)
+    from utilities.humanizer import humanize_note_arrays, HUMANIZATION_TEMPLATES
+    from utilities.scale_registry import ScaleRegistry, ScaleDescriptor
     from utilities.override_loader import get_part_override, Overrides # Overridesもインポート
 except ImportError as e:
     print(f"BassGenerator: Warning - could not import all utilities: {e}")
     MIN_NOTE_DURATION_QL = 0.125
     def get_time_signature_object(ts_str: Optional[str]) -> meter.TimeSignature: return meter.TimeSignature(ts_str or "4/4")
     def sanitize_chord_label(label: Optional[str]) -> Optional[str]: return label
-    def apply_humanization_to_part(part, template_name=None, custom_params=None): return part
-    HUMANIZATION_TEMPLATES = {}
-    class ScaleRegistry:
-        @staticmethod
-        def get(tonic_str: Optional[str], mode_str: Optional[str]) -> music21.scale.ConcreteScale:
-            return music21.scale.MajorScale(tonic_str or "C")
+    def normalize_chord_label(label: Optional[str]) -> str: return str(label).strip() if label else "Rest"
     import re
     _ROOT_RE_STRICT = re.compile(r'^([A-G](?:[#b]{1,2}|[ns])?)(?![#b])')
-    def get_approach_note(from_p, to_p, scale_o, style="chromatic_or_diatonic", max_s=2, pref_dir=None): return to_p
-    class DummyPartOverride: model_config = {}; model_fields = {}
+    ChordPCs = Any # ダミー: コードを解析できないので全ブロックがスキップされる
+    def parse_chord_pcs(label): return None
+    def chord_pcs_from_chord_symbol(cs): return None
+    PATTERN_ROLE_CODES = {"root": 0, "fifth": 1, "third": 2, "octave_root": 3, "seventh": 4, "shell": 5, "full": 6}
+    def compile_pattern_roles(pattern, role_codes=None, default_role="root"): return tuple(0 for _ in pattern) # 全てルート
+    def seventh_pc_of(chord_pcs): return None
+    def humanize_note_arrays(offsets, durations, velocities, template_name=None, custom_params=None): return list(offsets), list(durations), list(velocities)
+    HUMANIZATION_TEMPLATES = {}
+    ScaleDescriptor = Any
+    class ScaleRegistry: # ダミー
+        @staticmethod
+        def get_descriptor(tonic_str, mode_str): return None
+    class DummyPartOverride:
+        model_config = {}; model_fields = {}
+        def model_dump(self, **kwargs) -> Dict[str, Any]: return {}
     def get_part_override(overrides, section, part) -> DummyPartOverride: return DummyPartOverride()
-    class Overrides: root = {} # ダミー
+    class Overrides: # ダミー
+        def __init__(self, root: Optional[Dict] = None): self.root = root or {}
 
+# 同じパッケージのモジュール (utilities が無くても自前のフォールバックで読み込める) なので別扱いにする
+from .bass_utils import get_approach_offset, fold_to_bass_register, DEFAULT_BASS_REGISTER, VocalIntervalIndex, bass_candidate_costs
 
 EMOTION_TO_BUCKET_BASS: dict[str, str] = { "quiet_pain_and_nascent_strength": "calm", "deep_regret_gratitude_and_realization": "calm", "self_reproach_regret_deep_sadness": "calm", "memory_unresolved_feelings_silence": "calm", "nature_memory_floating_sensation_forgiveness": "calm", "supported_light_longing_for_rebirth": "groovy", "wavering_heart_gratitude_chosen_strength": "groovy", "hope_dawn_light_gentle_guidance": "groovy", "acceptance_of_love_and_pain_hopeful_belief": "energetic", "trial_cry_prayer_unbreakable_heart": "energetic", "reaffirmed_strength_of_love_positive_determination": "energetic", "future_cooperation_our_path_final_resolve_and_liberation": "energetic", "default": "groovy" }
 BUCKET_TO_PATTERN_BASS: dict[tuple[str, str], str] = { ("calm", "low"): "root_only", ("calm", "medium_low"): "root_fifth", ("calm", "medium"): "bass_half_time_pop", ("calm", "medium_high"):"bass_half_time_pop", ("calm", "high"): "walking", ("groovy", "low"): "bass_syncopated_rnb", ("groovy", "medium_low"): "walking", ("groovy", "medium"): "bass_walking_8ths", ("groovy", "medium_high"):"bass_walking_8ths", ("groovy", "high"): "bass_funk_octave", ("energetic", "low"): "bass_quarter_notes", ("energetic", "medium_low"): "bass_pump_8th_octaves", ("energetic", "medium"): "bass_pump_8th_octaves", ("energetic", "medium_high"):"bass_funk_octave", ("energetic", "high"): "bass_funk_octave", ("default", "low"): "root_only", ("default", "medium_low"): "bass_quarter_notes", ("default", "medium"): "walking", ("default", "medium_high"):"bass_walking_8ths", ("default", "high"): "bass_pump_8th_octaves", }
 
+class BassEvent(NamedTuple):
+    """ベース1音。offset / duration は QL (compose の戻り値では絶対位置、パターン生成中はブロック内位置)。"""
+    offset: float
+    midi: int
+    duration: float
+    velocity: int
+    tie_start: bool = False
+
+# アルゴリズム系パターンの1小節テンプレートを保持する LRU の上限
+BASS_MEASURE_TEMPLATE_CACHE_SIZE: int = 256
+# 小節テンプレートの1音: (小節内オフセット, MIDI, 長さ QL, ベロシティ)
+MeasureTemplate = Tuple[Tuple[float, int, float, int], ...]
+
+# 固定パターンの "type" -> 役割コード。共通の PATTERN_ROLE_CODES (ピアノ・ギターと同じ) にベース固有の役割を足したもの。
+# 未知の type はルート扱い (従来のフォールバックと同じ)。ベースは単音なので octave_root / shell / full もルートを鳴らす
+BASS_ROLE_CODES: Dict[str, int] = {**PATTERN_ROLE_CODES, "random_chord_tone": 7, "scale_tone": 8, "approach": 9}
+_ROLE_RANDOM_CHORD_TONE = BASS_ROLE_CODES["random_chord_tone"]; _ROLE_SCALE_TONE = BASS_ROLE_CODES["scale_tone"]
+
+class CompiledBassPattern(NamedTuple):
+    """固定パターンを列ごとの配列にしたもの (NumPy が無い環境ではタプル)。random_indices は乱数を使う音の位置 (パターン順)。"""
+    offsets: Any
+    durations: Any
+    velocity_factors: Any
+    roles: Any
+    glides: Any
+    random_indices: Tuple[int, ...]
+
+# 候補探索 (candidate_search) で試すスタイルとオクターブ移動。既定では設定どおりのライン + 変更の少ない順に数本だけ試す
+BASS_CANDIDATE_APPROACH_STYLES: Tuple[str, ...] = ("chromatic_or_diatonic", "chromatic_only", "diatonic_only")
+BASS_CANDIDATE_WEAK_BEAT_STYLES: Tuple[str, ...] = ("root", "ghost", "rest")
+BASS_CANDIDATE_OCTAVE_SHIFTS: Tuple[int, ...] = (0, -1, 1)
+BASS_CANDIDATE_DEFAULT_COUNT: int = 8
+
+class BassCandidateVariant(NamedTuple):
+    approach_style: str
+    weak_beat_style: str
+    octave_shift: int
+
+# コード品質コード (HarmonicContext.qualities)
+CHORD_QUALITY_CODES: Dict[str, int] = {"major": 0, "minor": 1, "diminished": 2, "augmented": 3, "suspended": 4, "power": 5, "other": 6}
+
+def chord_quality_code(chord_pcs: ChordPCs) -> int:
+    """ルートからの3度・5度の音程で品質を分類する (m7b5 は diminished 扱い)。"""
+    root_pc = chord_pcs.root_pc
+    third = (chord_pcs.third_pc - root_pc) % 12 if chord_pcs.third_pc is not None else None
+    fifth = (chord_pcs.fifth_pc - root_pc) % 12 if chord_pcs.fifth_pc is not None else None
+    if third is None: return CHORD_QUALITY_CODES["power"] if len(chord_pcs.pitch_classes) <= 2 else CHORD_QUALITY_CODES["suspended"]
+    if third == 4: return CHORD_QUALITY_CODES["augmented"] if fifth == 8 else CHORD_QUALITY_CODES["major"]
+    if third == 3: return CHORD_QUALITY_CODES["diminished"] if fifth == 6 else CHORD_QUALITY_CODES["minor"]
+    return CHORD_QUALITY_CODES["other"]
+
+class HarmonicContext(NamedTuple):
+    """
+    曲全体のブロックごとの和声情報。compose の前処理で一度だけ作り、各ベース戦略はインデックスで参照する。
+    root_pcs / next_root_pcs / qualities は int8 配列 (休符・解析不能は -1)、to_section_end は
+    ブロック先頭からセクション終端までの QL。NumPy が無い環境ではタプル。chord_pcs は解析済みのコード (休符は None)。
+    """
+    chord_pcs: Tuple[Optional[ChordPCs], ...]
+    root_pcs: Any
+    next_root_pcs: Any
+    qualities: Any
+    to_section_end: Any
+
+    def next_root_pc(self, blk_idx: int) -> Optional[int]:
+        next_root = int(self.next_root_pcs[blk_idx])
+        return next_root if next_root >= 0 else None
+
+def compile_bass_pattern(pattern: Sequence[Dict[str, Any]]) -> CompiledBassPattern:
+    """rhythm_library の固定パターン (イベント dict のリスト) を CompiledBassPattern に変換する。"""
+    events = [ev for ev in pattern if isinstance(ev, dict)]
+    offsets = [float(ev.get("offset", 0.0)) for ev in events]; durations = [float(ev.get("duration", 1.0)) for ev in events]
+    velocity_factors = [float(ev.get("velocity_factor", 1.0)) for ev in events]
+    roles = compile_pattern_roles(events, BASS_ROLE_CODES)
+    glides = [bool(ev.get("glide_to_next", False)) for ev in events]
+    random_indices = tuple(i for i, role in enumerate(roles) if role in (_ROLE_RANDOM_CHORD_TONE, _ROLE_SCALE_TONE))
+    if np is not None:
+        return CompiledBassPattern(np.asarray(offsets, dtype=np.float64), np.asarray(durations, dtype=np.float64),
+                                   np.asarray(velocity_factors, dtype=np.float64), np.asarray(roles, dtype=np.int8),
+                                   np.asarray(glides, dtype=bool), random_indices)
+    return CompiledBassPattern(tuple(offsets), tuple(durations), tuple(velocity_factors), tuple(roles), tuple(glides), random_indices)
+
 class BassGenerator:
     def __init__(self, rhythm_library: Optional[Dict[str, Dict]] = None, default_instrument: m21instrument.Instrument = m21instrument.AcousticBass(), global_tempo: int = 120, global_time_signature: str = "4/4", global_key_tonic: str = "C", global_key_mode: str = "major", rng_seed: Optional[int] = None):
         self.logger = logging.getLogger(__name__)
@@ -60,6 +165,12 @@ class BassGenerator:
             self.rng = random.Random(rng_seed)
         else:
             self.rng = random.Random()
+        self.midi_program = default_instrument.midiProgram if default_instrument.midiProgram is not None else 32
+        self._measure_template_cache: "OrderedDict[Tuple[Any, ...], MeasureTemplate]" = OrderedDict()
+        self._chord_fallback_cache: Dict[str, Optional[ChordPCs]] = {} # ネイティブパーサで読めないラベルの music21 解析結果
+        self.measure_template_cache_hits = 0
+        self.measure_template_cache_misses = 0
+        self.last_harmonic_context: Optional[HarmonicContext] = None # 直近の compose で作った和声コンテキスト
 
         # デフォルトパターンの追加 (もし存在しなければ)
         if "basic_chord_tone_quarters" not in self.bass_rhythm_library:
@@ -72,6 +183,11 @@ class BassGenerator:
             self.bass_rhythm_library["root_only"] = {"description": "Fallback whole-note roots.", "tags": ["bass", "fallback", "algorithmic"], "pattern_type": "algorithmic_root_only", "pattern": [{"offset": 0.0, "duration": 4.0, "velocity_factor": 0.6}]} # patternはアルゴリズム用には不要だが一応
             self.logger.info("BassGenerator: Added 'root_only' to bass_rhythm_library.")
 
+        # 固定パターンはここで一度だけ配列に変換しておく (ブロックごとの dict 解釈を省く)
+        self._compiled_fixed_patterns: Dict[str, CompiledBassPattern] = {
+            key: compile_bass_pattern(details["pattern"]) for key, details in self.bass_rhythm_library.items()
+            if isinstance(details, dict) and isinstance(details.get("pattern"), list) and "algorithmic" not in str(details.get("pattern_type", ""))}
+
 
     def _choose_bass_pattern_key(self, section_musical_intent: dict) -> str: # メソッド化
         emotion = section_musical_intent.get("emotion", "default"); intensity = section_musical_intent.get("intensity", "medium").lower()
@@ -94,50 +210,101 @@ class BassGenerator:
                 return {"pattern_type": "algorithmic_root_only", "pattern": [], "options": {}} # 最低限のフォールバック
         return details
 
-    def _get_bass_pitch_in_octave(self, base_pitch_obj: Optional[pitch.Pitch], target_octave: int) -> int:
-        if not base_pitch_obj: return pitch.Pitch(f"C{target_octave}").midi
-        p_new = pitch.Pitch(base_pitch_obj.name); p_new.octave = target_octave; min_bass_midi = 28; max_bass_midi = 60; current_midi = p_new.midi
-        while current_midi < min_bass_midi: current_midi += 12
-        while current_midi > max_bass_midi:
-            if current_midi - 12 >= min_bass_midi: current_midi -= 12
-            else: break
-        return max(min_bass_midi, min(current_midi, max_bass_midi))
-
-    def _generate_notes_from_fixed_pattern( self, pattern: List[Dict[str, Any]], m21_cs: harmony.ChordSymbol, base_velocity: int, target_octave: int, block_duration: float, current_scale: Optional[music21.scale.ConcreteScale] = None) -> List[Tuple[float, music21.note.Note]]:
-        notes: List[Tuple[float, music21.note.Note]] = [];
-        if not m21_cs or not m21_cs.pitches: return notes
-        root_pitch_obj = m21_cs.root(); third_pitch_obj = m21_cs.third; fifth_pitch_obj = m21_cs.fifth; chord_tones = [p for p in [root_pitch_obj, third_pitch_obj, fifth_pitch_obj] if p]
-        for p_event in pattern:
-            offset_in_block = p_event.get("offset", 0.0); duration_ql = p_event.get("duration", 1.0); vel_factor = p_event.get("velocity_factor", 1.0); note_type = p_event.get("type", "root").lower()
-            final_velocity = max(1, min(127, int(base_velocity * vel_factor))); chosen_pitch_base: Optional[pitch.Pitch] = None
-            if note_type == "root" and root_pitch_obj: chosen_pitch_base = root_pitch_obj
-            elif note_type == "fifth" and fifth_pitch_obj: chosen_pitch_base = fifth_pitch_obj
-            elif note_type == "third" and third_pitch_obj: chosen_pitch_base = third_pitch_obj
-            elif note_type == "octave_root" and root_pitch_obj: chosen_pitch_base = root_pitch_obj
-            elif note_type == "random_chord_tone" and chord_tones: chosen_pitch_base = self.rng.choice(chord_tones)
-            elif note_type == "scale_tone" and current_scale:
-                try: p_s = current_scale.pitchFromDegree(self.rng.choice([1,2,3,4,5,6,7]))
-                except Exception: p_s = None
-                if p_s: chosen_pitch_base = p_s
-                elif root_pitch_obj: chosen_pitch_base = root_pitch_obj
-            elif note_type == "approach" and root_pitch_obj: chosen_pitch_base = root_pitch_obj.transpose(-1) # 単純な半音下
-            if not chosen_pitch_base and root_pitch_obj: chosen_pitch_base = root_pitch_obj # フォールバック
-            if chosen_pitch_base:
-                midi_pitch = self._get_bass_pitch_in_octave(chosen_pitch_base, target_octave); n = music21.note.Note(); n.pitch.midi = midi_pitch
-                n.duration = music21.duration.Duration(duration_ql); n.volume.velocity = final_velocity
-                if p_event.get("glide_to_next", False): n.tie = music21.tie.Tie("start")
-                notes.append((offset_in_block, n))
-        return notes
-
-    def _apply_weak_beat(self, notes_in_measure: List[Tuple[float, music21.note.Note]],
+    def _resolve_bass_register(self, bass_params: Dict[str, Any]) -> Tuple[int, int]:
+        """セクションのパラメータから音域 (min_midi, max_midi) を決める。5弦やシンセベース用に bass_range_min/max_midi で変更可能。"""
+        min_midi = bass_params.get("bass_range_min_midi", DEFAULT_BASS_REGISTER[0])
+        max_midi = bass_params.get("bass_range_max_midi", DEFAULT_BASS_REGISTER[1])
+        try: min_midi = int(min_midi); max_midi = int(max_midi)
+        except (TypeError, ValueError): min_midi, max_midi = DEFAULT_BASS_REGISTER
+        if not (0 <= min_midi and max_midi <= 127 and max_midi - min_midi >= 11):
+            self.logger.warning(f"BassGen: Invalid bass range {min_midi}-{max_midi} (needs at least an octave within 0-127). Using {DEFAULT_BASS_REGISTER}.")
+            return DEFAULT_BASS_REGISTER
+        return (min_midi, max_midi)
+
+    def _chord_pcs_for_label(self, normalized_label: str) -> Optional[ChordPCs]:
+        """ネイティブパーサで読めないラベルだけ music21 で解析する (ルートのみのフォールバックを含む)。結果はラベルごとに保持。"""
+        chord_pcs = parse_chord_pcs(normalized_label)
+        if chord_pcs is not None: return chord_pcs
+        if normalized_label in self._chord_fallback_cache: return self._chord_fallback_cache[normalized_label]
+
+        m21_cs_obj: Optional[harmony.ChordSymbol] = None; sanitized_label : Optional[str] = None; parse_failure_reason = "Unknown parse error"
+        try:
+            sanitized_label = sanitize_chord_label(normalized_label)
+            if sanitized_label and sanitized_label.lower() != "rest": m21_cs_obj = harmony.ChordSymbol(sanitized_label)
+            else: parse_failure_reason = f"sanitize_chord_label returned None for '{normalized_label}'"
+        except harmony.HarmonyException as e_harm: parse_failure_reason = f"HarmonyException for '{sanitized_label}': {e_harm}"
+        except Exception as e_chord_parse: parse_failure_reason = f"Unexpected parse error for '{sanitized_label}': {e_chord_parse}"
+
+        if not m21_cs_obj:
+            self.logger.warning(f"BassGen: Chord '{normalized_label}' could not be fully parsed ({parse_failure_reason}). Attempting root-only fallback.")
+            root_only_match = _ROOT_RE_STRICT.match(normalized_label)
+            if root_only_match:
+                try: m21_cs_obj = harmony.ChordSymbol(root_only_match.group(0)); self.logger.info(f"BassGen: Fallback to root: '{m21_cs_obj.figure}' for original '{normalized_label}'.")
+                except Exception as e_root_parse: self.logger.error(f"BassGen: Could not even parse root '{root_only_match.group(0)}' from '{normalized_label}': {e_root_parse}.")
+            else: self.logger.error(f"BassGen: Could not extract root from '{normalized_label}' ({parse_failure_reason}).")
+
+        chord_pcs = chord_pcs_from_chord_symbol(m21_cs_obj) if m21_cs_obj else None
+        self._chord_fallback_cache[normalized_label] = chord_pcs
+        return chord_pcs
+
+    def _build_harmonic_context(self, processed_blocks: Sequence[Dict[str, Any]]) -> HarmonicContext:
+        """全ブロックのコードを一度ずつ解析し、次のルートとセクション終端までの距離を後ろから埋める。"""
+        block_count = len(processed_blocks)
+        chord_pcs_list: List[Optional[ChordPCs]] = []
+        for blk in processed_blocks:
+            normalized_label = normalize_chord_label(blk.get("chord_label", "C"))
+            chord_pcs_list.append(None if normalized_label.lower() == "rest" else self._chord_pcs_for_label(normalized_label))
+        root_pcs = [cp.root_pc if cp else -1 for cp in chord_pcs_list]
+        qualities = [chord_quality_code(cp) if cp else -1 for cp in chord_pcs_list]
+        next_root_pcs = root_pcs[1:] + [-1]
+        for i in range(block_count - 1): # 次ブロックにラベルが無い場合は従来どおり先読みしない
+            if not processed_blocks[i + 1].get("chord_label"): next_root_pcs[i] = -1
+        to_section_end = [0.0] * block_count; section_end = 0.0
+        for i in range(block_count - 1, -1, -1):
+            blk = processed_blocks[i]; blk_offset = float(blk.get("offset", 0.0)); blk_end = blk_offset + float(blk.get("q_length", 4.0))
+            if i == block_count - 1 or processed_blocks[i + 1].get("section_name") != blk.get("section_name"): section_end = blk_end
+            to_section_end[i] = max(section_end, blk_end) - blk_offset
+        if np is not None:
+            return HarmonicContext(tuple(chord_pcs_list), np.asarray(root_pcs, dtype=np.int8), np.asarray(next_root_pcs, dtype=np.int8),
+                                   np.asarray(qualities, dtype=np.int8), np.asarray(to_section_end, dtype=np.float64))
+        return HarmonicContext(tuple(chord_pcs_list), tuple(root_pcs), tuple(next_root_pcs), tuple(qualities), tuple(to_section_end))
+
+    def _generate_notes_from_fixed_pattern( self, pattern: Union[List[Dict[str, Any]], CompiledBassPattern], chord_pcs: ChordPCs, base_velocity: int, target_octave: int, block_duration: float, current_scale: Optional[ScaleDescriptor] = None, bass_register: Tuple[int, int] = DEFAULT_BASS_REGISTER) -> List[BassEvent]:
+        if not chord_pcs: return []
+        compiled = pattern if isinstance(pattern, CompiledBassPattern) else compile_bass_pattern(pattern)
+        if not len(compiled.roles): return []
+        root_pc = chord_pcs.root_pc; third_pc = chord_pcs.third_pc; fifth_pc = chord_pcs.fifth_pc; chord_tones = [pc for pc in [root_pc, third_pc, fifth_pc] if pc is not None]
+        # 役割コード順の MIDI (乱数系の役割はルートで仮置きし、下で上書き)
+        seventh_pc = seventh_pc_of(chord_pcs)
+        role_pcs = [root_pc, fifth_pc if fifth_pc is not None else root_pc, third_pc if third_pc is not None else root_pc,
+                    root_pc, seventh_pc if seventh_pc is not None else root_pc, root_pc, root_pc,
+                    root_pc, root_pc, (root_pc - 1) % 12] # approach は単純な半音下
+        role_midis = [fold_to_bass_register(pc, target_octave, bass_register) for pc in role_pcs]
+        if np is not None:
+            midis = np.asarray(role_midis, dtype=np.int64)[compiled.roles].tolist()
+            velocities = np.clip((base_velocity * compiled.velocity_factors).astype(np.int64), 1, 127).tolist()
+            offsets = compiled.offsets.tolist(); durations = compiled.durations.tolist(); glides = compiled.glides.tolist()
+        else:
+            midis = [role_midis[role] for role in compiled.roles]
+            velocities = [max(1, min(127, int(base_velocity * vf))) for vf in compiled.velocity_factors]
+            offsets = list(compiled.offsets); durations = list(compiled.durations); glides = list(compiled.glides)
+        for i in compiled.random_indices: # 乱数の消費順はパターン順のまま
+            if compiled.roles[i] == _ROLE_RANDOM_CHORD_TONE: chosen_pc = self.rng.choice(chord_tones)
+            elif current_scale: chosen_pc = current_scale.pc_of_degree(self.rng.choice([1,2,3,4,5,6,7]))
+            else: continue
+            midis[i] = fold_to_bass_register(chosen_pc, target_octave, bass_register)
+        return [BassEvent(o, m, d, v, g) for o, m, d, v, g in zip(offsets, midis, durations, velocities, glides)]
+
+    def _apply_weak_beat(self, notes_in_measure: List[BassEvent],
                          style: str,
-                         base_velocity: int) -> List[Tuple[float, music21.note.Note]]:
+                         base_velocity: int) -> List[BassEvent]:
         if style == "none" or not notes_in_measure: return notes_in_measure
-        new_notes_tuples: List[Tuple[float, music21.note.Note]] = []
+        new_notes: List[BassEvent] = []
         beats_in_measure = self.global_time_signature_obj.beatCount if self.global_time_signature_obj else 4
         beat_q_len = self.global_time_signature_obj.beatDuration.quarterLength if self.global_time_signature_obj else 1.0
 
-        for rel_offset, note_obj in notes_in_measure:
+        for note_ev in notes_in_measure:
+            rel_offset = note_ev.offset
             is_weak_beat = False
             # 拍番号を計算 (0-indexed)
             beat_number_float = rel_offset / beat_q_len
@@ -154,77 +321,140 @@ class BassGenerator:
             if is_weak_beat:
                 if style == "rest": self.logger.debug(f"BassGen _apply_weak_beat: Removing note at offset {rel_offset} for style 'rest'."); continue
                 elif style == "ghost":
-                    original_vel = note_obj.volume.velocity if note_obj.volume and note_obj.volume.velocity is not None else base_velocity
-                    note_obj.volume.velocity = max(1, int(original_vel * 0.4))
-                    self.logger.debug(f"BassGen _apply_weak_beat: Ghosting note at offset {rel_offset} to vel {note_obj.volume.velocity}.")
-            new_notes_tuples.append((rel_offset, note_obj))
-        return new_notes_tuples
+                    original_vel = note_ev.velocity if note_ev.velocity is not None else base_velocity
+                    note_ev = note_ev._replace(velocity=max(1, int(original_vel * 0.4)))
+                    self.logger.debug(f"BassGen _apply_weak_beat: Ghosting note at offset {rel_offset} to vel {note_ev.velocity}.")
+            new_notes.append(note_ev)
+        return new_notes
 
     def _insert_approach_note_to_measure(self,
-                                      notes_in_measure: List[Tuple[float, music21.note.Note]],
-                                      current_chord_symbol: harmony.ChordSymbol,
-                                      next_chord_root: Optional[pitch.Pitch],
-                                      current_scale: music21.scale.ConcreteScale,
+                                      notes_in_measure: List[BassEvent],
+                                      current_chord: ChordPCs,
+                                      next_chord_root_pc: Optional[int],
+                                      scale_mask: int,
                                       approach_style: str,
                                       target_octave: int,
-                                      base_velocity: int
-                                      ) -> List[Tuple[float, music21.note.Note]]:
-        if not next_chord_root or self.measure_duration < 1.0:
+                                      base_velocity: int,
+                                      bass_register: Tuple[int, int] = DEFAULT_BASS_REGISTER
+                                      ) -> List[BassEvent]:
+        if next_chord_root_pc is None or self.measure_duration < 1.0:
             return notes_in_measure
 
         approach_note_rel_offset = self.measure_duration - 0.25
 
         can_insert = True
-        original_last_note_tuple: Optional[Tuple[float, music21.note.Note]] = None
-        sorted_notes_in_measure = sorted(notes_in_measure, key=lambda x: x[0])
+        original_last_idx: Optional[int] = None
+        sorted_notes_in_measure = sorted(notes_in_measure, key=lambda ev: ev.offset)
 
-        for rel_offset, note_obj in reversed(sorted_notes_in_measure):
-            if rel_offset >= approach_note_rel_offset:
+        for idx in range(len(sorted_notes_in_measure) - 1, -1, -1):
+            note_ev = sorted_notes_in_measure[idx]
+            if note_ev.offset >= approach_note_rel_offset:
                 can_insert = False; break
-            if rel_offset < approach_note_rel_offset and (rel_offset + note_obj.duration.quarterLength > approach_note_rel_offset):
-                original_last_note_tuple = (rel_offset, note_obj)
+            if note_ev.offset + note_ev.duration > approach_note_rel_offset:
+                original_last_idx = idx
                 break
 
         if not can_insert:
             self.logger.debug(f"BassGen _insert_approach: Cannot insert approach note at {approach_note_rel_offset}, existing note conflict.")
             return notes_in_measure
 
-        from_pitch_for_approach = current_chord_symbol.root()
-        if original_last_note_tuple:
-            from_pitch_for_approach = original_last_note_tuple[1].pitch
+        from_midi = fold_to_bass_register(current_chord.root_pc, target_octave, bass_register)
+        if original_last_idx is not None:
+            from_midi = sorted_notes_in_measure[original_last_idx].midi
         elif sorted_notes_in_measure:
-             from_pitch_for_approach = sorted_notes_in_measure[-1][1].pitch
+            from_midi = sorted_notes_in_measure[-1].midi
 
-        approach_pitch_obj = get_approach_note(
-            from_pitch_for_approach, next_chord_root, current_scale, approach_style=approach_style
-        )
+        # 目標音もベース音域に置いてから、どちら側から近づくかを決める
+        target_midi = fold_to_bass_register(next_chord_root_pc, target_octave, bass_register)
+        approach_offset = get_approach_offset(next_chord_root_pc, scale_mask, approach_style, 2, None, from_midi - target_midi)
 
-        if approach_pitch_obj:
-            app_note = music21.note.Note()
-            app_note.pitch.midi = self._get_bass_pitch_in_octave(approach_pitch_obj, target_octave)
-            app_note.duration.quarterLength = 0.25
-            app_note.volume.velocity = min(127, int(base_velocity * 0.85))
+        if approach_offset is not None:
+            app_note = BassEvent(approach_note_rel_offset, fold_to_bass_register(next_chord_root_pc + approach_offset, target_octave, bass_register),
+                                 0.25, min(127, int(base_velocity * 0.85)))
 
-            if original_last_note_tuple:
-                orig_rel_offset, orig_note_obj_ref = original_last_note_tuple
-                new_dur = approach_note_rel_offset - orig_rel_offset
+            if original_last_idx is not None:
+                orig_note = sorted_notes_in_measure[original_last_idx]
+                new_dur = approach_note_rel_offset - orig_note.offset
                 if new_dur >= MIN_NOTE_DURATION_QL / 2:
-                    orig_note_obj_ref.duration.quarterLength = new_dur
+                    sorted_notes_in_measure[original_last_idx] = orig_note._replace(duration=new_dur)
                 else:
                     self.logger.debug(f"BassGen _insert_approach: Last note would be too short ({new_dur}) after making space. Skipping approach.")
                     return notes_in_measure
 
-            notes_in_measure.append((approach_note_rel_offset, app_note))
-            notes_in_measure.sort(key=lambda x: x[0])
-            self.logger.info(f"BassGen _insert_approach: Added approach note {app_note.nameWithOctave} at {approach_note_rel_offset} for next root {next_chord_root.name}")
+            sorted_notes_in_measure.append(app_note)
+            sorted_notes_in_measure.sort(key=lambda ev: ev.offset)
+            self.logger.info(f"BassGen _insert_approach: Added approach note (midi {app_note.midi}) at {approach_note_rel_offset} for next root pc {next_chord_root_pc}")
+            return sorted_notes_in_measure
         return notes_in_measure
 
 
-    def _generate_algorithmic_pattern(self, pattern_type: str, m21_cs: harmony.ChordSymbol, options: Dict[str, Any], base_velocity: int, target_octave: int, block_offset_ignored: float, block_duration: float, current_scale: music21.scale.ConcreteScale, next_chord_root: Optional[pitch.Pitch] = None, section_overrides: Optional[Any] = None) -> List[Tuple[float, music21.note.Note]]:
-        notes_tuples: List[Tuple[float, music21.note.Note]] = []
-        if not m21_cs or not m21_cs.pitches: return notes_tuples
-        root_note_obj = m21_cs.root()
-        if not root_note_obj: return notes_tuples
+    def _get_measure_template(self, chord_pcs: ChordPCs, current_options: Dict[str, Any], effective_base_velocity: int,
+                              target_octave: int, current_scale: ScaleDescriptor,
+                              next_chord_root_pc: Optional[int], bass_register: Tuple[int, int] = DEFAULT_BASS_REGISTER) -> MeasureTemplate:
+        """algorithmic_chord_tone_quarters の1小節分を (offset, midi, duration, velocity) で返す。結果は LRU でキャッシュする。"""
+        cache_key = (
+            chord_pcs, next_chord_root_pc,
+            json.dumps(current_options, sort_keys=True, default=str), effective_base_velocity, target_octave,
+            self.global_time_signature_obj.ratioString if self.global_time_signature_obj else "4/4",
+            current_scale, bass_register,
+        )
+        cached_template = self._measure_template_cache.get(cache_key)
+        if cached_template is not None:
+            self._measure_template_cache.move_to_end(cache_key)
+            self.measure_template_cache_hits += 1
+            return cached_template
+        self.measure_template_cache_misses += 1
+
+        strong_beat_vel_boost = current_options.get("strong_beat_velocity_boost", 15)
+        off_beat_vel_reduction = current_options.get("off_beat_velocity_reduction", 5)
+        weak_beat_style_final = current_options.get("weak_beat_style", "root")
+        approach_on_4th_final = current_options.get("approach_on_4th_beat", True) # Trueがデフォルト
+        approach_style_final = current_options.get("approach_style_on_4th", "chromatic_or_diatonic")
+
+        beats_per_measure_in_block = self.global_time_signature_obj.beatCount if self.global_time_signature_obj else 4
+
+        measure_notes_raw: List[BassEvent] = []
+        for beat_idx in range(beats_per_measure_in_block):
+            current_rel_offset_in_measure = beat_idx * 1.0
+            chosen_pc: int
+            current_velocity = effective_base_velocity
+            note_duration_ql = 1.0
+
+            if beat_idx == 0 :
+                chosen_pc = chord_pcs.root_pc
+                current_velocity = min(127, effective_base_velocity + strong_beat_vel_boost)
+            elif beats_per_measure_in_block >= 4 and beat_idx == (beats_per_measure_in_block // 2) :
+                if chord_pcs.fifth_pc is not None: chosen_pc = chord_pcs.fifth_pc
+                elif chord_pcs.third_pc is not None: chosen_pc = chord_pcs.third_pc
+                else: chosen_pc = chord_pcs.root_pc
+                current_velocity = min(127, effective_base_velocity + (strong_beat_vel_boost // 2))
+            else:
+                chosen_pc = chord_pcs.root_pc
+                current_velocity = max(1, effective_base_velocity - off_beat_vel_reduction)
+
+            if note_duration_ql < MIN_NOTE_DURATION_QL: continue
+            measure_notes_raw.append(BassEvent(current_rel_offset_in_measure, fold_to_bass_register(chosen_pc, target_octave, bass_register),
+                                               note_duration_ql, current_velocity))
+
+        processed_measure_notes = self._apply_weak_beat(measure_notes_raw, weak_beat_style_final, effective_base_velocity)
+
+        if approach_on_4th_final and next_chord_root_pc is not None and beats_per_measure_in_block == 4:
+            processed_measure_notes = self._insert_approach_note_to_measure(
+                processed_measure_notes, chord_pcs, next_chord_root_pc, current_scale.mask,
+                approach_style_final, target_octave, effective_base_velocity, bass_register
+            )
+
+        template: MeasureTemplate = tuple(
+            (note_ev.offset, note_ev.midi, float(note_ev.duration), note_ev.velocity) for note_ev in processed_measure_notes
+        )
+        self._measure_template_cache[cache_key] = template
+        if len(self._measure_template_cache) > BASS_MEASURE_TEMPLATE_CACHE_SIZE:
+            self._measure_template_cache.popitem(last=False)
+        return template
+
+    def _generate_algorithmic_pattern(self, pattern_type: str, chord_pcs: ChordPCs, options: Dict[str, Any], base_velocity: int, target_octave: int, block_offset_ignored: float, block_duration: float, current_scale: ScaleDescriptor, next_chord_root_pc: Optional[int] = None, section_overrides: Optional[Any] = None, bass_register: Tuple[int, int] = DEFAULT_BASS_REGISTER) -> List[BassEvent]:
+        notes_out: List[BassEvent] = []
+        if not chord_pcs: return notes_out
         
         current_options = copy.deepcopy(options) # 元のoptionsをディープコピー
         effective_base_velocity = base_velocity
@@ -250,60 +480,18 @@ class BassGenerator:
 
 
         if pattern_type == "algorithmic_chord_tone_quarters":
-            strong_beat_vel_boost = current_options.get("strong_beat_velocity_boost", 15)
-            off_beat_vel_reduction = current_options.get("off_beat_velocity_reduction", 5)
-            weak_beat_style_final = current_options.get("weak_beat_style", "root")
-            approach_on_4th_final = current_options.get("approach_on_4th_beat", True) # Trueがデフォルト
-            approach_style_final = current_options.get("approach_style_on_4th", "chromatic_or_diatonic")
-
-            beats_per_measure_in_block = self.global_time_signature_obj.beatCount if self.global_time_signature_obj else 4
-            
-            measure_notes_raw: List[Tuple[float, music21.note.Note]] = []
-            for beat_idx in range(beats_per_measure_in_block):
-                current_rel_offset_in_measure = beat_idx * 1.0
-                chosen_pitch_base: Optional[pitch.Pitch] = None
-                current_velocity = effective_base_velocity
-                note_duration_ql = 1.0
-
-                if beat_idx == 0 :
-                    chosen_pitch_base = root_note_obj
-                    current_velocity = min(127, effective_base_velocity + strong_beat_vel_boost)
-                elif beats_per_measure_in_block >= 4 and beat_idx == (beats_per_measure_in_block // 2) :
-                    if m21_cs.fifth: chosen_pitch_base = m21_cs.fifth
-                    elif m21_cs.third: chosen_pitch_base = m21_cs.third
-                    else: chosen_pitch_base = root_note_obj
-                    current_velocity = min(127, effective_base_velocity + (strong_beat_vel_boost // 2))
-                else:
-                    chosen_pitch_base = root_note_obj
-                    current_velocity = max(1, effective_base_velocity - off_beat_vel_reduction)
-                
-                if chosen_pitch_base:
-                    if note_duration_ql < MIN_NOTE_DURATION_QL: continue
-                    midi_pitch = self._get_bass_pitch_in_octave(chosen_pitch_base, target_octave); n = music21.note.Note(); n.pitch.midi = midi_pitch
-                    n.duration.quarterLength = note_duration_ql; n.volume.velocity = current_velocity
-                    measure_notes_raw.append((current_rel_offset_in_measure, n))
-            
-            processed_measure_notes = self._apply_weak_beat(measure_notes_raw, weak_beat_style_final, effective_base_velocity)
+            measure_template = self._get_measure_template(chord_pcs, current_options, effective_base_velocity,
+                                                          target_octave, current_scale, next_chord_root_pc, bass_register)
 
-            if approach_on_4th_final and next_chord_root and beats_per_measure_in_block == 4:
-                processed_measure_notes = self._insert_approach_note_to_measure(
-                    processed_measure_notes, m21_cs, next_chord_root, current_scale,
-                    approach_style_final, target_octave, effective_base_velocity
-                )
-            
+            # キャッシュ済みテンプレートを小節単位で敷き詰める
             current_pos_in_block = 0.0
             while current_pos_in_block < block_duration - (MIN_NOTE_DURATION_QL / 8.0):
-                for rel_offset_in_measure, note_obj_template in processed_measure_notes:
+                for rel_offset_in_measure, midi_val, dur_ql, vel_val in measure_template:
                     abs_offset_in_block = current_pos_in_block + rel_offset_in_measure
                     if abs_offset_in_block >= block_duration - (MIN_NOTE_DURATION_QL / 8.0): break
-                    note_to_add = music21.note.Note(note_obj_template.pitch)
-                    note_to_add.duration.quarterLength = note_obj_template.duration.quarterLength
-                    note_to_add.volume.velocity = note_obj_template.volume.velocity
-                    remaining_block_dur = block_duration - abs_offset_in_block
-                    if note_to_add.duration.quarterLength > remaining_block_dur:
-                        note_to_add.duration.quarterLength = remaining_block_dur
-                    if note_to_add.duration.quarterLength >= MIN_NOTE_DURATION_QL / 2:
-                        notes_tuples.append((abs_offset_in_block, note_to_add))
+                    note_dur = min(dur_ql, block_duration - abs_offset_in_block)
+                    if note_dur >= MIN_NOTE_DURATION_QL / 2:
+                        notes_out.append(BassEvent(abs_offset_in_block, midi_val, note_dur, vel_val))
                 current_pos_in_block += self.measure_duration
                 if self.measure_duration <=0: break
 
@@ -311,33 +499,98 @@ class BassGenerator:
             note_duration_ql = current_options.get("note_duration_ql", block_duration);
             if note_duration_ql <= 0: note_duration_ql = block_duration
             num_notes = int(block_duration / note_duration_ql) if note_duration_ql > 0 else 0
+            root_midi = fold_to_bass_register(chord_pcs.root_pc, target_octave, bass_register)
             for i in range(num_notes):
-                current_rel_offset = i * note_duration_ql
-                midi_pitch = self._get_bass_pitch_in_octave(root_note_obj, target_octave); n = music21.note.Note(); n.pitch.midi = midi_pitch; n.duration.quarterLength = note_duration_ql
-                n.volume.velocity = effective_base_velocity; notes_tuples.append((current_rel_offset, n))
+                notes_out.append(BassEvent(i * note_duration_ql, root_midi, note_duration_ql, effective_base_velocity))
         else: # 未知のアルゴリズムパターンの場合、デフォルトのアルゴリズムにフォールバック
             self.logger.warning(f"BassGenerator: Unknown algorithmic pattern_type '{pattern_type}'. Falling back to 'algorithmic_chord_tone_quarters'.")
             default_algo_options = self.bass_rhythm_library.get("basic_chord_tone_quarters",{}).get("options",{})
             # section_overrides は最初の呼び出しで適用済みなので、再帰呼び出しでは None を渡す
-            notes_tuples.extend(self._generate_algorithmic_pattern("algorithmic_chord_tone_quarters", m21_cs, default_algo_options, base_velocity, target_octave, 0.0, block_duration, current_scale, next_chord_root, None))
-        return notes_tuples
+            notes_out.extend(self._generate_algorithmic_pattern("algorithmic_chord_tone_quarters", chord_pcs, default_algo_options, base_velocity, target_octave, 0.0, block_duration, current_scale, next_chord_root_pc, None, bass_register))
+        return notes_out
+
+    def _is_strong_beat(self, abs_offset: float) -> bool:
+        """小節の1拍目 (4拍以上なら中央の拍も) の拍頭かどうか。"""
+        beats_in_measure = self.global_time_signature_obj.beatCount if self.global_time_signature_obj else 4
+        beat_q_len = self.global_time_signature_obj.beatDuration.quarterLength if self.global_time_signature_obj else 1.0
+        beat_number_float = (abs_offset % self.measure_duration) / beat_q_len if self.measure_duration > 0 else 0.0
+        if abs(beat_number_float - round(beat_number_float)) >= 0.01: return False
+        beat_index = int(round(beat_number_float)) % beats_in_measure
+        return beat_index == 0 or (beats_in_measure >= 4 and beat_index == beats_in_measure // 2)
+
+    def _avoid_vocal_collisions(self, block_events: List[BassEvent], block_abs_offset: float, chord_pcs: ChordPCs,
+                                target_octave: int, bass_register: Tuple[int, int], vocal_index: VocalIntervalIndex) -> List[BassEvent]:
+        """強拍のベース音がボーカルとユニゾン(オクターブ)・短2度・長7度でぶつかる場合、ぶつからないコードトーンに差し替える。"""
+        beat_q_len = self.global_time_signature_obj.beatDuration.quarterLength if self.global_time_signature_obj else 1.0
 
-    def compose(self, processed_blocks: Sequence[Dict[str, Any]], overrides: Optional[Any] = None, return_pretty_midi: bool = False) -> Union[stream.Part, Any]:
+        def clashes(bass_pc: int, vocal_pcs: set) -> bool:
+            return any((bass_pc - vocal_pc) % 12 in (0, 1, 11) for vocal_pc in vocal_pcs)
+
+        adjusted_events: List[BassEvent] = []
+        for note_ev in block_events:
+            abs_offset = block_abs_offset + note_ev.offset
+            if not self._is_strong_beat(abs_offset):
+                adjusted_events.append(note_ev); continue
+            vocal_pcs = {midi_val % 12 for midi_val in vocal_index.pitches_in_window(abs_offset, abs_offset + min(note_ev.duration, beat_q_len))}
+            if vocal_pcs and clashes(note_ev.midi % 12, vocal_pcs):
+                for candidate_pc in (chord_pcs.fifth_pc, chord_pcs.third_pc, chord_pcs.root_pc):
+                    if candidate_pc is None or candidate_pc == note_ev.midi % 12 or clashes(candidate_pc, vocal_pcs): continue
+                    new_midi = fold_to_bass_register(candidate_pc, target_octave, bass_register)
+                    self.logger.debug(f"BassGen: Vocal collision at {abs_offset:.2f} (bass {note_ev.midi}, vocal pcs {sorted(vocal_pcs)}). Using {new_midi}.")
+                    note_ev = note_ev._replace(midi=new_midi)
+                    break
+            adjusted_events.append(note_ev)
+        return adjusted_events
+
+    def compose(self, processed_blocks: Sequence[Dict[str, Any]], overrides: Optional[Any] = None,
+                return_pretty_midi: bool = False, return_events: bool = False,
+                vocal_notes: Optional[Union[Sequence[Dict[str, Any]], VocalIntervalIndex]] = None) -> Union[stream.Part, Any]:
+        """
+        return_pretty_midi=True なら pretty_midi.Instrument を、return_events=True なら BassEvent のリストを返す。
+        どちらも music21 オブジェクトは生成しない。music21 の Part は同じイベント列から _events_to_part で作る。
+        vocal_notes (ボーカルの音符 dict のリストまたは VocalIntervalIndex) を渡すと、強拍でボーカルとぶつかる音を避ける。
+        """
+        vocal_index = vocal_notes if isinstance(vocal_notes, VocalIntervalIndex) else (VocalIntervalIndex(vocal_notes) if vocal_notes else None)
+        bass_events = self._render_events(processed_blocks, overrides, vocal_index)
+        if return_events: return bass_events
+        if return_pretty_midi: return self._events_to_pretty_midi(bass_events)
+        first_block = processed_blocks[0] if processed_blocks else {}
+        return self._events_to_part(bass_events, first_block.get("tonic_of_section", self.global_key_tonic), first_block.get("mode", self.global_key_mode))
+
+    def _events_to_part(self, bass_events: Sequence[BassEvent], key_tonic: str, key_mode: str) -> stream.Part:
         bass_part = stream.Part(id="Bass"); bass_part.insert(0, self.default_instrument)
         if self.global_tempo: bass_part.insert(0, tempo.MetronomeMark(number=self.global_tempo))
         if self.global_time_signature_obj: bass_part.insert(0, meter.TimeSignature(self.global_time_signature_obj.ratioString))
         else: bass_part.insert(0, meter.TimeSignature("4/4"))
+        try: bass_part.insert(0, key.Key(key_tonic, key_mode.lower()))
+        except Exception: bass_part.insert(0, key.Key(self.global_key_tonic, self.global_key_mode.lower()))
+
+        for ev in bass_events:
+            n = note.Note(); n.pitch.midi = ev.midi
+            n.duration.quarterLength = ev.duration; n.volume.velocity = ev.velocity
+            if ev.tie_start: n.tie = music21.tie.Tie("start")
+            bass_part.insert(ev.offset, n)
+        return bass_part
 
-        if processed_blocks:
-            first_block_tonic = processed_blocks[0].get("tonic_of_section", self.global_key_tonic); first_block_mode = processed_blocks[0].get("mode", self.global_key_mode)
-            try:
-                if not bass_part.getElementsByClass(key.Key).first(): bass_part.insert(0, key.Key(first_block_tonic, first_block_mode.lower()))
-            except Exception:
-                 if not bass_part.getElementsByClass(key.Key).first(): bass_part.insert(0, key.Key(self.global_key_tonic, self.global_key_mode.lower()))
-        else:
-            if not bass_part.getElementsByClass(key.Key).first(): bass_part.insert(0, key.Key(self.global_key_tonic, self.global_key_mode.lower()))
-
+    def _events_to_pretty_midi(self, bass_events: Sequence[BassEvent]) -> Any:
+        if pretty_midi is None:
+            raise ImportError("BassGen: pretty_midi is not installed. `pip install pretty_midi`")
+        sec_per_ql = 60.0 / float(self.global_tempo or 120)
+        bass_inst = pretty_midi.Instrument(program=self.midi_program, name="Bass")
+        bass_inst.notes = [
+            pretty_midi.Note(velocity=int(ev.velocity), pitch=int(ev.midi),
+                             start=ev.offset * sec_per_ql, end=(ev.offset + ev.duration) * sec_per_ql)
+            for ev in bass_events
+        ]
+        return bass_inst
+
+    def _render_events(self, processed_blocks: Sequence[Dict[str, Any]], overrides: Optional[Any] = None,
+                       vocal_index: Optional[VocalIntervalIndex] = None) -> List[BassEvent]:
+        bass_events: List[BassEvent] = []
         part_overall_humanize_params = None
+        block_plans: List[Dict[str, Any]] = [] # 鳴らすブロックだけ。パラメータ解決 (1パス目) と音の生成 (2パス目) を分ける
+        harmonic_context = self._build_harmonic_context(processed_blocks)
+        self.last_harmonic_context = harmonic_context
 
         for blk_idx, blk_data_original in enumerate(processed_blocks):
             blk_data = copy.deepcopy(blk_data_original) # 元のデータを変更しないようにコピー
@@ -357,7 +610,7 @@ class BassGenerator:
                     final_bass_params["options"].update(override_dict.pop("options"))
                 final_bass_params.update(override_dict)
             
-            blk_data["part_params"]["bass"] = final_bass_params # マージ結果をblk_dataに反映
+            blk_data.setdefault("part_params", {})["bass"] = final_bass_params # マージ結果をblk_dataに反映
 
             block_musical_intent = blk_data.get("musical_intent", {})
             rhythm_key_from_params = final_bass_params.get("rhythm_key", final_bass_params.get("style"))
@@ -378,86 +631,157 @@ class BassGenerator:
                 }
 
             chord_label_str = blk_data.get("chord_label", "C"); block_q_length = float(blk_data.get("q_length", 4.0)); block_abs_offset = float(blk_data.get("offset", 0.0))
-            m21_cs_obj: Optional[harmony.ChordSymbol] = None; sanitized_label : Optional[str] = None; parse_failure_reason = "Unknown parse error"
-            try:
-                sanitized_label = sanitize_chord_label(chord_label_str)
-                if sanitized_label and sanitized_label.lower() != "rest": m21_cs_obj = harmony.ChordSymbol(sanitized_label);
-                elif sanitized_label and sanitized_label.lower() == "rest": self.logger.info(f"BassGen: Block {blk_idx+1} is a Rest."); continue
-                else: parse_failure_reason = f"sanitize_chord_label returned None for '{chord_label_str}'"
-            except harmony.HarmonyException as e_harm: parse_failure_reason = f"HarmonyException for '{sanitized_label}': {e_harm}"
-            except Exception as e_chord_parse: parse_failure_reason = f"Unexpected parse error for '{sanitized_label}': {e_chord_parse}"
-
-            if not m21_cs_obj and sanitized_label and sanitized_label.lower() != "rest":
-                self.logger.warning(f"BassGen: Chord '{chord_label_str}' (sanitized: '{sanitized_label}') could not be fully parsed ({parse_failure_reason}). Attempting root-only fallback.")
-                root_only_match = _ROOT_RE_STRICT.match(sanitized_label if sanitized_label else "")
-                if root_only_match:
-                    try: m21_cs_obj = harmony.ChordSymbol(root_only_match.group(0)); self.logger.info(f"BassGen: Fallback to root: '{m21_cs_obj.figure}' for original '{chord_label_str}'.")
-                    except Exception as e_root_parse: self.logger.error(f"BassGen: Could not even parse root '{root_only_match.group(0)}' from '{chord_label_str}': {e_root_parse}. Skipping block."); continue
-                else: self.logger.error(f"BassGen: Could not extract root from '{sanitized_label}' after sanitize failure ({parse_failure_reason}). Skipping block."); continue
-            elif not m21_cs_obj and (not sanitized_label or sanitized_label.lower() != "rest"): self.logger.error(f"BassGen: No valid chord or root for block {blk_idx+1} (Label: '{chord_label_str}', Sanitized: '{sanitized_label}', Reason: {parse_failure_reason}). Skipping."); continue
+            chord_pcs = harmonic_context.chord_pcs[blk_idx]
+            if not chord_pcs:
+                normalized_label = normalize_chord_label(chord_label_str)
+                if normalized_label.lower() == "rest": self.logger.info(f"BassGen: Block {blk_idx+1} is a Rest.")
+                else: self.logger.error(f"BassGen: No valid chord or root for block {blk_idx+1} (Label: '{chord_label_str}', Normalized: '{normalized_label}'). Skipping.")
+                continue
 
             pattern_details = self._get_rhythm_pattern_details(final_bass_params.get("rhythm_key"))
             if not pattern_details: self.logger.warning(f'Skipped block {blk_idx+1} in compose: chord="{chord_label_str}", reason="No pattern_details for rhythm_key {final_bass_params.get("rhythm_key")}"'); continue
             
             # base_velocity は final_bass_params から取得 (override適用済み)
             base_vel = final_bass_params.get("velocity", pattern_details.get("velocity_base", 70))
-            target_oct = final_bass_params.get("octave", pattern_details.get("target_octave", 2))
+            target_oct = int(final_bass_params.get("octave", pattern_details.get("target_octave", 2))) # YAML / JSON では 2.0 のこともある
+            bass_register = self._resolve_bass_register(final_bass_params)
             section_tonic = blk_data.get("tonic_of_section", self.global_key_tonic); section_mode = blk_data.get("mode", self.global_key_mode)
-            current_m21_scale = ScaleRegistry.get(section_tonic, section_mode)
-            if not current_m21_scale: current_m21_scale = music21.scale.MajorScale("C")
-            next_chord_root_pitch: Optional[pitch.Pitch] = None
-            if blk_idx + 1 < len(processed_blocks):
-                next_blk_data = processed_blocks[blk_idx + 1]; next_chord_label_str = next_blk_data.get("chord_label")
-                if next_chord_label_str:
-                    next_sanitized_label = sanitize_chord_label(next_chord_label_str)
-                    if next_sanitized_label and next_sanitized_label.lower() != "rest":
-                        try: next_cs_obj = harmony.ChordSymbol(next_sanitized_label);
-                        except Exception: next_cs_obj = None
-                        if next_cs_obj and next_cs_obj.root(): next_chord_root_pitch = next_cs_obj.root()
-            
-            generated_notes_for_block: List[Tuple[float, music21.note.Note]] = []
-            if m21_cs_obj:
-                if "pattern_type" in pattern_details and isinstance(pattern_details["pattern_type"], str) and "algorithmic" in pattern_details["pattern_type"]:
-                    algo_options = pattern_details.get("options", {}).copy() # パターン固有のオプション
-                    # final_bass_params の中の "options" をマージ (chordmapやoverride由来)
-                    algo_options.update(final_bass_params.get("options", {}))
-                    
-                    # weak_beat_style など、final_bass_params 直下のキーもアルゴリズムオプションとして渡す
-                    # (ただし、algo_options内の同名キーを上書きしないように注意)
-                    for k in ["weak_beat_style", "approach_on_4th_beat", "approach_style_on_4th"]:
-                        if k in final_bass_params and k not in algo_options : # algo_optionsになければ追加
-                             algo_options[k] = final_bass_params[k]
-
-                    generated_notes_for_block = self._generate_algorithmic_pattern(
-                        pattern_details["pattern_type"], m21_cs_obj, algo_options,
-                        base_vel, target_oct, 0.0, block_q_length, current_m21_scale,
-                        next_chord_root_pitch, section_overrides=part_specific_overrides_model
-                    )
-                elif "pattern" in pattern_details and isinstance(pattern_details["pattern"], list):
-                    generated_notes_for_block = self._generate_notes_from_fixed_pattern(
-                        pattern_details["pattern"], m21_cs_obj, base_vel, target_oct, block_q_length, current_m21_scale
-                    )
+            current_scale = ScaleRegistry.get_descriptor(section_tonic, section_mode)
+            next_chord_root_pc = harmonic_context.next_root_pc(blk_idx)
             
-            for rel_offset, note_obj in generated_notes_for_block:
-                abs_note_offset = block_abs_offset + rel_offset
-                end_of_note = abs_note_offset + note_obj.duration.quarterLength
-                end_of_block = block_abs_offset + block_q_length
-                if end_of_note > end_of_block + 0.001:
-                    new_dur = end_of_block - abs_note_offset
-                    if new_dur > MIN_NOTE_DURATION_QL / 2: note_obj.duration.quarterLength = new_dur
-                    else: continue
-                if note_obj.duration.quarterLength >= MIN_NOTE_DURATION_QL / 2:
-                     bass_part.insert(abs_note_offset, note_obj)
-                else: self.logger.debug(f"BassGen: Final note for {m21_cs_obj.figure if m21_cs_obj else 'N/A'} at {abs_note_offset:.2f} is too short. Skipping.")
+
+            algo_options: Optional[Dict[str, Any]] = None; fixed_pattern: Optional[Union[List[Dict[str, Any]], CompiledBassPattern]] = None
+            if "pattern_type" in pattern_details and isinstance(pattern_details["pattern_type"], str) and "algorithmic" in pattern_details["pattern_type"]:
+                algo_options = pattern_details.get("options", {}).copy() # パターン固有のオプション
+                # final_bass_params の中の "options" をマージ (chordmapやoverride由来)
+                algo_options.update(final_bass_params.get("options", {}))
+                
+                # weak_beat_style など、final_bass_params 直下のキーもアルゴリズムオプションとして渡す
+                # (ただし、algo_options内の同名キーを上書きしないように注意)
+                for k in ["weak_beat_style", "approach_on_4th_beat", "approach_style_on_4th"]:
+                    if k in final_bass_params and k not in algo_options : # algo_optionsになければ追加
+                         algo_options[k] = final_bass_params[k]
+            elif "pattern" in pattern_details and isinstance(pattern_details["pattern"], list):
+                compiled_pattern = self._compiled_fixed_patterns.get(final_bass_params.get("rhythm_key"))
+                fixed_pattern = compiled_pattern if compiled_pattern is not None else pattern_details["pattern"]
+
+            block_plans.append({
+                "section_name": current_section_name, "params": final_bass_params, "overrides_model": part_specific_overrides_model,
+                "chord_pcs": chord_pcs, "pattern_type": pattern_details.get("pattern_type"), "algo_options": algo_options, "fixed_pattern": fixed_pattern,
+                "base_velocity": base_vel, "target_octave": target_oct, "bass_register": bass_register, "current_scale": current_scale,
+                "next_chord_root_pc": next_chord_root_pc, "offset": block_abs_offset, "q_length": block_q_length,
+            })
+
+        section_start = 0
+        while section_start < len(block_plans):
+            section_end = section_start + 1
+            while section_end < len(block_plans) and block_plans[section_end]["section_name"] == block_plans[section_start]["section_name"]: section_end += 1
+            section_plans = block_plans[section_start:section_end]; section_start = section_end
+            if section_plans[0]["params"].get("candidate_search", False):
+                bass_events.extend(self._search_section_candidates(section_plans, vocal_index))
+            else:
+                for plan in section_plans: bass_events.extend(self._realize_block_plan(plan, vocal_index))
         
-        if part_overall_humanize_params and part_overall_humanize_params.get("humanize_opt", False):
+        if part_overall_humanize_params and part_overall_humanize_params.get("humanize_opt", False) and bass_events:
             try:
-                bass_part_humanized = apply_humanization_to_part(bass_part, template_name=part_overall_humanize_params.get("template_name"), custom_params=part_overall_humanize_params.get("custom_params"))
-                if isinstance(bass_part_humanized, stream.Part): bass_part_humanized.id = "Bass";
-                bass_part = bass_part_humanized
+                new_offsets, new_durations, new_velocities = humanize_note_arrays(
+                    [ev.offset for ev in bass_events], [ev.duration for ev in bass_events], [ev.velocity for ev in bass_events],
+                    template_name=part_overall_humanize_params.get("template_name"), custom_params=part_overall_humanize_params.get("custom_params"))
+                bass_events = [ev._replace(offset=o, duration=d, velocity=int(v))
+                               for ev, o, d, v in zip(bass_events, new_offsets, new_durations, new_velocities)]
             except Exception as e_hum: self.logger.error(f"BassGen: Error during bass part humanization: {e_hum}", exc_info=True)
         
-        if return_pretty_midi: return None
-        return bass_part
+        bass_events.sort(key=lambda ev: ev.offset)
+        return bass_events
+
+    def _realize_block_plan(self, plan: Dict[str, Any], vocal_index: Optional[VocalIntervalIndex] = None,
+                            variant: Optional[BassCandidateVariant] = None) -> List[BassEvent]:
+        """1ブロック分のベース音を生成し、絶対オフセットに直してブロック終端で切る。variant は候補探索時の差し替え。"""
+        chord_pcs = plan["chord_pcs"]; block_abs_offset = plan["offset"]; block_q_length = plan["q_length"]; bass_register = plan["bass_register"]
+        target_oct = plan["target_octave"] + (variant.octave_shift if variant else 0)
+        generated_notes_for_block: List[BassEvent] = []
+        if plan["algo_options"] is not None:
+            algo_options = plan["algo_options"]
+            if variant:
+                algo_options = dict(algo_options, approach_style_on_4th=variant.approach_style, weak_beat_style=variant.weak_beat_style)
+            generated_notes_for_block = self._generate_algorithmic_pattern(
+                plan["pattern_type"], chord_pcs, algo_options,
+                plan["base_velocity"], target_oct, 0.0, block_q_length, plan["current_scale"],
+                plan["next_chord_root_pc"], section_overrides=plan["overrides_model"], bass_register=bass_register
+            )
+        elif plan["fixed_pattern"] is not None:
+            generated_notes_for_block = self._generate_notes_from_fixed_pattern(
+                plan["fixed_pattern"], chord_pcs, plan["base_velocity"], target_oct, block_q_length, plan["current_scale"], bass_register
+            )
+        
+        if vocal_index and plan["params"].get("avoid_vocal_collisions", True):
+            generated_notes_for_block = self._avoid_vocal_collisions(generated_notes_for_block, block_abs_offset, chord_pcs,
+                                                                     target_oct, bass_register, vocal_index)
+
+        block_events: List[BassEvent] = []
+        end_of_block = block_abs_offset + block_q_length
+        for note_ev in generated_notes_for_block:
+            abs_note_offset = block_abs_offset + note_ev.offset
+            note_dur = note_ev.duration
+            if abs_note_offset + note_dur > end_of_block + 0.001:
+                new_dur = end_of_block - abs_note_offset
+                if new_dur > MIN_NOTE_DURATION_QL / 2: note_dur = new_dur
+                else: continue
+            if note_dur >= MIN_NOTE_DURATION_QL / 2:
+                 block_events.append(note_ev._replace(offset=abs_note_offset, duration=note_dur))
+            else: self.logger.debug(f"BassGen: Final note for {chord_pcs.figure} at {abs_note_offset:.2f} is too short. Skipping.")
+        return block_events
+
+    def _search_section_candidates(self, section_plans: List[Dict[str, Any]], vocal_index: Optional[VocalIntervalIndex] = None) -> List[BassEvent]:
+        """
+        セクション全体について、アプローチ/弱拍スタイルとオクターブを変えた候補ラインを生成し、
+        bass_candidate_costs で一括採点して最もコストの低いものを返す。先頭の候補は設定どおりのライン。
+        """
+        if np is None:
+            self.logger.warning("BassGen: candidate_search requires NumPy. Using the configured bass line.")
+            return [ev for plan in section_plans for ev in self._realize_block_plan(plan, vocal_index)]
+        first_params = section_plans[0]["params"]; first_options = section_plans[0]["algo_options"] or {}
+        configured_variant = BassCandidateVariant(first_options.get("approach_style_on_4th", "chromatic_or_diatonic"), first_options.get("weak_beat_style", "root"), 0)
+        try: candidate_count = max(1, int(first_params.get("candidate_count", BASS_CANDIDATE_DEFAULT_COUNT)))
+        except (TypeError, ValueError): candidate_count = BASS_CANDIDATE_DEFAULT_COUNT
+        all_variants = [BassCandidateVariant(a, w, o) for a in BASS_CANDIDATE_APPROACH_STYLES for w in BASS_CANDIDATE_WEAK_BEAT_STYLES for o in BASS_CANDIDATE_OCTAVE_SHIFTS]
+        all_variants.sort(key=lambda v: (v.approach_style != configured_variant.approach_style) + (v.weak_beat_style != configured_variant.weak_beat_style) + (v.octave_shift != 0))
+        variants = [configured_variant] + [v for v in all_variants if v != configured_variant][:candidate_count - 1]
+
+        chord_masks = [sum(1 << pc for pc in plan["chord_pcs"].pitch_classes) for plan in section_plans]
+        beat_q_len = self.global_time_signature_obj.beatDuration.quarterLength if self.global_time_signature_obj else 1.0
+        vocal_mask_cache: Dict[Tuple[float, float], int] = {}
+        candidates: List[List[BassEvent]] = []; style_changes: List[int] = []; seen_lines = set()
+        note_chord_masks: List[List[int]] = []; note_vocal_masks: List[List[int]] = []; note_strong: List[List[bool]] = []
+        for variant in variants:
+            line: List[BassEvent] = []; line_chord_masks: List[int] = []
+            for plan, chord_mask in zip(section_plans, chord_masks):
+                block_events = self._realize_block_plan(plan, vocal_index, variant)
+                line.extend(block_events); line_chord_masks.extend([chord_mask] * len(block_events))
+            line_key = tuple(line)
+            if line_key in seen_lines: continue
+            seen_lines.add(line_key)
+            line_vocal_masks: List[int] = []
+            for ev in line:
+                window = (ev.offset, min(ev.duration, beat_q_len))
+                if window not in vocal_mask_cache:
+                    vocal_mask_cache[window] = sum(1 << pc for pc in {m % 12 for m in vocal_index.pitches_in_window(window[0], window[0] + window[1])}) if vocal_index else 0
+                line_vocal_masks.append(vocal_mask_cache[window])
+            candidates.append(line); note_chord_masks.append(line_chord_masks); note_vocal_masks.append(line_vocal_masks)
+            note_strong.append([self._is_strong_beat(ev.offset) for ev in line])
+            style_changes.append((variant.approach_style != configured_variant.approach_style) + (variant.weak_beat_style != configured_variant.weak_beat_style) + (variant.octave_shift != 0))
+        if len(candidates) == 1: return candidates[0]
+
+        max_len = max(len(line) for line in candidates)
+        midis = np.zeros((len(candidates), max_len), dtype=np.int64); valid = np.zeros_like(midis, dtype=bool)
+        strong = np.zeros_like(valid); chord_mask_arr = np.zeros_like(midis); vocal_mask_arr = np.zeros_like(midis)
+        for c_idx, line in enumerate(candidates):
+            n = len(line)
+            midis[c_idx, :n] = [ev.midi for ev in line]; valid[c_idx, :n] = True; strong[c_idx, :n] = note_strong[c_idx]
+            chord_mask_arr[c_idx, :n] = note_chord_masks[c_idx]; vocal_mask_arr[c_idx, :n] = note_vocal_masks[c_idx]
+        costs = bass_candidate_costs(midis, valid, strong, chord_mask_arr, vocal_mask_arr, np.asarray(style_changes), section_plans[0]["bass_register"])
+        best_idx = int(np.argmin(costs))
+        self.logger.debug(f"BassGen: Section '{section_plans[0]['section_name']}': {len(candidates)} bass candidates, best #{best_idx} (cost {costs[best_idx]:.3f}, configured {costs[0]:.3f}).")
+        return candidates[best_idx]
 
 # --- END OF FILE generator/bass_generator.py ---
\ No newline at end of file
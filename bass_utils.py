@@ -4,14 +4,22 @@ from __future__ import annotations
 Low-level helpers for *bass line generation*.
 """
 
-from typing import List, Sequence, Optional, Any, Dict, Tuple
+from typing import List, Sequence, Optional, Any, Dict, Tuple, Iterable, NamedTuple
 import random as _rand
 import logging
+from bisect import bisect_left
+from collections import OrderedDict
+from functools import lru_cache
 
 from music21 import note, pitch, harmony, interval, scale as m21_scale
 
 try:
-    from utilities.scale_registry import ScaleRegistry as SR
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from utilities.scale_registry import ScaleRegistry as SR, ScaleDescriptor
 except ImportError:
     logger_fallback_sr_bass = logging.getLogger(__name__ + ".fallback_sr_bass")
     logger_fallback_sr_bass.error("BassUtils: Could not import ScaleRegistry from utilities. Scale-aware functions might fail.")
@@ -22,9 +30,200 @@ except ImportError:
             effective_tonic = tonic_str if tonic_str else "C"
             try: return m21_scale.MajorScale(pitch.Pitch(effective_tonic))
             except Exception: return m21_scale.MajorScale(pitch.Pitch("C"))
+        @staticmethod
+        def get_descriptor(tonic_str: Optional[str], mode_str: Optional[str]) -> "ScaleDescriptor":
+            degree_to_pc = tuple(p.pitchClass for p in SR.get(tonic_str, mode_str).getPitches()[:7])
+            pc_to_degree = tuple(degree_to_pc.index(pc) + 1 if pc in degree_to_pc else 0 for pc in range(12))
+            return ScaleDescriptor(degree_to_pc[0], sum(1 << pc for pc in degree_to_pc), degree_to_pc, pc_to_degree)
+    class ScaleDescriptor(NamedTuple):
+        tonic_pc: int; mask: int; degree_to_pc: Tuple[int, ...]; pc_to_degree: Tuple[int, ...]
+        def contains(self, pc: int) -> bool: return bool((self.mask >> (pc % 12)) & 1)
+        def degree_of(self, pc: int) -> Optional[int]: return self.pc_to_degree[pc % 12] or None
+        def pc_of_degree(self, degree: int) -> int: return self.degree_to_pc[(degree - 1) % len(self.degree_to_pc)]
+
+try:
+    from utilities.core_music_utils import pitch_name_to_midi
+except ImportError:
+    def pitch_name_to_midi(pitch_name: Optional[str]) -> Optional[int]:
+        try: return pitch.Pitch(pitch_name).midi if pitch_name else None
+        except Exception: return None
 
 logger = logging.getLogger(__name__)
 
+
+class VocalIntervalIndex:
+    """
+    ボーカル音の区間インデックス。開始位置でソートしておき、任意の区間で鳴っている音を bisect で引く。
+    最長音長ぶんだけ左に広げて探索するので、1回の問い合わせは O(log n + 区間付近の音数)。
+
+    vocal_notes は VocalGenerator と同じ dict 形式 ({"offset", "pitch" / "pitch_str", "length" / "q_length"})。
+    """
+
+    def __init__(self, vocal_notes: Optional[Iterable[Dict[str, Any]]] = None):
+        parsed: List[Tuple[float, float, int, str]] = []
+        for vn in vocal_notes or []:
+            try:
+                offset = float(vn.get("offset", vn.get("Offset", 0.0)))
+                length = float(vn.get("q_length", vn.get("length", vn.get("Length", 0.0))))
+            except (TypeError, ValueError):
+                continue
+            pitch_str = str(vn.get("pitch_str", vn.get("pitch", vn.get("Pitch", ""))))
+            midi_val = vn.get("midi")
+            if midi_val is None:
+                midi_val = pitch_name_to_midi(pitch_str)
+            if midi_val is None or length <= 0:
+                logger.debug(f"VocalIntervalIndex: Skipping vocal note {vn!r} (no pitch or non-positive length).")
+                continue
+            parsed.append((offset, offset + length, int(midi_val), pitch_str))
+        parsed.sort(key=lambda item: item[0])
+        self._starts: List[float] = [item[0] for item in parsed]
+        self._ends: List[float] = [item[1] for item in parsed]
+        self._midis: List[int] = [item[2] for item in parsed]
+        self._pitch_strs: List[str] = [item[3] for item in parsed]
+        self._max_length: float = max((end - start for start, end, _, _ in parsed), default=0.0)
+
+    def __len__(self) -> int:
+        return len(self._starts)
+
+    def _indices_in_window(self, start: float, end: float) -> List[int]:
+        lo = bisect_left(self._starts, start - self._max_length)
+        hi = bisect_left(self._starts, end)
+        return [i for i in range(lo, hi) if self._ends[i] > start]
+
+    def pitches_in_window(self, start: float, end: float) -> List[int]:
+        """[start, end) の間に鳴っているボーカル音の MIDI ノート番号。"""
+        return [self._midis[i] for i in self._indices_in_window(start, end)]
+
+    def notes_in_block(self, block_offset: float, block_length: float) -> List[Dict[str, Any]]:
+        """generate_bass_measure の vocal_notes_in_block 形式 (ブロック内で始まる音のみ) で返す。"""
+        lo = bisect_left(self._starts, block_offset)
+        hi = bisect_left(self._starts, block_offset + block_length)
+        return [{"block_relative_offset": self._starts[i] - block_offset, "pitch_str": self._pitch_strs[i], "midi": self._midis[i],
+                 "q_length": self._ends[i] - self._starts[i]} for i in range(lo, hi)]
+
+# --- ベース音域の折り返しテーブル ---
+DEFAULT_BASS_REGISTER: Tuple[int, int] = (28, 60) # 4弦ベース E1–C4
+_REGISTER_TABLE_MIN_OCTAVE = -1
+_REGISTER_TABLE_MAX_OCTAVE = 9
+
+
+@lru_cache(maxsize=None)
+def bass_register_table(min_midi: int = DEFAULT_BASS_REGISTER[0], max_midi: int = DEFAULT_BASS_REGISTER[1]) -> Tuple[Tuple[int, ...], ...]:
+    """[ピッチクラス][オクターブ + 1] -> 音域 [min_midi, max_midi] に折り返した MIDI ノート番号。"""
+    table: List[Tuple[int, ...]] = []
+    for pc in range(12):
+        row: List[int] = []
+        for octave in range(_REGISTER_TABLE_MIN_OCTAVE, _REGISTER_TABLE_MAX_OCTAVE + 1):
+            current_midi = (octave + 1) * 12 + pc
+            while current_midi < min_midi: current_midi += 12
+            while current_midi > max_midi:
+                if current_midi - 12 >= min_midi: current_midi -= 12
+                else: break
+            row.append(max(min_midi, min(current_midi, max_midi)))
+        table.append(tuple(row))
+    return tuple(table)
+
+
+def fold_to_bass_register(pc: int, target_octave: int, register: Tuple[int, int] = DEFAULT_BASS_REGISTER) -> int:
+    """
+    ピッチクラスを target_octave に置き、音域 register に収めた MIDI を返す (テーブル参照のみ)。
+    target_octave は YAML / JSON 由来の float (2.0 など) でもよい。
+
+    >>> fold_to_bass_register(0, 2), fold_to_bass_register(0, 2.0), fold_to_bass_register(7, 9)
+    (36, 36, 55)
+    """
+    octave_idx = min(max(int(target_octave), _REGISTER_TABLE_MIN_OCTAVE), _REGISTER_TABLE_MAX_OCTAVE) - _REGISTER_TABLE_MIN_OCTAVE
+    return bass_register_table(register[0], register[1])[pc % 12][octave_idx]
+
+
+# --- アプローチノート用の事前計算テーブル ---
+# スケールは 12bit のピッチクラスマスク (bit n = pc n) で表す。
+_APPROACH_DIRECTION_PENALTY = 100
+# id -> (スケール, マスク) の上限付き LRU。ScaleRegistry のキャッシュ (SCALE_CACHE_MAX_SIZE) と同じ規模にし、
+# 追い出されたスケールへの参照を持ち続けないようにする
+SCALE_MASK_CACHE_MAX_SIZE = 256
+_scale_mask_by_id: "OrderedDict[int, Tuple[m21_scale.ConcreteScale, int]]" = OrderedDict()
+
+
+def _scale_pc_mask(scale_obj: Optional[m21_scale.ConcreteScale]) -> int:
+    """スケールオブジェクトのピッチクラスマスクを返す。ScaleRegistry がオブジェクトを共有するので id で覚えておく。"""
+    if scale_obj is None:
+        return 0
+    cached = _scale_mask_by_id.get(id(scale_obj))
+    if cached is not None and cached[0] is scale_obj:
+        _scale_mask_by_id.move_to_end(id(scale_obj))
+        return cached[1]
+    mask = 0
+    try:
+        for p_obj in scale_obj.getPitches():
+            mask |= 1 << p_obj.pitchClass
+    except Exception as e:
+        logger.warning(f"BassUtils (_scale_pc_mask): Could not read pitches from scale '{scale_obj}': {e}")
+    _scale_mask_by_id[id(scale_obj)] = (scale_obj, mask)  # 参照を保持して id の再利用を防ぐ
+    _scale_mask_by_id.move_to_end(id(scale_obj))
+    while len(_scale_mask_by_id) > SCALE_MASK_CACHE_MAX_SIZE:
+        _scale_mask_by_id.popitem(last=False)
+    return mask
+
+
+@lru_cache(maxsize=None)
+def _approach_table_for_scale(
+    scale_mask: int, approach_style: str, max_step: int, preferred_direction: Optional[str]
+) -> Tuple[Tuple[int, ...], ...]:
+    """1スケール分のテーブル。添字 = 目標音のピッチクラス、値 = 最優先の半音オフセット候補 (同順位のみ)。"""
+    table: List[Tuple[int, ...]] = []
+    for target_pc in range(12):
+        ranked: List[Tuple[int, int, int]] = []  # (優先度, 方向ペナルティ, オフセット)
+        for step in range(1, max_step + 1):
+            for offset in (-step, step):
+                is_diatonic = bool(scale_mask >> ((target_pc + offset) % 12) & 1)
+                # 優先度付け:
+                # 1: スケール内の半音
+                # 2: スケール内の全音
+                # 3: スケール外の半音 (クロマチック)
+                priority = 0
+                if approach_style == "diatonic_only":
+                    if is_diatonic: priority = step
+                elif approach_style == "chromatic_only":
+                    if step == 1: priority = 1
+                elif approach_style == "chromatic_or_diatonic":
+                    if step == 1: priority = 1 if is_diatonic else 3
+                    elif step == 2 and is_diatonic: priority = 2
+                if priority <= 0:
+                    continue
+                direction_score = 0
+                if preferred_direction == "above" and offset < 0: direction_score = _APPROACH_DIRECTION_PENALTY
+                if preferred_direction == "below" and offset > 0: direction_score = _APPROACH_DIRECTION_PENALTY
+                ranked.append((priority, direction_score, offset))
+        if not ranked:
+            table.append(())
+            continue
+        best_rank = min(r[:2] for r in ranked)
+        table.append(tuple(r[2] for r in ranked if r[:2] == best_rank))
+    return tuple(table)
+
+
+def get_approach_offset(
+    target_pc: int,
+    scale_mask: int,
+    approach_style: str = "chromatic_or_diatonic",
+    max_step: int = 2,
+    preferred_direction: Optional[str] = None,
+    from_distance: Optional[int] = None,
+) -> Optional[int]:
+    """
+    目標音へのアプローチを半音オフセットで返します (テーブル参照のみ)。
+
+    from_distance は「開始音 - 目標音」の半音差。同順位の候補が複数あるとき、開始音に近い方を選ぶのに使います。
+    """
+    candidates = _approach_table_for_scale(scale_mask, approach_style, max_step, preferred_direction)[target_pc % 12]
+    if not candidates:
+        return None
+    if from_distance is None or len(candidates) == 1:
+        return candidates[0]
+    return min(candidates, key=lambda off: abs(off - from_distance))
+
+
 def get_approach_note(
     from_pitch: pitch.Pitch,
     to_pitch: pitch.Pitch,
@@ -36,6 +235,8 @@ def get_approach_note(
     """
     指定された2音間を繋ぐのに適したアプローチノート（1音）を提案します。
 
+    候補の選択は get_approach_offset の事前計算テーブルで行い、music21 の移調は結果の1回だけです。
+
     Args:
         from_pitch (pitch.Pitch): アプローチを開始する音。
         to_pitch (pitch.Pitch): 目標とする音。
@@ -50,66 +251,55 @@ def get_approach_note(
     if not from_pitch or not to_pitch:
         return None
 
-    candidates: List[Tuple[int, pitch.Pitch]] = [] # (優先度, ピッチ) - 数値が小さいほど高優先度
-
-    for step in range(1, max_step + 1):
-        # 下からのアプローチ
-        p_below = to_pitch.transpose(-step)
-        is_diatonic_below = scale_obj and scale_obj.getScaleDegreeFromPitch(p_below) is not None
-        
-        # 上からのアプローチ
-        p_above = to_pitch.transpose(step)
-        is_diatonic_above = scale_obj and scale_obj.getScaleDegreeFromPitch(p_above) is not None
-
-        # 優先度付け:
-        # 1: スケール内の半音
-        # 2: スケール内の全音
-        # 3: スケール外の半音 (クロマチック)
-        # 4: スケール外の全音 (クロマチック) - 通常は避けるがスタイルによる
-
-        if approach_style == "diatonic_only":
-            if is_diatonic_below: candidates.append((step, p_below))
-            if is_diatonic_above: candidates.append((step, p_above))
-        elif approach_style == "chromatic_only":
-            if step == 1: # 半音のみ
-                candidates.append((1, p_below))
-                candidates.append((1, p_above))
-        elif approach_style == "chromatic_or_diatonic": # デフォルト
-            priority_below = 0
-            if step == 1: priority_below = 1 if is_diatonic_below else 3
-            elif step == 2 and is_diatonic_below: priority_below = 2
-            
-            priority_above = 0
-            if step == 1: priority_above = 1 if is_diatonic_above else 3
-            elif step == 2 and is_diatonic_above: priority_above = 2
-
-            if priority_below > 0: candidates.append((priority_below, p_below))
-            if priority_above > 0: candidates.append((priority_above, p_above))
-            
-    if not candidates:
+    from_distance = int(round(from_pitch.ps - to_pitch.ps))
+    offset = get_approach_offset(to_pitch.pitchClass, _scale_pc_mask(scale_obj), approach_style,
+                                 max_step, preferred_direction, from_distance)
+    logger.debug(f"BassUtils (get_approach): From={from_pitch.name}, To={to_pitch.name}, Style='{approach_style}', Offset={offset}")
+    if offset is None:
         return None
+    return to_pitch.transpose(offset)
 
-    # 優先方向と現在の音からの距離でソート
-    def sort_key(candidate_tuple):
-        priority, p = candidate_tuple
-        distance_from_current = abs(p.ps - from_pitch.ps)
-        direction_score = 0
-        if preferred_direction == "above" and p.ps < to_pitch.ps: direction_score = 100 # ペナルティ
-        if preferred_direction == "below" and p.ps > to_pitch.ps: direction_score = 100 # ペナルティ
-        return (priority, direction_score, distance_from_current)
 
-    candidates.sort(key=sort_key)
-    
-    logger.debug(f"BassUtils (get_approach): From={from_pitch.name}, To={to_pitch.name}, Style='{approach_style}', Candidates (Prio, Pitch, Dist): {[(c[0], c[1].nameWithOctave, abs(c[1].ps - from_pitch.ps)) for c in candidates]}")
-    
-    return candidates[0][1] if candidates else None
+# --- 候補ラインの一括採点 ---
+BASS_CANDIDATE_COST_WEIGHTS: Dict[str, float] = {
+    "voice_leading": 1.0, # 平均跳躍幅 (オクターブ単位)
+    "range": 1.0,         # 音域中央から外れた量 (オクターブ単位)
+    "chord_clash": 2.0,   # 強拍の非コードトーンの割合
+    "vocal_clash": 2.0,   # ボーカルと同音・短2度・長7度になる音の割合
+    "repetition": 0.5,    # 直前と同じ音の割合
+    "style_change": 0.15, # 設定スタイルから変えた項目数
+}
+
+
+def bass_candidate_costs(midis: "np.ndarray", valid: "np.ndarray", strong: "np.ndarray", chord_masks: "np.ndarray", vocal_masks: "np.ndarray",
+                         style_changes: "np.ndarray", register: Tuple[int, int] = DEFAULT_BASS_REGISTER,
+                         weights: Optional[Dict[str, float]] = None) -> "np.ndarray":
+    """
+    候補ライン (行) × 音 (列) の整数配列をまとめて採点し、候補ごとのコストを返す (小さいほど良い)。
+    valid は各行の有効な音 (先頭から詰める)、chord_masks / vocal_masks は各音の時点のコード / ボーカルのピッチクラスマスク。
+    """
+    w = dict(BASS_CANDIDATE_COST_WEIGHTS, **(weights or {}))
+    pcs = midis % 12
+    note_counts = np.maximum(valid.sum(axis=1), 1)
+    pair_valid = valid[:, 1:] & valid[:, :-1]; pair_counts = np.maximum(pair_valid.sum(axis=1), 1)
+    leaps = np.abs(np.diff(midis, axis=1))
+    voice_leading = (leaps * pair_valid).sum(axis=1) / pair_counts / 12.0
+    repetition = ((leaps == 0) & pair_valid).sum(axis=1) / pair_counts
+    center = (register[0] + register[1]) / 2.0; comfort = (register[1] - register[0]) / 4.0
+    range_cost = (np.maximum(np.abs(midis - center) - comfort, 0.0) * valid).sum(axis=1) / note_counts / 12.0
+    strong_valid = strong & valid
+    chord_clash = ((((chord_masks >> pcs) & 1) == 0) & strong_valid).sum(axis=1) / np.maximum(strong_valid.sum(axis=1), 1)
+    clash_bits = (1 << pcs) | (1 << ((pcs + 1) % 12)) | (1 << ((pcs + 11) % 12))
+    vocal_clash = (((vocal_masks & clash_bits) != 0) & valid).sum(axis=1) / note_counts
+    return (w["voice_leading"] * voice_leading + w["range"] * range_cost + w["chord_clash"] * chord_clash
+            + w["vocal_clash"] * vocal_clash + w["repetition"] * repetition + w["style_change"] * style_changes)
 
 
 # --- 既存の関数 (walking_quarters, root_fifth_half, STYLE_DISPATCH, generate_bass_measure) は変更なし ---
 # (ただし、STYLE_DISPATCH内のlambda関数でのlogger呼び出しは、このファイルスコープのloggerを使うように修正を推奨)
 def walking_quarters(cs_now: harmony.ChordSymbol, cs_next: harmony.ChordSymbol, tonic: str, mode: str, octave: int = 3, vocal_notes_in_block: Optional[List[Dict]] = None) -> List[pitch.Pitch]:
     if vocal_notes_in_block: logger.debug(f"walking_quarters for {cs_now.figure if cs_now else 'N/A'}: Received {len(vocal_notes_in_block)} vocal notes.")
-    scl = SR.get(tonic, mode)
+    scl = SR.get(tonic, mode); scl_desc = SR.get_descriptor(tonic, mode)
     if not cs_now or not cs_now.root(): return [pitch.Pitch(f"C{octave}")] * 4
     root_now_init = cs_now.root(); root_now = root_now_init.transpose((octave - root_now_init.octave) * 12)
     effective_cs_next_root = cs_next.root() if cs_next and cs_next.root() else root_now_init
@@ -121,7 +311,7 @@ def walking_quarters(cs_now: harmony.ChordSymbol, cs_next: harmony.ChordSymbol,
     beat2_candidate_pitch = _rand.choice(options_b2_pitches) if options_b2_pitches else root_now_init
     beat2 = beat2_candidate_pitch.transpose((octave - beat2_candidate_pitch.octave) * 12)
     beat3_candidate_pitch = beat2.transpose(_rand.choice([-2, -1, 1, 2]))
-    if scl.getScaleDegreeFromPitch(beat3_candidate_pitch) is None:
+    if not scl_desc.contains(beat3_candidate_pitch.pitchClass):
         temp_options_b3 = [p for p in options_b2_pitches if p.nameWithOctave != beat2_candidate_pitch.nameWithOctave]
         if not temp_options_b3: temp_options_b3 = [root_now_init]
         beat3_candidate_pitch = _rand.choice(temp_options_b3) if temp_options_b3 else root_now_init
@@ -129,12 +319,12 @@ def walking_quarters(cs_now: harmony.ChordSymbol, cs_next: harmony.ChordSymbol,
     else: beat3 = beat3_candidate_pitch
     # approach_note はシンプルな半音/全音移動なので、ここでは get_approach_note を使うか検討
     beat4 = approach_note(beat3, root_next) # もし get_approach_note を使うなら: get_approach_note(beat3, root_next, scl) or root_next
-    if scl.getScaleDegreeFromPitch(beat4) is None:
-        if scl.getScaleDegreeFromPitch(root_next) is not None: beat4 = root_next
+    if not scl_desc.contains(beat4.pitchClass):
+        if scl_desc.contains(root_next.pitchClass): beat4 = root_next
         else:
             beat4_alt = scl.nextPitch(beat3, direction=m21_scale.Direction.ASCENDING if root_next.ps > beat3.ps else m21_scale.Direction.DESCENDING)
-            if isinstance(beat4_alt, pitch.Pitch) and (scl.getScaleDegreeFromPitch(beat4_alt) is not None): beat4 = beat4_alt
-            elif isinstance(beat4_alt, list) and beat4_alt and isinstance(beat4_alt[0], pitch.Pitch) and (scl.getScaleDegreeFromPitch(beat4_alt[0]) is not None) : beat4 = beat4_alt[0] # nextPitchがリストを返す場合
+            if isinstance(beat4_alt, pitch.Pitch) and scl_desc.contains(beat4_alt.pitchClass): beat4 = beat4_alt
+            elif isinstance(beat4_alt, list) and beat4_alt and isinstance(beat4_alt[0], pitch.Pitch) and scl_desc.contains(beat4_alt[0].pitchClass) : beat4 = beat4_alt[0] # nextPitchがリストを返す場合
             else: beat4 = root_next # 最終フォールバック
     return [beat1, beat2, beat3, beat4]
 
@@ -164,7 +354,7 @@ def generate_bass_measure(style: str, cs_now: harmony.ChordSymbol, cs_next: harm
         if not initial_pitches: initial_pitches = [fill_pitch] * 4
         elif len(initial_pitches) < 4: initial_pitches.extend([fill_pitch] * (4 - len(initial_pitches)))
         else: initial_pitches = initial_pitches[:4]
-    final_adjusted_pitches: List[pitch.Pitch] = []; scl_obj = SR.get(tonic, mode)
+    final_adjusted_pitches: List[pitch.Pitch] = []; scl_desc = SR.get_descriptor(tonic, mode)
     for beat_idx, p_bass_initial in enumerate(initial_pitches):
         adjusted_pitch_current_beat = p_bass_initial
         vocal_notes_on_this_beat = [vn for vn in (vocal_notes_in_block or []) if beat_idx <= vn.get("block_relative_offset", -999.0) < (beat_idx + 1.0)]
@@ -178,10 +368,10 @@ def generate_bass_measure(style: str, cs_now: harmony.ChordSymbol, cs_next: harm
                         current_bass_is_root = (adjusted_pitch_current_beat.pitchClass == root_pc); candidate_pitch: Optional[pitch.Pitch] = None
                         if current_bass_is_root and cs_now.fifth:
                             candidate_pitch = cs_now.fifth.transpose((octave - cs_now.fifth.octave) * 12)
-                            if scl_obj.getScaleDegreeFromPitch(candidate_pitch) is not None: adjusted_pitch_current_beat = candidate_pitch
+                            if scl_desc.contains(candidate_pitch.pitchClass): adjusted_pitch_current_beat = candidate_pitch
                             elif cs_now.third:
                                 candidate_pitch = cs_now.third.transpose((octave - cs_now.third.octave) * 12)
-                                if scl_obj.getScaleDegreeFromPitch(candidate_pitch) is not None: adjusted_pitch_current_beat = candidate_pitch
+                                if scl_desc.contains(candidate_pitch.pitchClass): adjusted_pitch_current_beat = candidate_pitch
                         elif adjusted_pitch_current_beat.pitchClass == fifth_pc: adjusted_pitch_current_beat = cs_now.root().transpose((octave - cs_now.root().octave) * 12)
                         break 
                 except Exception: pass
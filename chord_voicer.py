@@ -1,6 +1,6 @@
 # --- START OF FILE generators/chord_voicer.py (emotion_humanizer連携強化・改修版) ---
 import music21
-from typing import List, Dict, Optional, Tuple, Any, Sequence
+from typing import List, Dict, Optional, Tuple, Any, Sequence, NamedTuple
 
 # music21 のサブモジュールを正しい形式でインポート
 import music21.stream as stream
@@ -20,6 +20,16 @@ from music21 import articulations # 明示的にインポート
 import re
 import random
 import logging
+import threading
+import json
+import os
+from pathlib import Path
+from collections import OrderedDict
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 logger = logging.getLogger(__name__)
 
@@ -51,13 +61,317 @@ VOICING_STYLE_DROP2 = "drop2"
 VOICING_STYLE_DROP3 = "drop3"
 VOICING_STYLE_DROP24 = "drop2and4"
 VOICING_STYLE_FOUR_WAY_CLOSE = "four_way_close"
+VOICING_STYLE_VOICE_LEADING = "voice_leading" # 進行全体で声部の動きが最小になるボイシングを探索する
 DEFAULT_VOICING_STYLE = VOICING_STYLE_CLOSED
+# VoicingService の結果 (Voicing) を保持する LRU の上限
+VOICING_CACHE_MAX_SIZE: int = 2048
+# (figure, bass, style, target_octave, num_voices, midi_range)
+VoicingKey = Tuple[str, Optional[str], str, int, Optional[int], Optional[Tuple[int, int]]]
+# voice_leading モードのビーム幅 (セクションごとに voice_leading_beam_width で変更可) とコストの重み
+VOICE_LEADING_DEFAULT_BEAM_WIDTH: int = 8
+VOICE_LEADING_COST_WEIGHTS: Dict[str, float] = {
+    "movement": 1.0,        # 各声部から相手の最寄りの音までの距離 (半音) の合計
+    "top_leap": 0.5,        # トップノートの跳躍が5半音を超えた分
+    "inversion": 1.0,       # 基本形以外の転回形
+    "spread": 1.0,          # ドロップ2 / オープン
+    "octave_shift": 1.5,    # 基準オクターブからの移動
+    "center": 0.5,          # 基準ボイシングの平均音高からの距離 (半音)
+}
+# ボイシングテーブル: (ルートからの音程構成, ベースの音程 or None, スタイル) -> 基準音からの半音オフセット。
+# 基準音はベース (無ければルート) を target_octave に置いた音。music21 で一度だけ計算してディスクにキャッシュする
+VOICING_TABLE_VERSION: int = 1
+VOICING_TABLE_STYLES: Tuple[str, ...] = (VOICING_STYLE_CLOSED, VOICING_STYLE_OPEN, VOICING_STYLE_DROP2, VOICING_STYLE_FOUR_WAY_CLOSE, VOICING_STYLE_SEMI_CLOSED)
+VOICING_TABLE_CACHE_DIR_ENV = "CHORD_VOICER_CACHE_DIR"
+_VOICING_TABLE_REF_OCTAVE = 4
+VoicingTableKey = Tuple[Tuple[int, ...], Optional[int], str]
+_voicing_table: Optional[Dict[VoicingTableKey, Tuple[int, ...]]] = None
+_voicing_table_lock = threading.RLock()
+
+def _voicing_table_path() -> Path:
+    cache_dir = os.environ.get(VOICING_TABLE_CACHE_DIR_ENV) or str(Path.home() / ".cache" / "chord_voicer")
+    return Path(cache_dir) / f"voicing_table_v{VOICING_TABLE_VERSION}.json"
+
+def _ref_midi(ref_pitch: pitch.Pitch, target_octave: int) -> int:
+    """ref_pitch と同じ綴りで target_octave に置いた音の MIDI 番号 (B# / C- のオクターブ境界も music21 と同じ扱い)。"""
+    ref_octave = ref_pitch.octave if ref_pitch.octave is not None else ref_pitch.implicitOctave
+    return int(round(ref_pitch.ps)) + 12 * (target_octave - ref_octave)
+
+def _load_voicing_table(path: Path) -> Optional[Dict[VoicingTableKey, Tuple[int, ...]]]:
+    try:
+        with path.open("r", encoding="utf-8") as f: data = json.load(f)
+        if data.get("version") != VOICING_TABLE_VERSION or data.get("music21_version") != music21.__version__:
+            logger.info(f"CV: Voicing table cache '{path}' is from another version. Rebuilding.")
+            return None
+        return {(tuple(intervals), bass_interval, style): tuple(offsets) for intervals, bass_interval, style, offsets in data["entries"]}
+    except FileNotFoundError:
+        return None
+    except Exception as e_load:
+        logger.warning(f"CV: Could not load voicing table cache '{path}': {e_load}. Rebuilding.")
+        return None
+
+def _save_voicing_table(path: Path, table: Dict[VoicingTableKey, Tuple[int, ...]]) -> None:
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        with tmp_path.open("w", encoding="utf-8") as f:
+            json.dump({"version": VOICING_TABLE_VERSION, "music21_version": music21.__version__,
+                       "entries": [[list(k[0]), k[1], k[2], list(v)] for k, v in table.items()]}, f)
+        os.replace(tmp_path, path)
+    except Exception as e_save:
+        logger.warning(f"CV: Could not write voicing table cache '{path}': {e_save}")
+
+def _compute_voicing_style(
+        cs_obj: harmony.ChordSymbol,
+        style_name: str,
+        target_octave_for_bottom_note: int = DEFAULT_CHORD_TARGET_OCTAVE_BOTTOM,
+        num_voices_target: Optional[int] = None
+) -> List[pitch.Pitch]:
+    if not cs_obj.pitches:
+        logger.debug(f"CV._apply_style: ChordSymbol '{cs_obj.figure}' has no pitches. Returning empty list.")
+        return []
+    try:
+        temp_chord_for_closed = m21chord.Chord(cs_obj.pitches)
+        original_closed_pitches = sorted(list(temp_chord_for_closed.closedPosition(inPlace=False).pitches), key=lambda p: p.ps)
+    except Exception as e_closed:
+        logger.warning(f"CV._apply_style: Could not get closed position for '{cs_obj.figure}': {e_closed}. Using raw pitches.")
+        original_closed_pitches = sorted(list(cs_obj.pitches),  key=lambda p: p.ps)
+
+    if not original_closed_pitches: return []
+    current_pitches_for_voicing = list(original_closed_pitches)
+    voiced_pitches_list: List[pitch.Pitch] = []
+
+    try:
+        if style_name == VOICING_STYLE_OPEN:
+            temp_chord = m21chord.Chord(current_pitches_for_voicing)
+            voiced_pitches_list = list(temp_chord.openPosition(inPlace=False).pitches)
+        elif style_name == VOICING_STYLE_DROP2:
+            if len(current_pitches_for_voicing) >= 2:
+                temp_pitches = list(current_pitches_for_voicing)
+                if len(temp_pitches) >= 2: # 2声以上で有効
+                    if len(temp_pitches) >= 4: # 4声以上の場合は上から2番目
+                        second_highest = temp_pitches.pop(-2)
+                    elif len(temp_pitches) == 3: # 3声の場合は真ん中
+                        second_highest = temp_pitches.pop(1)
+                    else: # 2声の場合は高い方 (実質ルートが下がる)
+                        second_highest = temp_pitches.pop(1)
+                    second_highest_dropped = second_highest.transpose(-12)
+                    voiced_pitches_list = sorted(temp_pitches + [second_highest_dropped], key=lambda p: p.ps)
+                else: voiced_pitches_list = current_pitches_for_voicing
+            else: voiced_pitches_list = current_pitches_for_voicing
+        elif style_name == VOICING_STYLE_FOUR_WAY_CLOSE:
+            if len(current_pitches_for_voicing) >= 4:
+                temp_chord = m21chord.Chord(current_pitches_for_voicing)
+                try:
+                    temp_chord.fourWayClose(inPlace=True)
+                    voiced_pitches_list = list(temp_chord.pitches)
+                except Exception as e_4way:
+                    logger.warning(f"CV: fourWayClose for '{cs_obj.figure}' failed: {e_4way}. Defaulting to closed.")
+                    voiced_pitches_list = current_pitches_for_voicing
+            else:
+                logger.debug(f"CV: Not enough pitches for fourWayClose on {cs_obj.figure}. Using closed.")
+                voiced_pitches_list = current_pitches_for_voicing
+        elif style_name == VOICING_STYLE_SEMI_CLOSED:
+            if len(current_pitches_for_voicing) >= 1: # 最低1音あればルートは作れる
+                root_note = cs_obj.root()
+                if root_note:
+                    bass_pitch = pitch.Pitch(root_note.name)
+                    bass_pitch.octave = target_octave_for_bottom_note # 指定オクターブにルートを配置
+                    
+                    other_pitches = [p for p in original_closed_pitches if p.name != root_note.name]
+                    # 残りの音でクローズボイシングをベース音より上に作る
+                    upper_voices = []
+                    if other_pitches:
+                        temp_upper_chord = m21chord.Chord(other_pitches)
+                        closed_upper_pitches = sorted(list(temp_upper_chord.closedPosition(inPlace=False).pitches), key=lambda p:p.ps)
+                        # ベース音より高い位置になるように調整
+                        if closed_upper_pitches:
+                            lowest_upper = min(closed_upper_pitches, key=lambda p:p.ps)
+                            shift_needed = 0
+                            while lowest_upper.ps <= bass_pitch.ps:
+                                lowest_upper.transpose(12, inPlace=True)
+                                shift_needed +=12
+                            if shift_needed > 0:
+                                upper_voices = [p.transpose(shift_needed) for p in closed_upper_pitches]
+                            else:
+                                upper_voices = closed_upper_pitches
+                    voiced_pitches_list = sorted([bass_pitch] + upper_voices, key=lambda p: p.ps)
+                else: voiced_pitches_list = current_pitches_for_voicing
+            else: voiced_pitches_list = current_pitches_for_voicing
+        else:
+            if style_name != VOICING_STYLE_CLOSED:
+                logger.debug(f"CV: Unknown voicing style '{style_name}'. Defaulting to closed for '{cs_obj.figure}'.")
+            voiced_pitches_list = current_pitches_for_voicing
+    except Exception as e_style_app:
+        logger.error(f"CV._apply_style: Error applying voicing style '{style_name}' to '{cs_obj.figure}': {e_style_app}. Defaulting to closed.", exc_info=True)
+        voiced_pitches_list = list(original_closed_pitches)
+
+    if not voiced_pitches_list: voiced_pitches_list = list(original_closed_pitches)
+
+    if num_voices_target is not None and voiced_pitches_list:
+        if len(voiced_pitches_list) > num_voices_target:
+            # より音楽的な声部削減（例：ルートと主要テンションを残すなど）も検討可能
+            voiced_pitches_list = sorted(voiced_pitches_list, key=lambda p: p.ps)[:num_voices_target]
+    
+    if voiced_pitches_list:
+        current_bottom_pitch_obj = min(voiced_pitches_list, key=lambda p: p.ps)
+        ref_pitch_for_octave = cs_obj.bass() if cs_obj.bass() is not None else cs_obj.root()
+        if ref_pitch_for_octave is None: ref_pitch_for_octave = pitch.Pitch("C")
+
+        target_bottom_ref_pitch = pitch.Pitch(ref_pitch_for_octave.name)
+        target_bottom_ref_pitch.octave = target_octave_for_bottom_note
+        octave_difference = round((target_bottom_ref_pitch.ps - current_bottom_pitch_obj.ps) / 12.0)
+        semitones_to_shift = int(octave_difference * 12)
+        if semitones_to_shift != 0:
+            voiced_pitches_list = [p.transpose(semitones_to_shift) for p in voiced_pitches_list]
+    
+    return sorted(voiced_pitches_list, key=lambda p: p.ps)
+
+def _voicing_table_offsets(cs_obj: harmony.ChordSymbol, style_name: str) -> Tuple[int, ...]:
+    ref_pitch = cs_obj.bass() if cs_obj.bass() is not None else cs_obj.root()
+    if style_name == VOICING_STYLE_SEMI_CLOSED:
+        # ルートを最低音に置き、残りの音をその上にクローズで積む (ルートはベース音に最も近いオクターブ)
+        root_pc = cs_obj.root().pitchClass
+        root_interval = (root_pc - ref_pitch.pitchClass) % 12
+        root_offset = root_interval if root_interval < 6 else root_interval - 12
+        upper_offsets = sorted({(p.pitchClass - root_pc) % 12 for p in cs_obj.pitches if p.pitchClass != root_pc})
+        return tuple([root_offset] + [root_offset + interval_pc for interval_pc in upper_offsets])
+    if style_name == VOICING_STYLE_OPEN and not hasattr(m21chord.Chord, "openPosition"):
+        # music21 10 には openPosition が無いので、クローズの下から2番目、4番目…の音を1オクターブ上げて開く (voice_leading の候補と同じ形)
+        closed_offsets = _voicing_table_offsets(cs_obj, VOICING_STYLE_CLOSED)
+        if len(closed_offsets) < 3: return closed_offsets
+        return tuple(sorted(offset + 12 if i % 2 == 1 else offset for i, offset in enumerate(closed_offsets)))
+    voiced_pitches = _compute_voicing_style(cs_obj, style_name, _VOICING_TABLE_REF_OCTAVE, None)
+    ref_midi = _ref_midi(ref_pitch, _VOICING_TABLE_REF_OCTAVE)
+    return tuple(p.midi - ref_midi for p in voiced_pitches)
+
+def _build_voicing_table() -> Dict[VoicingTableKey, Tuple[int, ...]]:
+    table: Dict[VoicingTableKey, Tuple[int, ...]] = {}
+    for chord_kind in harmony.CHORD_TYPES:
+        try: cs_obj = harmony.ChordSymbol(root="C", kind=chord_kind)
+        except Exception as e_kind: logger.debug(f"CV: Skipping chord kind '{chord_kind}' in voicing table: {e_kind}"); continue
+        if not cs_obj.pitches: continue
+        intervals = tuple(sorted({p.pitchClass for p in cs_obj.pitches}))
+        for style_name in VOICING_TABLE_STYLES:
+            if (intervals, None, style_name) not in table:
+                table[(intervals, None, style_name)] = _voicing_table_offsets(cs_obj, style_name)
+    logger.info(f"CV: Built voicing table with {len(table)} entries.")
+    return table
+
+def _get_voicing_table() -> Dict[VoicingTableKey, Tuple[int, ...]]:
+    """プロセス内で共有するボイシングテーブル。無ければディスクから読み、それも無ければ全コードタイプ × スタイルで作って保存する。"""
+    global _voicing_table
+    if _voicing_table is not None: return _voicing_table
+    with _voicing_table_lock:
+        if _voicing_table is None:
+            table_path = _voicing_table_path()
+            table = _load_voicing_table(table_path)
+            if table is None:
+                table = _build_voicing_table()
+                _save_voicing_table(table_path, table)
+            _voicing_table = table
+    return _voicing_table
+
+def _voicing_from_table(cs_obj: harmony.ChordSymbol, style_name: str, target_octave: int, num_voices: Optional[int]) -> Tuple[int, ...]:
+    """ボイシングテーブルを引き、基準音の MIDI を足すだけで実音にする (music21 のボイシング処理は通らない)。"""
+    root = cs_obj.root(); bass = cs_obj.bass()
+    if root is None or not cs_obj.pitches: return ()
+    root_pc = root.pitchClass
+    intervals = tuple(sorted({(p.pitchClass - root_pc) % 12 for p in cs_obj.pitches}))
+    bass_interval = (bass.pitchClass - root_pc) % 12 if bass is not None and bass.pitchClass != root_pc else None
+    table_key: VoicingTableKey = (intervals, bass_interval, style_name if style_name in VOICING_TABLE_STYLES else VOICING_STYLE_CLOSED)
+    if style_name not in VOICING_TABLE_STYLES and style_name != VOICING_STYLE_CLOSED:
+        logger.debug(f"CV: Unknown voicing style '{style_name}'. Defaulting to closed for '{cs_obj.figure}'.")
+    table = _get_voicing_table()
+    offsets = table.get(table_key)
+    if offsets is None: # テーブルに無い構成 (分数コードなど) は一度だけ計算して追加
+        offsets = _voicing_table_offsets(cs_obj, table_key[2])
+        with _voicing_table_lock: table[table_key] = offsets
+    ref_midi = _ref_midi(bass if bass is not None else root, target_octave)
+    voiced_midis = tuple(ref_midi + offset for offset in offsets)
+    return voiced_midis[:num_voices] if num_voices is not None else voiced_midis
+
+def _pitches_from_midi(voiced_midis: Sequence[int], cs_obj: harmony.ChordSymbol) -> List[pitch.Pitch]:
+    """MIDI 番号から Pitch を作る。綴りはコードの構成音 (ピッチクラスが一致するもの) に合わせる。"""
+    spelling_by_pc = {p.pitchClass: p.name for p in cs_obj.pitches}
+    bass_pitch = cs_obj.bass()
+    if bass_pitch is not None: spelling_by_pc.setdefault(bass_pitch.pitchClass, bass_pitch.name)
+    pitches_out: List[pitch.Pitch] = []
+    for midi_val in voiced_midis:
+        spelled_name = spelling_by_pc.get(midi_val % 12)
+        if spelled_name is None: pitches_out.append(pitch.Pitch(midi=midi_val)); continue
+        p_obj = pitch.Pitch(spelled_name); p_obj.octave = midi_val // 12 - 1
+        if p_obj.midi != midi_val: p_obj.octave += (midi_val - p_obj.midi) // 12 # B# / C- などオクターブ境界をまたぐ綴り
+        pitches_out.append(p_obj)
+    return pitches_out
+
+class Voicing(NamedTuple):
+    """ボイシング結果 (ピアノ・ギター・コードパート共通)。midis は低い順の MIDI ノート番号。"""
+    midis: Tuple[int, ...]
+    figure: str
+    style: str
+
+def fit_voicing_to_range(voiced_midis: Sequence[int], midi_range: Tuple[int, int]) -> Tuple[int, ...]:
+    """
+    最低音が音域の下限以上になるまで全体をオクターブ単位で上げ、音域外の音と同じピッチクラスの2回目以降を落とす
+    (ギターの弦に乗る形。低い方の音を残す)。
+    """
+    if not voiced_midis: return ()
+    low, high = midi_range
+    lowest = min(voiced_midis)
+    shift = 12 * -((lowest - low) // 12) if lowest < low else 0 # ceil((low - lowest) / 12) オクターブ
+    fitted: List[int] = []; seen_pcs = set()
+    for midi_val in sorted(m + shift for m in voiced_midis):
+        if low <= midi_val <= high and midi_val % 12 not in seen_pcs: seen_pcs.add(midi_val % 12); fitted.append(midi_val)
+    return tuple(fitted)
+
+class VoicingService:
+    """
+    曲ごとに1つ作り、ピアノ・ギター・コードパート (ChordVoicer) に渡して共有するボイシングサービス。
+    結果は Voicing (MIDI の整数タプル) で返し、(コード, スタイル, オクターブ, 声部数, 音域) ごとに一度だけ計算する。
+    計算はボイシングテーブルを引くだけで、音域指定があれば fit_voicing_to_range で収めてから声部数に切る。
+    """
+    def __init__(self, cache_size: int = VOICING_CACHE_MAX_SIZE):
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[VoicingKey, Voicing]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def voice(self, cs_obj: harmony.ChordSymbol, style_name: str = DEFAULT_VOICING_STYLE,
+              target_octave: int = DEFAULT_CHORD_TARGET_OCTAVE_BOTTOM, num_voices: Optional[int] = None,
+              midi_range: Optional[Tuple[int, int]] = None) -> Voicing:
+        """cs_obj のボイシング。同じコード・設定の2回目以降は (どのパートからの呼び出しでも) キャッシュから返す。"""
+        cs_bass = cs_obj.bass()
+        cache_key: VoicingKey = (cs_obj.figure, cs_bass.name if cs_bass is not None else None, style_name, target_octave, num_voices, midi_range)
+        with self._lock:
+            cached = self._cache.get(cache_key)
+            if cached is not None:
+                self._cache.move_to_end(cache_key)
+                self.cache_hits += 1
+                return cached
+            self.cache_misses += 1
+        voiced_midis = _voicing_from_table(cs_obj, style_name, target_octave, None)
+        if midi_range is not None: voiced_midis = fit_voicing_to_range(voiced_midis, midi_range)
+        voicing = Voicing(voiced_midis[:num_voices] if num_voices is not None else voiced_midis, cs_obj.figure, style_name)
+        with self._lock:
+            self._cache[cache_key] = voicing
+            if len(self._cache) > self.cache_size: self._cache.popitem(last=False)
+        return voicing
+
+    @staticmethod
+    def pitches(voiced_midis: Sequence[int], cs_obj: harmony.ChordSymbol) -> List[pitch.Pitch]:
+        """MIDI 番号を cs_obj の綴りの Pitch にする (music21 の音符を作るパート用)。"""
+        return _pitches_from_midi(voiced_midis, cs_obj)
+
+_VOICE_LEADING_RANGE_BELOW = 7   # 基準オクターブのルートからこれだけ下まで
+_VOICE_LEADING_RANGE_SPAN = 36
 
 class ChordVoicer:
     def __init__(self,
                  default_instrument=m21instrument.KeyboardInstrument(),
                  global_tempo: int = 120,
-                 global_time_signature: str = "4/4"):
+                 global_time_signature: str = "4/4",
+                 voicing_service: Optional["VoicingService"] = None):
         self.default_instrument = default_instrument
         self.global_tempo = global_tempo
         try:
@@ -68,113 +382,121 @@ class ChordVoicer:
         except Exception as e_ts_init:
             logger.error(f"ChordVoicer __init__: Error initializing time signature from '{global_time_signature}': {e_ts_init}. Defaulting to 4/4.", exc_info=True)
             self.global_time_signature_obj = meter.TimeSignature("4/4")
+        # ボイシングの結果とキャッシュはサービス側に持つ (modular_composer が曲ごとに1つ作り、ピアノ・ギターと共有する)
+        self.voicing_service = voicing_service if voicing_service is not None else VoicingService()
+        # (クローズボイシング, target_octave) -> voice_leading の候補とペナルティ
+        self._candidate_cache_lock = threading.Lock()
+        self._voice_leading_candidate_cache: "OrderedDict[Tuple[Tuple[int, ...], int], Tuple[Tuple[Tuple[int, ...], ...], Tuple[float, ...]]]" = OrderedDict()
 
-    def _apply_voicing_style(
+    def get_voicing_midi(
             self,
             cs_obj: harmony.ChordSymbol,
             style_name: str,
             target_octave_for_bottom_note: int = DEFAULT_CHORD_TARGET_OCTAVE_BOTTOM,
             num_voices_target: Optional[int] = None
-    ) -> List[pitch.Pitch]:
-        if not cs_obj.pitches:
-            logger.debug(f"CV._apply_style: ChordSymbol '{cs_obj.figure}' has no pitches. Returning empty list.")
-            return []
-        try:
-            temp_chord_for_closed = m21chord.Chord(cs_obj.pitches)
-            original_closed_pitches = sorted(list(temp_chord_for_closed.closedPosition(inPlace=False).pitches), key=lambda p: p.ps)
-        except Exception as e_closed:
-            logger.warning(f"CV._apply_style: Could not get closed position for '{cs_obj.figure}': {e_closed}. Using raw pitches.")
-            original_closed_pitches = sorted(list(cs_obj.pitches),  key=lambda p: p.ps)
+    ) -> Tuple[int, ...]:
+        """ボイシング結果を MIDI ノート番号の (低い順の) タプルで返す (voicing_service のキャッシュを通す)。"""
+        return self.voicing_service.voice(cs_obj, style_name, target_octave_for_bottom_note, num_voices_target).midis
 
-        if not original_closed_pitches: return []
-        current_pitches_for_voicing = list(original_closed_pitches)
-        voiced_pitches_list: List[pitch.Pitch] = []
+    def _voice_leading_candidates(self, cs_obj: harmony.ChordSymbol, target_octave: int,
+                                  num_voices: Optional[int]) -> Tuple[Tuple[Tuple[int, ...], ...], Tuple[float, ...]]:
+        """転回形 × (クローズ / ドロップ2 / オープン) × オクターブ移動の候補と、それぞれの静的ペナルティを整数演算で作る。"""
+        base = self.get_voicing_midi(cs_obj, VOICING_STYLE_CLOSED, target_octave, num_voices)
+        if not base: return (), ()
+        cache_key = (base, target_octave)
+        with self._candidate_cache_lock:
+            cached = self._voice_leading_candidate_cache.get(cache_key)
+            if cached is not None:
+                self._voice_leading_candidate_cache.move_to_end(cache_key)
+                return cached
+        w = VOICE_LEADING_COST_WEIGHTS
+        voice_count = len(base); base_center = sum(base) / voice_count
+        range_low = (target_octave + 1) * 12 - _VOICE_LEADING_RANGE_BELOW; range_high = range_low + _VOICE_LEADING_RANGE_SPAN
+        candidates: List[Tuple[int, ...]] = [base]; penalties: List[float] = [0.0]; seen = {base}
+        for inversion in range(voice_count):
+            inverted = sorted(list(base[inversion:]) + [m + 12 for m in base[:inversion]])
+            shapes = [(inverted, 0.0)]
+            if voice_count >= 3:
+                drop_idx = voice_count - 2 if voice_count >= 4 else 1
+                shapes.append((sorted(inverted[:drop_idx] + inverted[drop_idx + 1:] + [inverted[drop_idx] - 12]), w["spread"]))
+                shapes.append((sorted(m + 12 if i % 2 == 1 else m for i, m in enumerate(inverted)), w["spread"]))
+            for shape, shape_penalty in shapes:
+                for octave_shift in (0, -12, 12):
+                    voicing = tuple(m + octave_shift for m in shape)
+                    if voicing in seen or voicing[0] < range_low or voicing[-1] > range_high: continue
+                    seen.add(voicing); candidates.append(voicing)
+                    penalties.append(shape_penalty + w["inversion"] * (inversion > 0) + w["octave_shift"] * (octave_shift != 0)
+                                     + w["center"] * abs(sum(voicing) / voice_count - base_center))
+        result = (tuple(candidates), tuple(penalties))
+        with self._candidate_cache_lock:
+            self._voice_leading_candidate_cache[cache_key] = result
+            if len(self._voice_leading_candidate_cache) > VOICING_CACHE_MAX_SIZE:
+                self._voice_leading_candidate_cache.popitem(last=False)
+        return result
 
-        try:
-            if style_name == VOICING_STYLE_OPEN:
-                temp_chord = m21chord.Chord(current_pitches_for_voicing)
-                voiced_pitches_list = list(temp_chord.openPosition(inPlace=False).pitches)
-            elif style_name == VOICING_STYLE_DROP2:
-                if len(current_pitches_for_voicing) >= 2:
-                    temp_pitches = list(current_pitches_for_voicing)
-                    if len(temp_pitches) >= 2: # 2声以上で有効
-                        if len(temp_pitches) >= 4: # 4声以上の場合は上から2番目
-                            second_highest = temp_pitches.pop(-2)
-                        elif len(temp_pitches) == 3: # 3声の場合は真ん中
-                            second_highest = temp_pitches.pop(1)
-                        else: # 2声の場合は高い方 (実質ルートが下がる)
-                            second_highest = temp_pitches.pop(1)
-                        second_highest_dropped = second_highest.transpose(-12)
-                        voiced_pitches_list = sorted(temp_pitches + [second_highest_dropped], key=lambda p: p.ps)
-                    else: voiced_pitches_list = current_pitches_for_voicing
-                else: voiced_pitches_list = current_pitches_for_voicing
-            elif style_name == VOICING_STYLE_FOUR_WAY_CLOSE:
-                if len(current_pitches_for_voicing) >= 4:
-                    temp_chord = m21chord.Chord(current_pitches_for_voicing)
-                    try:
-                        temp_chord.fourWayClose(inPlace=True)
-                        voiced_pitches_list = list(temp_chord.pitches)
-                    except Exception as e_4way:
-                        logger.warning(f"CV: fourWayClose for '{cs_obj.figure}' failed: {e_4way}. Defaulting to closed.")
-                        voiced_pitches_list = current_pitches_for_voicing
-                else:
-                    logger.debug(f"CV: Not enough pitches for fourWayClose on {cs_obj.figure}. Using closed.")
-                    voiced_pitches_list = current_pitches_for_voicing
-            elif style_name == VOICING_STYLE_SEMI_CLOSED:
-                if len(current_pitches_for_voicing) >= 1: # 最低1音あればルートは作れる
-                    root_note = cs_obj.root()
-                    if root_note:
-                        bass_pitch = pitch.Pitch(root_note.name)
-                        bass_pitch.octave = target_octave_for_bottom_note # 指定オクターブにルートを配置
-                        
-                        other_pitches = [p for p in original_closed_pitches if p.name != root_note.name]
-                        # 残りの音でクローズボイシングをベース音より上に作る
-                        upper_voices = []
-                        if other_pitches:
-                            temp_upper_chord = m21chord.Chord(other_pitches)
-                            closed_upper_pitches = sorted(list(temp_upper_chord.closedPosition(inPlace=False).pitches), key=lambda p:p.ps)
-                            # ベース音より高い位置になるように調整
-                            if closed_upper_pitches:
-                                lowest_upper = min(closed_upper_pitches, key=lambda p:p.ps)
-                                shift_needed = 0
-                                while lowest_upper.ps <= bass_pitch.ps:
-                                    lowest_upper.transpose(12, inPlace=True)
-                                    shift_needed +=12
-                                if shift_needed > 0:
-                                    upper_voices = [p.transpose(shift_needed) for p in closed_upper_pitches]
-                                else:
-                                    upper_voices = closed_upper_pitches
-                        voiced_pitches_list = sorted([bass_pitch] + upper_voices, key=lambda p: p.ps)
-                    else: voiced_pitches_list = current_pitches_for_voicing
-                else: voiced_pitches_list = current_pitches_for_voicing
-            else:
-                if style_name != VOICING_STYLE_CLOSED:
-                    logger.debug(f"CV: Unknown voicing style '{style_name}'. Defaulting to closed for '{cs_obj.figure}'.")
-                voiced_pitches_list = current_pitches_for_voicing
-        except Exception as e_style_app:
-            logger.error(f"CV._apply_style: Error applying voicing style '{style_name}' to '{cs_obj.figure}': {e_style_app}. Defaulting to closed.", exc_info=True)
-            voiced_pitches_list = list(original_closed_pitches)
-
-        if not voiced_pitches_list: voiced_pitches_list = list(original_closed_pitches)
-
-        if num_voices_target is not None and voiced_pitches_list:
-            if len(voiced_pitches_list) > num_voices_target:
-                # より音楽的な声部削減（例：ルートと主要テンションを残すなど）も検討可能
-                voiced_pitches_list = sorted(voiced_pitches_list, key=lambda p: p.ps)[:num_voices_target]
-        
-        if voiced_pitches_list:
-            current_bottom_pitch_obj = min(voiced_pitches_list, key=lambda p: p.ps)
-            ref_pitch_for_octave = cs_obj.bass() if cs_obj.bass() is not None else cs_obj.root()
-            if ref_pitch_for_octave is None: ref_pitch_for_octave = pitch.Pitch("C")
-
-            target_bottom_ref_pitch = pitch.Pitch(ref_pitch_for_octave.name)
-            target_bottom_ref_pitch.octave = target_octave_for_bottom_note
-            octave_difference = round((target_bottom_ref_pitch.ps - current_bottom_pitch_obj.ps) / 12.0)
-            semitones_to_shift = int(octave_difference * 12)
-            if semitones_to_shift != 0:
-                voiced_pitches_list = [p.transpose(semitones_to_shift) for p in voiced_pitches_list]
-        
-        return sorted(voiced_pitches_list, key=lambda p: p.ps)
+    def voice_lead_progression(
+            self,
+            chord_symbols: Sequence[Optional[harmony.ChordSymbol]],
+            target_octave: int = DEFAULT_CHORD_TARGET_OCTAVE_BOTTOM,
+            num_voices: Optional[int] = None,
+            beam_widths: Optional[Sequence[int]] = None
+    ) -> List[Tuple[int, ...]]:
+        """
+        進行全体について、声部の動き + ペナルティの合計が最小になるボイシング (MIDI タプル) をビームサーチで選ぶ。
+        None のコードは空タプルを返し、前後のコードはそのまま繋ぐ。beam_widths はコードごとのビーム幅 (セクション設定用)。
+        """
+        results: List[Tuple[int, ...]] = [() for _ in chord_symbols]
+        steps: List[Tuple[int, Tuple[Tuple[int, ...], ...], "np.ndarray"]] = []
+        for chord_idx, cs_obj in enumerate(chord_symbols):
+            if cs_obj is None or not cs_obj.pitches: continue
+            candidates, penalties = self._voice_leading_candidates(cs_obj, target_octave, num_voices)
+            if not candidates: continue
+            if np is None: results[chord_idx] = candidates[0]; continue
+            steps.append((chord_idx, candidates, np.asarray(penalties, dtype=np.float64)))
+        if np is None or not steps:
+            if np is None: logger.warning("CV.voice_lead_progression: NumPy not available. Using closed voicings.")
+            return results
+
+        w = VOICE_LEADING_COST_WEIGHTS
+        max_voices = max(len(v) for _, candidates, _ in steps for v in candidates)
+        # 声部数の違う候補は遠い値で埋め、重み 0 の列として扱う (最寄り音の計算で選ばれない)
+        far = 10_000
+        array_memo: Dict[int, Tuple["np.ndarray", "np.ndarray", "np.ndarray"]] = {} # 同じ候補タプル (キャッシュで共有) は一度だけ配列化
+        def as_array(candidates: Tuple[Tuple[int, ...], ...]) -> Tuple["np.ndarray", "np.ndarray", "np.ndarray"]:
+            memo = array_memo.get(id(candidates))
+            if memo is not None: return memo
+            arr = np.full((len(candidates), max_voices), far, dtype=np.int32); weight = np.zeros(arr.shape, dtype=np.float64)
+            for row, voicing in enumerate(candidates): arr[row, :len(voicing)] = voicing; weight[row, :len(voicing)] = 1.0
+            memo = (arr, weight, np.asarray([voicing[-1] for voicing in candidates], dtype=np.int32))
+            array_memo[id(candidates)] = memo
+            return memo
+
+        prev_arr, prev_weight, prev_top = as_array(steps[0][1])
+        kept = np.argsort(steps[0][2], kind="stable")[:self._beam_width_at(beam_widths, steps[0][0])]
+        cumulative = steps[0][2][kept]; prev_arr = prev_arr[kept]; prev_weight = prev_weight[kept]; prev_top = prev_top[kept]
+        kept_history = [kept]; back_history: List["np.ndarray"] = []
+        for chord_idx, candidates, penalties in steps[1:]:
+            cur_arr, cur_weight, cur_top = as_array(candidates)
+            dist = np.abs(prev_arr[:, None, :, None] - cur_arr[None, :, None, :]) # (prev, cur, prev_voice, cur_voice)
+            movement = (dist.min(axis=2) * cur_weight[None, :, :]).sum(axis=2) + (dist.min(axis=3) * prev_weight[:, None, :]).sum(axis=2)
+            top_leap = np.maximum(np.abs(prev_top[:, None] - cur_top[None, :]) - 5, 0)
+            total = cumulative[:, None] + (w["movement"] / 2.0) * movement + w["top_leap"] * top_leap + penalties[None, :]
+            best_prev = total.argmin(axis=0); best_total = total[best_prev, np.arange(len(candidates))]
+            kept = np.argsort(best_total, kind="stable")[:self._beam_width_at(beam_widths, chord_idx)]
+            cumulative = best_total[kept]; prev_arr = cur_arr[kept]; prev_weight = cur_weight[kept]; prev_top = cur_top[kept]
+            kept_history.append(kept); back_history.append(best_prev[kept])
+
+        state = int(np.argmin(cumulative))
+        for step_idx in range(len(steps) - 1, -1, -1):
+            chord_idx, candidates, _ = steps[step_idx]
+            results[chord_idx] = candidates[int(kept_history[step_idx][state])]
+            if step_idx > 0: state = int(back_history[step_idx - 1][state])
+        return results
+
+    @staticmethod
+    def _beam_width_at(beam_widths: Optional[Sequence[int]], chord_idx: int) -> int:
+        if beam_widths is None or chord_idx >= len(beam_widths) or not beam_widths[chord_idx]: return VOICE_LEADING_DEFAULT_BEAM_WIDTH
+        return max(1, int(beam_widths[chord_idx]))
 
     def compose(self, processed_chord_events: List[Dict]) -> stream.Part:
         chord_part = stream.Part(id="ChordsVoiced")
@@ -194,6 +516,7 @@ class ChordVoicer:
             return chord_part
         logger.info(f"CV.compose: Processing {len(processed_chord_events)} chord events.")
 
+        prepared_events: List[Dict[str, Any]] = [] # ボイシング前のイベント (voice_leading は進行全体で決めるため2パスにする)
         for event_idx, event_data in enumerate(processed_chord_events):
             abs_offset = event_data.get("absolute_offset") # modular_composer.pyの出力に合わせる
             humanized_duration = event_data.get("q_length") # modular_composer.pyの出力に合わせる
@@ -212,10 +535,9 @@ class ChordVoicer:
                 voicing_params = event_data.get("part_params", {}).get("piano", {}) # ピアノ設定を流用
 
             voicing_style_name = voicing_params.get("voicing_style", DEFAULT_VOICING_STYLE)
-            # target_octave, num_voices は DEFAULT_CONFIG の piano 設定などを参照するように変更
-            default_piano_cfg = DEFAULT_CONFIG.get("default_part_parameters",{}).get("piano",{})
-            target_oct = voicing_params.get("target_octave", default_piano_cfg.get("default_rh_target_octave", DEFAULT_CHORD_TARGET_OCTAVE_BOTTOM))
-            num_voices = voicing_params.get("num_voices", default_piano_cfg.get("default_rh_num_voices"))
+            # target_octave, num_voices が無ければピアノ設定の右手の値を使う
+            target_oct = voicing_params.get("target_octave", voicing_params.get("default_rh_target_octave", DEFAULT_CHORD_TARGET_OCTAVE_BOTTOM))
+            num_voices = voicing_params.get("num_voices", voicing_params.get("default_rh_num_voices"))
 
 
             if chord_symbol_str is None or chord_symbol_str.lower() == "rest":
@@ -242,12 +564,35 @@ class ChordVoicer:
                 logger.warning(f"  CV Event {event_idx+1}: ChordSymbol '{cs.figure}' has no pitches. Skipping.")
                 continue
 
-            voiced_pitches = self._apply_voicing_style(
-                cs,
-                voicing_style_name,
-                target_octave_for_bottom_note=target_oct,
-                num_voices_target=num_voices
-            )
+            prepared_events.append({
+                "event_idx": event_idx, "cs": cs, "style": voicing_style_name, "target_octave": target_oct, "num_voices": num_voices,
+                "beam_width": voicing_params.get("voice_leading_beam_width"), "velocity": humanized_velocity,
+                "articulation": humanized_articulation_str, "offset": abs_offset, "duration": humanized_duration,
+            })
+
+        # voice_leading のイベントは連続する区間ごとにまとめて最適化する。
+        # 候補の音域と声部数は区間で共通なので、target_octave / num_voices が変わるところでも区間を切る
+        voice_led_midis: Dict[int, Tuple[int, ...]] = {}
+        run_start = 0
+        while run_start < len(prepared_events):
+            if prepared_events[run_start]["style"] != VOICING_STYLE_VOICE_LEADING: run_start += 1; continue
+            run_settings = (prepared_events[run_start]["target_octave"], prepared_events[run_start]["num_voices"])
+            run_end = run_start
+            while (run_end < len(prepared_events) and prepared_events[run_end]["style"] == VOICING_STYLE_VOICE_LEADING
+                   and (prepared_events[run_end]["target_octave"], prepared_events[run_end]["num_voices"]) == run_settings): run_end += 1
+            run = prepared_events[run_start:run_end]
+            voicings = self.voice_lead_progression([ev["cs"] for ev in run], run[0]["target_octave"], run[0]["num_voices"],
+                                                   [ev["beam_width"] for ev in run])
+            for ev, voicing in zip(run, voicings): voice_led_midis[ev["event_idx"]] = voicing
+            run_start = run_end
+
+        for prepared in prepared_events:
+            event_idx = prepared["event_idx"]; cs = prepared["cs"]
+            humanized_velocity = prepared["velocity"]; humanized_articulation_str = prepared["articulation"]
+            abs_offset = prepared["offset"]; humanized_duration = prepared["duration"]
+            if event_idx in voice_led_midis: voiced_midis = voice_led_midis[event_idx]
+            else: voiced_midis = self.voicing_service.voice(cs, prepared["style"], prepared["target_octave"], prepared["num_voices"]).midis
+            voiced_pitches = _pitches_from_midi(voiced_midis, cs)
 
             if not voiced_pitches:
                 logger.warning(f"  CV Event {event_idx+1}: No pitches after voicing for '{cs.figure}'. Skipping.")
@@ -273,4 +618,4 @@ class ChordVoicer:
         logger.info(f"CV.compose: Finished. Part '{chord_part.id}' contains {len(list(chord_part.flatten().notesAndRests))} elements.")
         return chord_part
 
-# --- END OF FILE generators/chord_voicer.py ---
\ No newline at end of file
+# --- END OF FILE generators/chord_voicer.py ---
@@ -1,10 +1,12 @@
 # --- START OF FILE utilities/core_music_utils.py (インデントエラーと自己参照インポート修正版) ---
 import music21
-from music21 import pitch, harmony, key, meter, stream, note, chord
+from music21 import pitch, harmony, key, meter, stream, note, chord, midi
+import music21.midi.translate
 import re
 import logging
+from functools import lru_cache
 # typingモジュールからのインポートはここで行う
-from typing import List, Dict, Optional, Any, Tuple, Union, cast, Sequence
+from typing import List, Dict, Optional, Any, Tuple, Union, cast, Sequence, NamedTuple
 
 logger = logging.getLogger(__name__)
 _ROOT_RE_STRICT = re.compile(r'^([A-G](?:[#b]{1,2}|[ns])?)(?![#b])')
@@ -26,9 +28,9 @@ def calculate_note_times(current_beat: float, duration_beats: float, bpm: float)
     end_time_seconds = start_time_seconds + duration_seconds
     return start_time_seconds, end_time_seconds
 
-def sanitize_chord_label(label: Optional[str]) -> Optional[str]:
+def normalize_chord_label(label: Optional[str]) -> str:
     """
-    入力されたコードラベルを music21 が解釈しやすい形式に近づける。
+    sanitize_chord_label の文字列変換部分のみ (music21 は使わない)。
     - 全角英数を半角に
     - 不要な空白削除
     - ルート音のフラットを'-'に (例: Bb -> B-)
@@ -87,6 +89,17 @@ def sanitize_chord_label(label: Optional[str]) -> Optional[str]:
     
     # 'power' は music21 が解釈できる
     # 'sus' は music21 が解釈できる (sus2, sus4)
+    return s
+
+def sanitize_chord_label(label: Optional[str]) -> Optional[str]:
+    """
+    入力されたコードラベルを music21 が解釈しやすい形式に近づける (変換内容は normalize_chord_label を参照)。
+    music21 でパースできない場合は None を返す。
+    """
+    original_label = label
+    s = normalize_chord_label(label)
+    if s == "Rest":
+        return s
 
     # 最終チェック: music21でパース試行
     try:
@@ -102,4 +115,217 @@ def sanitize_chord_label(label: Optional[str]) -> Optional[str]:
         logger.warning(f"CoreUtils (sanitize): Final form '{s}' (from '{original_label}') FAILED music21 parsing ({type(e_parse).__name__}: {e_parse}). Returning None.")
         return None
 
+# --- music21 を使わないコードパース (ピッチクラスのみ) ---
+class ChordPCs(NamedTuple):
+    """コードのピッチクラス表現。third_pc / fifth_pc は music21 の ChordSymbol.third / .fifth に相当 (無ければ None)。"""
+    figure: str
+    root_pc: int
+    third_pc: Optional[int]
+    fifth_pc: Optional[int]
+    bass_pc: int
+    pitch_classes: Tuple[int, ...]
+
+_NOTE_LETTER_PC: Dict[str, int] = {"C": 0, "D": 2, "E": 4, "F": 5, "G": 7, "A": 9, "B": 11}
+_CHORD_FIGURE_RE = re.compile(r'^([A-G])((?:#|-|b){0,2})(.*?)(?:/([A-G])((?:#|-|b){0,2}))?$')
+# 品質の接頭辞: (third, fifth, seventh) のルートからの半音数。長いものから順に照合する
+_CHORD_QUALITY_PREFIXES: Tuple[Tuple[str, Tuple[Optional[int], Optional[int], Optional[int]]], ...] = (
+    ("m7b5", (3, 6, 10)), ("minmaj", (3, 7, None)), ("mmaj", (3, 7, None)), ("dim7", (3, 6, 9)), ("dim", (3, 6, None)),
+    ("power", (None, 7, None)), ("min", (3, 7, None)), ("maj", (4, 7, None)), ("m", (3, 7, None)), ("+", (4, 8, None)),
+)
+_EXTENSION_INTERVALS: Dict[int, int] = {9: 2, 11: 5, 13: 9}
+_ALTERED_TONE_INTERVALS: Dict[str, int] = {"b5": 6, "#5": 8, "b9": 1, "#9": 3, "#11": 6, "b13": 8}
+_CHORD_SUFFIX_TOKEN_RE = re.compile(r'(sus2|sus4|sus|add[#b]?\d+|omit\d|no\d|[#b]\d+|\d+)')
+
+def _accidental_offset(acc: str) -> int:
+    return sum(1 if ch == '#' else -1 for ch in acc)
+
+@lru_cache(maxsize=1024)
+def parse_chord_pcs(label: Optional[str]) -> Optional[ChordPCs]:
+    """
+    normalize_chord_label 済みのラベル (未正規化でも可) をピッチクラスに分解する。music21 は使わない。
+    Rest や解釈できない品質は None を返すので、呼び出し側で music21 にフォールバックすること。
+    """
+    s = normalize_chord_label(label)
+    if s == "Rest":
+        return None
+    m = _CHORD_FIGURE_RE.match(s)
+    if not m:
+        return None
+    root_pc = (_NOTE_LETTER_PC[m.group(1)] + _accidental_offset(m.group(2))) % 12
+    quality = m.group(3) or ""
+
+    third: Optional[int] = 4; fifth: Optional[int] = 7; seventh: Optional[int] = None
+    is_maj_seventh = False
+    extras: List[int] = []
+    for prefix, (q_third, q_fifth, q_seventh) in _CHORD_QUALITY_PREFIXES:
+        if quality.startswith(prefix):
+            third, fifth, seventh = q_third, q_fifth, q_seventh
+            is_maj_seventh = prefix in ("maj", "mmaj", "minmaj")
+            quality = quality[len(prefix):]
+            break
+
+    pos = 0
+    while pos < len(quality):
+        tok_m = _CHORD_SUFFIX_TOKEN_RE.match(quality, pos)
+        if not tok_m:
+            return None
+        tok = tok_m.group(0); pos = tok_m.end()
+        if tok in ("sus4", "sus"): third = None; extras.append(5)
+        elif tok == "sus2": third = None; extras.append(2)
+        elif tok.startswith("add"):
+            add_m = re.match(r'add([#b]?)(\d+)', tok)
+            degree = int(add_m.group(2))
+            if degree not in _EXTENSION_INTERVALS: return None
+            extras.append((_EXTENSION_INTERVALS[degree] + _accidental_offset(add_m.group(1))) % 12)
+        elif tok.startswith(("omit", "no")):
+            if tok.endswith("3"): third = None
+            elif tok.endswith("5"): fifth = None
+        elif tok[0] in "#b":
+            interval_val = _ALTERED_TONE_INTERVALS.get(tok)
+            if interval_val is None: return None
+            if tok in ("b5", "#5"): fifth = interval_val
+            else: extras.append(interval_val)
+        else:
+            number = int(tok)
+            if number == 5 and seventh is None and not extras and third == 4: third = None # パワーコード
+            elif number == 6: extras.append(9)
+            elif number == 7: seventh = 11 if is_maj_seventh else (seventh if seventh is not None else 10)
+            elif number in _EXTENSION_INTERVALS:
+                if seventh is None: seventh = 11 if is_maj_seventh else 10
+                extras.extend(iv for deg, iv in _EXTENSION_INTERVALS.items() if deg <= number)
+            else:
+                return None
+
+    intervals = [0] + [iv for iv in (third, fifth, seventh) if iv is not None] + extras
+    bass_pc = root_pc
+    if m.group(4):
+        bass_pc = (_NOTE_LETTER_PC[m.group(4)] + _accidental_offset(m.group(5))) % 12
+    pitch_classes = tuple(sorted({(root_pc + iv) % 12 for iv in intervals} | {bass_pc}))
+    return ChordPCs(
+        figure=s, root_pc=root_pc,
+        third_pc=(root_pc + third) % 12 if third is not None else None,
+        fifth_pc=(root_pc + fifth) % 12 if fifth is not None else None,
+        bass_pc=bass_pc, pitch_classes=pitch_classes,
+    )
+
+_PITCH_NAME_RE = re.compile(r'^([A-G])((?:#|-|b){0,2})(-?\d+)$')
+
+@lru_cache(maxsize=512)
+def pitch_name_to_midi(pitch_name: Optional[str]) -> Optional[int]:
+    """'E-4' や 'C#3' のような音名を MIDI ノート番号にする (music21 の表記に準拠、music21 は使わない)。解釈できなければ None。"""
+    if not pitch_name: return None
+    m = _PITCH_NAME_RE.match(str(pitch_name).strip())
+    if not m: return None
+    return (int(m.group(3)) + 1) * 12 + _NOTE_LETTER_PC[m.group(1)] + _accidental_offset(m.group(2))
+
+def chord_pcs_from_chord_symbol(cs: harmony.ChordSymbol) -> Optional[ChordPCs]:
+    """music21 の ChordSymbol から ChordPCs を作る (parse_chord_pcs が解釈できないラベル用のフォールバック)。"""
+    if cs is None or not cs.root():
+        return None
+    root_pc = cs.root().pitchClass
+    return ChordPCs(
+        figure=cs.figure, root_pc=root_pc,
+        third_pc=cs.third.pitchClass if cs.third else None,
+        fifth_pc=cs.fifth.pitchClass if cs.fifth else None,
+        bass_pc=cs.bass().pitchClass if cs.bass() else root_pc,
+        pitch_classes=tuple(sorted({p.pitchClass for p in cs.pitches})),
+    )
+
+# --- パターンの役割コード: ピアノ左手・ベース・ギターのリズムパターンで共有する整数表現 ---
+# イベントの "type" をコードにしておき、ブロックごとに chord_role_table の表を引くだけで音が決まる。
+# ベースなど楽器固有の役割は、このコードの後ろに番号を足して使う。
+PATTERN_ROLE_CODES: Dict[str, int] = {"root": 0, "fifth": 1, "third": 2, "octave_root": 3, "seventh": 4, "shell": 5, "full": 6}
+NUM_PATTERN_ROLES: int = len(PATTERN_ROLE_CODES)
+
+def compile_pattern_roles(pattern: Sequence[Any], role_codes: Optional[Dict[str, int]] = None, default_role: str = "root") -> Tuple[int, ...]:
+    """パターンの各イベントの "type" を役割コードにする (未知の type や dict でないイベントは default_role)。"""
+    codes = role_codes if role_codes is not None else PATTERN_ROLE_CODES
+    default_code = codes[default_role]
+    return tuple(codes.get(str(ev.get("type", default_role)).lower(), default_code) if isinstance(ev, dict) else default_code for ev in pattern)
+
+def seventh_pc_of(chord_pcs: ChordPCs) -> Optional[int]:
+    """ChordPCs の7度のピッチクラス (短7度・長7度、減七の減7度)。無ければ None。"""
+    intervals = {(pc - chord_pcs.root_pc) % 12 for pc in chord_pcs.pitch_classes}
+    for interval_pc in (10, 11):
+        if interval_pc in intervals: return (chord_pcs.root_pc + interval_pc) % 12
+    if 9 in intervals and chord_pcs.fifth_pc is not None and (chord_pcs.fifth_pc - chord_pcs.root_pc) % 12 == 6:
+        return (chord_pcs.root_pc + 9) % 12
+    return None
+
+@lru_cache(maxsize=1024)
+def chord_role_table(voicing: Tuple[int, ...], chord_pcs: Optional[ChordPCs]) -> Tuple[Tuple[int, ...], ...]:
+    """
+    PATTERN_ROLE_CODES 順に、その役割で鳴らす MIDI のタプルを並べた表を作る。
+    root はボイシングの最低音、fifth / third / seventh はその上で最も近い該当音 (無ければ root)、
+    octave_root はルート + 1オクターブ、shell はルート・7度・10度 (7度が無ければ5度)、full はボイシング全体。
+    """
+    if not voicing: return ((),) * NUM_PATTERN_ROLES
+    bass = min(voicing)
+    def _above(pc: Optional[int]) -> Optional[int]:
+        return bass + ((pc - bass) % 12 or 12) if pc is not None else None
+    fifth = _above(chord_pcs.fifth_pc) if chord_pcs else None
+    third = _above(chord_pcs.third_pc) if chord_pcs else None
+    seventh = _above(seventh_pc_of(chord_pcs)) if chord_pcs else None
+    shell_top = seventh if seventh is not None else fifth
+    shell = [bass]
+    if shell_top is not None: shell.append(shell_top)
+    if third is not None: shell.append(third + 12 * ((shell[-1] - third) // 12 + 1) if third <= shell[-1] else third)
+    return ((bass,), (fifth if fifth is not None else bass,), (third if third is not None else bass,), (bass, bass + 12),
+            (seventh if seventh is not None else bass,), tuple(shell), tuple(sorted(voicing)))
+
+# --- コントロールチェンジ (CC): music21 の表記オブジェクトを使わず、MIDI 書き出しで直接トラックに流す ---
+CONTROLLER_EVENTS_EDITORIAL_KEY = "controller_events"
+
+class ControllerEvent(NamedTuple):
+    """Part に付けるコントロールチェンジ。offset は Part 先頭からの QL、controller は CC 番号 (64 = サステインペダル)。"""
+    offset: float
+    controller: int
+    value: int
+
+def set_controller_events(part: stream.Stream, events: Sequence[ControllerEvent]) -> None:
+    """Part の CC イベントを (時刻順に) 設定する。write_score_midi が Part のトラックに書き込む。"""
+    part.editorial[CONTROLLER_EVENTS_EDITORIAL_KEY] = sorted(events, key=lambda ev: ev.offset)
+
+def get_controller_events(part: stream.Stream) -> List[ControllerEvent]:
+    return list(part.editorial.get(CONTROLLER_EVENTS_EDITORIAL_KEY, []))
+
+def _insert_controller_events(track: midi.MidiTrack, events: Sequence[ControllerEvent], ticks_per_quarter: int) -> None:
+    """MidiTrack に CC を時刻順でマージする (同じ tick では既存イベントより前、End of Track より後ろには置かない)。"""
+    channel = next((ev.channel for ev in track.events if not isinstance(ev, midi.DeltaTime) and ev.isNoteOn()), None) or 1
+    timed: List[Tuple[int, midi.MidiEvent]] = []; tick = 0
+    for ev in track.events:
+        if isinstance(ev, midi.DeltaTime): tick += ev.time
+        else: timed.append((tick, ev))
+    end_tick = timed[-1][0] if timed else 0
+    cc_timed: List[Tuple[int, midi.MidiEvent]] = []
+    for cc in events:
+        cc_ev = midi.MidiEvent(track, type=midi.ChannelVoiceMessages.CONTROLLER_CHANGE, channel=channel)
+        cc_ev.parameter1 = int(cc.controller); cc_ev.parameter2 = max(0, min(127, int(cc.value)))
+        cc_timed.append((min(end_tick, max(0, int(round(cc.offset * ticks_per_quarter)))), cc_ev))
+    merged: List[Tuple[int, midi.MidiEvent]] = []; cc_idx = 0
+    for tick, ev in timed:
+        while cc_idx < len(cc_timed) and cc_timed[cc_idx][0] <= tick: merged.append(cc_timed[cc_idx]); cc_idx += 1
+        merged.append((tick, ev))
+    merged.extend(cc_timed[cc_idx:])
+    new_events: List[Any] = []; prev_tick = 0
+    for tick, ev in merged:
+        new_events.append(midi.DeltaTime(track, time=tick - prev_tick, channel=ev.channel)); new_events.append(ev); prev_tick = tick
+    track.events = new_events
+
+def write_score_midi(score: stream.Score, fp: Any) -> None:
+    """Score を MIDI ファイルに書き出す。各 Part の CC イベント (set_controller_events) はそのトラックに直接書き込む。"""
+    mf = midi.translate.streamToMidiFile(score)
+    parts = list(score.parts)
+    part_tracks = mf.tracks[1:] # 先頭はコンダクタートラック
+    if len(part_tracks) != len(parts):
+        if any(get_controller_events(p) for p in parts):
+            logger.warning(f"CoreUtils (write_score_midi): {len(part_tracks)} tracks for {len(parts)} parts. Controller events are not written.")
+    else:
+        for part, track in zip(parts, part_tracks):
+            cc_events = get_controller_events(part)
+            if cc_events: _insert_controller_events(track, cc_events, mf.ticksPerQuarterNote)
+    mf.open(str(fp), 'wb')
+    try: mf.write()
+    finally: mf.close()
+
 # --- END OF FILE utilities/core_music_utils.py ---
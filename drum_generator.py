@@ -1,8 +1,10 @@
 # --- START OF FILE generator/drum_generator.py (Harugoro-OTO KOTOBA Engine - Schema & Inherit & Override修正版) ---
 from __future__ import annotations
 
-import logging, random, math, copy
-from typing import Any, Dict, List, Optional, Sequence, Union, Set # Set を追加
+import logging, random, copy, json
+from types import MappingProxyType
+from collections import OrderedDict
+from typing import Any, Dict, FrozenSet, List, Mapping, NamedTuple, Optional, Sequence, Tuple, Union, Set # Set を追加
 
 from music21 import (
     stream, note, pitch, volume as m21volume, duration as m21dur, tempo,
@@ -13,7 +15,7 @@ from music21 import (
 try:
     from utilities.override_loader import load_overrides, get_part_override # get_part_override は compose 内で使用
     from utilities.core_music_utils import MIN_NOTE_DURATION_QL, get_time_signature_object
-    from utilities.humanizer import apply_humanization_to_element
+    from utilities.humanizer import humanize_note_arrays
 except ImportError:
     logger_fallback_utils_dg = logging.getLogger(__name__ + ".fallback_utils_dg")
     logger_fallback_utils_dg.warning("DrumGen: Could not import from utilities. Using fallbacks for core utils.")
@@ -22,16 +24,21 @@ except ImportError:
         if not ts_str: ts_str = "4/4"
         try: return meter.TimeSignature(ts_str)
         except Exception: return meter.TimeSignature("4/4")
-    def apply_humanization_to_element(element, template_name=None, custom_params=None):
-        return element
+    def humanize_note_arrays(offsets, durations, velocities, template_name=None, custom_params=None):
+        return list(offsets), list(durations), list(velocities)
     # ダミーの get_part_override (インポート失敗時)
     class DummyPartOverride: model_config = {}; model_fields = {} # pydantic.BaseModelのダミー
     def get_part_override(overrides, section, part, cli_override=None) -> DummyPartOverride: return DummyPartOverride()
 
 
+try:
+    import pretty_midi
+except ImportError:
+    pretty_midi = None
+
 logger = logging.getLogger(__name__)
 
-# ... (GM_DRUM_MAP, GHOST_ALIAS, EMOTION_TO_BUCKET, BUCKET_INTENSITY_TO_STYLE, _resolve_style は変更なし) ...
+# ... (GM_DRUM_MAP, GHOST_ALIAS, EMOTION_TO_BUCKET, BUCKET_INTENSITY_TO_STYLE は変更なし。フォールバック込みのスタイル解決は build_style_resolution_table) ...
 GM_DRUM_MAP: Dict[str, int] = {
     "kick": 36, "bd": 36, "acoustic_bass_drum": 35,
     "snare": 38, "sd": 38, "acoustic_snare": 38, "electric_snare": 40,
@@ -80,29 +87,86 @@ BUCKET_INTENSITY_TO_STYLE: Dict[str, Dict[str, str]] = {
     "default_fallback_bucket": {"low": "no_drums", "medium_low": "default_drum_pattern", "medium": "default_drum_pattern", "medium_high": "default_drum_pattern", "high": "default_drum_pattern", "default": "default_drum_pattern"}
 }
 
-def _resolve_style(emotion:str, intensity:str, pattern_lib: Dict[str, Any]) -> str:
-    bucket = EMOTION_TO_BUCKET.get(emotion.lower(), "default_fallback_bucket")
-    style_map_for_bucket = BUCKET_INTENSITY_TO_STYLE.get(bucket)
-    if not style_map_for_bucket:
-        logger.error(f"DrumGen _resolve_style: CRITICAL - Bucket '{bucket}' is not defined. Using 'default_drum_pattern'.")
-        return "default_drum_pattern"
-    resolved_style = style_map_for_bucket.get(intensity.lower())
-    if not resolved_style:
-        resolved_style = style_map_for_bucket.get("default", "default_drum_pattern")
-    if resolved_style not in pattern_lib:
-        logger.warning(f"DrumGen _resolve_style: Resolved style '{resolved_style}' not in pattern_lib. Falling back to 'default_drum_pattern'.")
-        # フォールバック先も存在するか確認 (念のため)
-        if "default_drum_pattern" not in pattern_lib:
-            logger.error(f"DrumGen _resolve_style: CRITICAL - Fallback 'default_drum_pattern' also not in pattern_lib. This should not happen.")
-            # ここでさらに安全なフォールバックを考えるか、エラーを出すか
-            # 例えば、空のパターンを返すなど
-            return "no_drums" # より安全なフォールバック
-        return "default_drum_pattern"
-    return resolved_style
+# ヒューマナイズ時の楽器別タイミング (QL, 負=前ノリ / 正=後ノリ)。MIDIノート番号で引くテーブル
+DRUM_INSTRUMENT_TIMING_OFFSET_QL: Dict[int, float] = {
+    35: -0.005, 36: -0.005,            # kick: 少し前
+    37: 0.004, 38: 0.008, 40: 0.008,   # side stick / snare: 少し後ろ
+    39: 0.006,                         # clap
+}
+
+# 確率付きイベントを含むパターンで、同一バーのキャッシュを何通りまで持つか (RNG サブストリーム数)
+DRUM_BAR_CACHE_VARIATIONS: int = 4
+# バーキャッシュ (LRU) の上限。長い曲でスタイル × フィル × ヒューマナイズ設定の組み合わせが増えても膨らまないようにする
+DRUM_BAR_CACHE_MAX_SIZE: int = 512
+
+# ドラムのレンダーは整数ティックで行う (1拍 = ppq ティック)。QL への変換は出力時のみ
+DEFAULT_DRUM_PPQ: int = 960
+
+class DrumHit(NamedTuple):
+    """ヒューマナイズ前の1打。tick はバー先頭からの相対ティック。"""
+    tick: int
+    midi: int
+    duration_ticks: int
+    velocity: int
+    humanize_template: Optional[str] = None
+    humanize_custom: Optional[Dict[str, Any]] = None
+
+class DrumEvent(NamedTuple):
+    """出力用の1打 (絶対ティック, DrumGenerator.ppq 基準)。music21 / pretty_midi / MIDI ティックのいずれにも変換できる。"""
+    tick: int
+    midi: int
+    duration_ticks: int
+    velocity: int
+
+def _freeze_humanize_spec(drum_block_params: Dict[str, Any]) -> Tuple[Any, ...]:
+    """ブロックのヒューマナイズ設定をキャッシュキー用の hashable に変換する。"""
+    if not drum_block_params.get("humanize_opt", False):
+        return (False,)
+    custom = drum_block_params.get("custom_params", {}) or {}
+    return (True, drum_block_params.get("template_name", "drum_tight"), json.dumps(custom, sort_keys=True, default=str))
+
+CHORDMAP_COMMON_DRUM_STYLES: Tuple[str, ...] = ("no_drums_or_sparse_cymbal", "no_drums_or_gentle_cymbal_swell", "no_drums_or_sparse_chimes", "ballad_soft_kick_snare_8th_hat", "rock_ballad_build_up_8th_hat", "anthem_rock_chorus_16th_hat")
+LUT_REFERENCED_DRUM_STYLES: FrozenSet[str] = frozenset(
+    style_key for bucket_styles in BUCKET_INTENSITY_TO_STYLE.values() for style_key in bucket_styles.values()
+) | frozenset(CHORDMAP_COMMON_DRUM_STYLES)
+DRUM_INTENSITY_KEYS: Tuple[str, ...] = tuple(sorted({intensity for bucket_styles in BUCKET_INTENSITY_TO_STYLE.values() for intensity in bucket_styles}))
+UNKNOWN_EMOTION_KEY = "" # EMOTION_TO_BUCKET にない感情はこのキーで default_fallback_bucket を引く
+
+def build_style_resolution_table(pattern_lib: Dict[str, Any], placeholder_styles: FrozenSet[str] = frozenset()) -> Tuple[Mapping[Tuple[str, str], str], Tuple[str, ...]]:
+    """
+    (emotion, intensity) -> style_key をフォールバック込みで全て解決した読み取り専用テーブルと、
+    解決できなかった / 無音プレースホルダーに落ちた組み合わせの検証レポートを返す。
+    テーブルのキーは (EMOTION_TO_BUCKET のキー or UNKNOWN_EMOTION_KEY, DRUM_INTENSITY_KEYS のいずれか)。
+    """
+    report: List[str] = []
+    bucket_styles_resolved: Dict[Tuple[str, str], str] = {}
+    buckets_in_use = set(EMOTION_TO_BUCKET.values()) | {"default_fallback_bucket"}
+    for bucket in sorted(buckets_in_use):
+        style_map_for_bucket = BUCKET_INTENSITY_TO_STYLE.get(bucket)
+        for intensity in DRUM_INTENSITY_KEYS:
+            if not style_map_for_bucket:
+                report.append(f"bucket '{bucket}' is not defined -> 'default_drum_pattern'")
+                bucket_styles_resolved[(bucket, intensity)] = "default_drum_pattern"
+                continue
+            resolved_style = style_map_for_bucket.get(intensity) or style_map_for_bucket.get("default", "default_drum_pattern")
+            if resolved_style not in pattern_lib:
+                fallback_style = "default_drum_pattern" if "default_drum_pattern" in pattern_lib else "no_drums"
+                report.append(f"{bucket}/{intensity}: style '{resolved_style}' not in pattern_lib -> '{fallback_style}'")
+                resolved_style = fallback_style
+            elif resolved_style in placeholder_styles:
+                report.append(f"{bucket}/{intensity}: style '{resolved_style}' is an auto-added silent placeholder")
+            bucket_styles_resolved[(bucket, intensity)] = resolved_style
+
+    table: Dict[Tuple[str, str], str] = {}
+    for emotion_key in (*EMOTION_TO_BUCKET.keys(), UNKNOWN_EMOTION_KEY):
+        bucket = EMOTION_TO_BUCKET.get(emotion_key, "default_fallback_bucket")
+        for intensity in DRUM_INTENSITY_KEYS:
+            table[(emotion_key, intensity)] = bucket_styles_resolved[(bucket, intensity)]
+    return MappingProxyType(table), tuple(dict.fromkeys(report))
 
 class DrumGenerator:
     def __init__(self, lib: Optional[Dict[str,Dict[str,Any]]] = None,
-                 tempo_bpm:int = 120, time_sig:str="4/4"):
+                 tempo_bpm:int = 120, time_sig:str="4/4", ppq: int = DEFAULT_DRUM_PPQ):
         self.raw_pattern_lib = copy.deepcopy(lib) if lib is not None else {}
         self.pattern_lib_cache: Dict[str, Dict[str, Any]] = {}
         self.rng = random.Random()
@@ -117,22 +181,22 @@ class DrumGenerator:
                 self.raw_pattern_lib[k] = v_def
                 logger.info(f"DrumGen __init__: Added core default '{k}' to raw pattern library.")
 
-        all_referenced_styles_in_luts = set()
-        for bucket_styles in BUCKET_INTENSITY_TO_STYLE.values():
-            for style_key_in_lut in bucket_styles.values():
-                all_referenced_styles_in_luts.add(style_key_in_lut)
-        chordmap_common_styles = ["no_drums_or_sparse_cymbal", "no_drums_or_gentle_cymbal_swell", "no_drums_or_sparse_chimes", "ballad_soft_kick_snare_8th_hat", "rock_ballad_build_up_8th_hat", "anthem_rock_chorus_16th_hat"]
-        all_referenced_styles_in_luts.update(chordmap_common_styles)
-
-        for style_key in all_referenced_styles_in_luts:
+        placeholder_styles = set()
+        for style_key in sorted(LUT_REFERENCED_DRUM_STYLES):
             if style_key not in self.raw_pattern_lib:
                 self.raw_pattern_lib[style_key] = {
                     "description": f"Placeholder for '{style_key}' (auto-added).",
                     "time_signature": "4/4", "swing": 0.5, "length_beats": 4.0,
                     "pattern": [], "fill_ins": {}
                 }
+                placeholder_styles.add(style_key)
                 logger.info(f"DrumGen __init__: Added silent placeholder for undefined style '{style_key}' to raw_pattern_lib.")
 
+        # 感情×強度 -> スタイルの解決は初期化時に一度だけ行い、ブロックごとは O(1) で引く
+        self.style_table, self.style_validation_report = build_style_resolution_table(self.raw_pattern_lib, frozenset(placeholder_styles))
+        if self.style_validation_report:
+            logger.warning("DrumGen __init__: Style resolution report:\n  " + "\n  ".join(self.style_validation_report))
+
         self.global_tempo = tempo_bpm
         self.global_time_signature_str = time_sig
         self.global_ts = get_time_signature_object(time_sig)
@@ -143,6 +207,26 @@ class DrumGenerator:
         if hasattr(self.instrument, "midiChannel"):
             self.instrument.midiChannel = 9
 
+        # バー単位のレンダーキャッシュ: 同一パラメータのバーはヒット列を再利用し、オフセットだけずらして配置する
+        self._bar_cache: "OrderedDict[Tuple[Any, ...], Tuple[DrumHit, ...]]" = OrderedDict()
+        self._bar_seed = self.rng.getrandbits(32)
+        self.bar_cache_hits = 0
+        self.bar_cache_misses = 0
+        self.ppq = int(ppq) if ppq and ppq > 0 else DEFAULT_DRUM_PPQ
+        self.instrument_timing_offsets_ticks: List[int] = [0] * 128
+        for midi_num, timing_offset_ql in DRUM_INSTRUMENT_TIMING_OFFSET_QL.items():
+            self.instrument_timing_offsets_ticks[midi_num] = self._ql_to_ticks(timing_offset_ql)
+        self._min_hit_ticks = max(1, self._ql_to_ticks(MIN_NOTE_DURATION_QL / 8.0))
+        self._min_bar_ticks = max(1, self._ql_to_ticks(MIN_NOTE_DURATION_QL / 4.0))
+
+    def _ql_to_ticks(self, ql: float) -> int:
+        return int(round(float(ql) * self.ppq))
+
+    def _lookup_style(self, emotion: str, intensity: str) -> str:
+        emotion_key = emotion if emotion in EMOTION_TO_BUCKET else UNKNOWN_EMOTION_KEY
+        intensity_key = intensity if (emotion_key, intensity) in self.style_table else "default"
+        return self.style_table[(emotion_key, intensity_key)]
+
     def _get_effective_pattern_def(self, style_key: str, visited: Optional[Set[str]] = None) -> Dict[str, Any]:
         if visited is None: visited = set()
         if style_key in visited:
@@ -194,19 +278,17 @@ class DrumGenerator:
         return pattern_def
 
     # ▼▼▼ compose メソッドのシグネチャを修正 ▼▼▼
-    def compose(self, blocks: List[Dict[str,Any]], overrides: Optional[Any] = None) -> stream.Part:
+    def compose(self, blocks: List[Dict[str,Any]], overrides: Optional[Any] = None,
+                return_pretty_midi: bool = False, return_events: bool = False) -> Union[stream.Part, Any]:
     # ▲▲▲ overrides の型を Optional[Any] に (Overridesモデルを受け取るため) ▲▲▲
-        part = stream.Part(id="Drums")
-        part.insert(0, self.instrument)
-        part.insert(0, tempo.MetronomeMark(number=self.global_tempo))
-        if self.global_ts and hasattr(self.global_ts, 'ratioString'):
-            ts_to_insert = meter.TimeSignature(self.global_ts.ratioString)
-        else:
-            logger.warning("DrumGen compose: self.global_ts is invalid. Defaulting to 4/4.")
-            ts_to_insert = meter.TimeSignature("4/4")
-        part.insert(0, ts_to_insert)
-
-        if not blocks: return part
+        """
+        return_pretty_midi=True なら pretty_midi.Instrument(is_drum=True) を、
+        return_events=True なら DrumEvent のリストを返す。どちらも music21 オブジェクトは生成しない。
+        """
+        if not blocks:
+            if return_events: return []
+            if return_pretty_midi: return self._events_to_pretty_midi([])
+            return self._events_to_part([])
         logger.info(f"DrumGen compose: Starting for {len(blocks)} blocks.")
 
         # ブロックごとのパラメータ解決を先に行う
@@ -253,18 +335,47 @@ class DrumGenerator:
                     logger.debug(f"DrumGen compose: Blk {blk_idx+1} using explicit style '{final_style_key}' from chordmap.")
                 else:
                     # 3. Emotion/Intensity からの解決
-                    final_style_key = _resolve_style(emo, inten, self.raw_pattern_lib)
+                    final_style_key = self._lookup_style(emo, inten)
                     logger.debug(f"DrumGen compose: Blk {blk_idx+1} (E:'{emo}',I:'{inten}') using auto-resolved style '{final_style_key}'")
 
             blk["part_params"]["drums"]["final_style_key_for_render"] = final_style_key # 実際に使用するスタイルキーを格納
             resolved_blocks.append(blk)
 
-        self._render(resolved_blocks, part) # 解決済みブロックリストを渡す
-        logger.info(f"DrumGen compose: Finished. Part has {len(list(part.flatten().notesAndRests))} elements.")
+        drum_events = self._render(resolved_blocks) # 解決済みブロックリストを渡す
+        logger.info(f"DrumGen compose: Finished. Rendered {len(drum_events)} hits.")
+        if return_events: return drum_events
+        if return_pretty_midi: return self._events_to_pretty_midi(drum_events)
+        return self._events_to_part(drum_events)
+
+    def _events_to_part(self, drum_events: Sequence[DrumEvent]) -> stream.Part:
+        part = stream.Part(id="Drums")
+        part.insert(0, self.instrument)
+        part.insert(0, tempo.MetronomeMark(number=self.global_tempo))
+        if self.global_ts and hasattr(self.global_ts, 'ratioString'):
+            ts_to_insert = meter.TimeSignature(self.global_ts.ratioString)
+        else:
+            logger.warning("DrumGen compose: self.global_ts is invalid. Defaulting to 4/4.")
+            ts_to_insert = meter.TimeSignature("4/4")
+        part.insert(0, ts_to_insert)
+        for ev in drum_events:
+            part.insert(ev.tick / self.ppq, self._make_hit_from_midi(ev.midi, ev.velocity, ev.duration_ticks / self.ppq))
         return part
 
-    def _render(self, blocks:Sequence[Dict[str,Any]], part:stream.Part):
+    def _events_to_pretty_midi(self, drum_events: Sequence[DrumEvent]) -> Any:
+        if pretty_midi is None:
+            raise ImportError("DrumGen: pretty_midi is not installed. `pip install pretty_midi`")
+        sec_per_tick = 60.0 / float(self.global_tempo or 120) / self.ppq
+        drum_inst = pretty_midi.Instrument(program=0, is_drum=True, name="Drums")
+        drum_inst.notes = [
+            pretty_midi.Note(velocity=ev.velocity, pitch=ev.midi,
+                             start=ev.tick * sec_per_tick, end=(ev.tick + ev.duration_ticks) * sec_per_tick)
+            for ev in drum_events
+        ]
+        return drum_inst
+
+    def _render(self, blocks:Sequence[Dict[str,Any]]) -> List[DrumEvent]:
         ms_since_fill = 0
+        pending_hits: List[Tuple[int, DrumHit]] = [] # (バーの絶対ティック, ヒット) - ヒューマナイズは最後にまとめて行う
         for blk_idx, blk_data in enumerate(blocks):
             # drums_params には既に override がマージされているはず
             drums_params = blk_data.get("part_params", {}).get("drums", {})
@@ -305,21 +416,23 @@ class DrumGenerator:
                 elif intensity_str in ["low", "medium_low"]: base_vel = max(20, base_vel - 6)
 
 
-            offset_in_score = blk_data.get("offset", 0.0)
-            remaining_ql_in_block = blk_data.get("q_length", pattern_unit_length_ql)
+            block_start_tick = self._ql_to_ticks(blk_data.get("offset", 0.0))
+            pattern_unit_ticks = self._ql_to_ticks(pattern_unit_length_ql)
+            remaining_ticks_in_block = self._ql_to_ticks(blk_data.get("q_length", pattern_unit_length_ql))
 
             if blk_data.get("is_first_in_section", False) and blk_idx > 0 :
                 ms_since_fill = 0
 
-            current_pos_within_block = 0.0
-            while remaining_ql_in_block > MIN_NOTE_DURATION_QL / 8.0:
-                current_pattern_iteration_ql = min(pattern_unit_length_ql, remaining_ql_in_block)
-                if current_pattern_iteration_ql < MIN_NOTE_DURATION_QL / 4.0 : break
+            current_tick_within_block = 0
+            while remaining_ticks_in_block >= self._min_hit_ticks:
+                current_pattern_iteration_ticks = min(pattern_unit_ticks, remaining_ticks_in_block)
+                if current_pattern_iteration_ticks < self._min_bar_ticks: break
 
-                is_last_pattern_iteration_in_block = (remaining_ql_in_block <= pattern_unit_length_ql + (MIN_NOTE_DURATION_QL / 8.0))
+                is_last_pattern_iteration_in_block = remaining_ticks_in_block <= pattern_unit_ticks
 
                 pattern_to_use = pat_events
                 fill_applied_this_iter = False
+                fill_key_used: Optional[str] = None
 
                 # fill_override は drums_params から取得 (override 適用済みのはず)
                 override_fill_key = drums_params.get("fill_override", drums_params.get("drum_fill_key_override"))
@@ -328,6 +441,7 @@ class DrumGenerator:
                     if chosen_fill_pattern is not None:
                         pattern_to_use = chosen_fill_pattern
                         fill_applied_this_iter = True
+                        fill_key_used = override_fill_key
                         logger.debug(f"DrumGen _render: Applied override fill '{override_fill_key}' for style '{style_key}'")
                     else: logger.warning(f"DrumGen _render: Override fill key '{override_fill_key}' not in fills for '{style_key}'.")
 
@@ -344,41 +458,68 @@ class DrumGenerator:
                             if chosen_fill_pattern is not None:
                                 pattern_to_use = chosen_fill_pattern
                                 fill_applied_this_iter = True
+                                fill_key_used = chosen_fill_key
                                 logger.debug(f"DrumGen _render: Applied scheduled fill '{chosen_fill_key}' for style '{style_key}'")
 
-                self._apply_pattern(part, pattern_to_use, offset_in_score + current_pos_within_block,
-                                    current_pattern_iteration_ql, base_vel,
-                                    swing_type, swing_ratio_val, pat_ts if pat_ts else self.global_ts,
-                                    drums_params) # ★★★ drums_params を渡してヒューマナイズ設定を取得できるようにする ★★★
+                bar_hits = self._get_bar_hits(style_key, fill_key_used, pattern_to_use,
+                                              current_pattern_iteration_ticks, base_vel,
+                                              swing_type, swing_ratio_val, pat_ts if pat_ts else self.global_ts,
+                                              drums_params)
+                bar_start_tick = block_start_tick + current_tick_within_block
+                pending_hits.extend((bar_start_tick, hit) for hit in bar_hits)
 
                 if fill_applied_this_iter: ms_since_fill = 0
                 else: ms_since_fill += 1
 
-                current_pos_within_block += current_pattern_iteration_ql
-                remaining_ql_in_block -= current_pattern_iteration_ql
-
-    # ▼▼▼ _apply_pattern のシグネチャを修正 ▼▼▼
-    def _apply_pattern(self, part:stream.Part, events:List[Dict[str,Any]],
-                       bar_start_abs:float, current_bar_len_ql:float, base_vel:int,
-                       swing_type:str, swing_ratio:float, pattern_ts:meter.TimeSignature,
-                       drum_block_params: Dict[str, Any]): # ★★★ drum_block_params を追加 ★★★
-    # ▲▲▲ _apply_pattern のシグネチャを修正 ▲▲▲
-        beat_len_ql = pattern_ts.beatDuration.quarterLength if pattern_ts else 1.0
+                current_tick_within_block += current_pattern_iteration_ticks
+                remaining_ticks_in_block -= current_pattern_iteration_ticks
+
+        logger.debug(f"DrumGen _render: Bar cache hits={self.bar_cache_hits}, misses={self.bar_cache_misses}, entries={len(self._bar_cache)}.")
+        return self._finalize_hits(pending_hits)
+
+    def _get_bar_hits(self, style_key: str, fill_key: Optional[str], events: List[Dict[str, Any]],
+                      current_bar_ticks: int, base_vel: int,
+                      swing_type: str, swing_ratio: float, pattern_ts: meter.TimeSignature,
+                      drum_block_params: Dict[str, Any]) -> Tuple[DrumHit, ...]:
+        """同じパラメータのバーはキャッシュ済みのヒット列を返す。確率付きイベントがある場合はサブストリームを選んでキーに含める。"""
+        has_probabilistic_events = any(ev_def.get("probability", 1.0) < 1.0 for ev_def in events)
+        substream = self.rng.randrange(DRUM_BAR_CACHE_VARIATIONS) if has_probabilistic_events else 0
+        cache_key = (style_key, fill_key, current_bar_ticks, base_vel,
+                     swing_type, round(swing_ratio, 6), _freeze_humanize_spec(drum_block_params), substream)
+        cached_hits = self._bar_cache.get(cache_key)
+        if cached_hits is not None:
+            self._bar_cache.move_to_end(cache_key)
+            self.bar_cache_hits += 1
+            return cached_hits
+        self.bar_cache_misses += 1
+        substream_rng = random.Random(f"{self._bar_seed}:{style_key}:{fill_key}:{substream}")
+        compiled_hits = tuple(self._compile_bar_hits(events, current_bar_ticks, base_vel, swing_type, swing_ratio,
+                                                     pattern_ts, drum_block_params, substream_rng))
+        self._bar_cache[cache_key] = compiled_hits
+        if len(self._bar_cache) > DRUM_BAR_CACHE_MAX_SIZE:
+            self._bar_cache.popitem(last=False)
+        return compiled_hits
+
+    def _compile_bar_hits(self, events:List[Dict[str,Any]], current_bar_ticks:int, base_vel:int,
+                          swing_type:str, swing_ratio:float, pattern_ts:meter.TimeSignature,
+                          drum_block_params: Dict[str, Any], rng: random.Random) -> List[DrumHit]:
+        beat_ticks = self._ql_to_ticks(pattern_ts.beatDuration.quarterLength if pattern_ts else 1.0)
+        hits: List[DrumHit] = []
 
         for ev_def in events:
-            if self.rng.random() > ev_def.get("probability", 1.0): continue
+            if rng.random() > ev_def.get("probability", 1.0): continue
             inst_name = ev_def.get("instrument")
             if not inst_name: continue
-            rel_offset_in_pattern = float(ev_def.get("offset", 0.0))
+            rel_tick_in_pattern = self._ql_to_ticks(ev_def.get("offset", 0.0))
 
             if swing_ratio != 0.5:
-                rel_offset_in_pattern = self._swing(rel_offset_in_pattern, swing_ratio, beat_len_ql, swing_type)
+                rel_tick_in_pattern = self._swing_ticks(rel_tick_in_pattern, swing_ratio, beat_ticks, swing_type)
 
-            if rel_offset_in_pattern >= current_bar_len_ql - (MIN_NOTE_DURATION_QL / 16.0): continue
+            if rel_tick_in_pattern >= current_bar_ticks: continue
 
-            hit_duration_ql = float(ev_def.get("duration", 0.125))
-            clipped_duration_ql = min(hit_duration_ql, current_bar_len_ql - rel_offset_in_pattern)
-            if clipped_duration_ql < MIN_NOTE_DURATION_QL / 8.0: continue
+            hit_duration_ticks = self._ql_to_ticks(ev_def.get("duration", 0.125))
+            clipped_duration_ticks = min(hit_duration_ticks, current_bar_ticks - rel_tick_in_pattern)
+            if clipped_duration_ticks < self._min_hit_ticks: continue
 
             vel_val = ev_def.get("velocity")
             vel_factor = ev_def.get("velocity_factor", 1.0)
@@ -387,8 +528,8 @@ class DrumGenerator:
             else: final_vel = int(base_vel * float(vel_factor))
             final_vel = max(1, min(127, final_vel))
 
-            drum_hit = self._make_hit(inst_name, final_vel, clipped_duration_ql)
-            if not drum_hit: continue
+            midi = self._drum_midi_for(inst_name)
+            if midi is None: continue
 
             # ▼▼▼ ヒューマナイズ処理を drum_block_params から取得 ▼▼▼
             humanize_this_hit = False
@@ -413,53 +554,73 @@ class DrumGenerator:
                     humanize_custom_for_hit = drum_block_params.get("custom_params", {})
             # ▲▲▲ ヒューマナイズ処理を drum_block_params から取得 ▲▲▲
 
-            time_delta_from_humanizer = 0.0
-            if humanize_this_hit:
-                original_hit_offset_before_humanize = drum_hit.offset # Should be 0.0
-                drum_hit = apply_humanization_to_element(drum_hit, template_name=humanize_template_for_hit, custom_params=humanize_custom_for_hit)
-                time_delta_from_humanizer = drum_hit.offset - original_hit_offset_before_humanize
-
-            final_insert_offset = bar_start_abs + rel_offset_in_pattern + time_delta_from_humanizer
-            drum_hit.offset = 0.0 # music21のinsertは要素のoffsetを無視するので、ここで0にしておくのが無難
-            part.insert(final_insert_offset, drum_hit)
-
-
-    def _swing(self, rel_offset:float, swing_ratio:float, beat_len_ql:float, swing_type:str = "eighth")->float:
-        if abs(swing_ratio - 0.5) < 1e-3 or beat_len_ql <= 0:
-            return rel_offset
-
-        subdivision_duration_ql: float
+            hits.append(DrumHit(rel_tick_in_pattern, midi, clipped_duration_ticks, final_vel,
+                                humanize_template_for_hit if humanize_this_hit else None,
+                                humanize_custom_for_hit if humanize_this_hit else None))
+        return hits
+
+    def _finalize_hits(self, pending_hits: Sequence[Tuple[int, DrumHit]]) -> List[DrumEvent]:
+        """キャッシュ済みヒットをバー位置にずらしてイベント化する。ヒューマナイズはテンプレートごとにまとめて1回で適用する。"""
+        humanize_groups: Dict[Tuple[str, str], List[int]] = {}
+        final_ticks = [bar_start_tick + hit.tick for bar_start_tick, hit in pending_hits]
+        final_duration_ticks = [hit.duration_ticks for _, hit in pending_hits]
+        final_velocities = [hit.velocity for _, hit in pending_hits]
+        for hit_idx, (_, hit) in enumerate(pending_hits):
+            if hit.humanize_template is None: continue
+            group_key = (hit.humanize_template, json.dumps(hit.humanize_custom or {}, sort_keys=True, default=str))
+            humanize_groups.setdefault(group_key, []).append(hit_idx)
+
+        # ヒューマナイズのテンプレートは QL 単位なので、このグループだけ QL に戻して処理しティックへ丸める
+        for (template_name, _), hit_indices in humanize_groups.items():
+            custom_params = pending_hits[hit_indices[0]][1].humanize_custom
+            new_offsets, new_durations, new_velocities = humanize_note_arrays(
+                [final_ticks[i] / self.ppq for i in hit_indices], [final_duration_ticks[i] / self.ppq for i in hit_indices],
+                [final_velocities[i] for i in hit_indices], template_name=template_name, custom_params=custom_params)
+            for i, new_offset, new_duration, new_velocity in zip(hit_indices, new_offsets, new_durations, new_velocities):
+                timing_offset_ticks = self.instrument_timing_offsets_ticks[pending_hits[i][1].midi]
+                final_ticks[i] = max(0, self._ql_to_ticks(new_offset) + timing_offset_ticks)
+                final_duration_ticks[i] = max(self._min_hit_ticks, self._ql_to_ticks(new_duration))
+                final_velocities[i] = new_velocity
+        logger.debug(f"DrumGen _finalize_hits: {len(pending_hits)} hits, {len(humanize_groups)} humanize groups.")
+
+        drum_events = [DrumEvent(final_ticks[i], hit.midi, final_duration_ticks[i], int(final_velocities[i]))
+                       for i, (_, hit) in enumerate(pending_hits)]
+        drum_events.sort(key=lambda ev: ev.tick)
+        return drum_events
+
+
+    def _swing_ticks(self, rel_tick:int, swing_ratio:float, beat_ticks:int, swing_type:str = "eighth")->int:
+        if abs(swing_ratio - 0.5) < 1e-3 or beat_ticks <= 0:
+            return rel_tick
+
+        subdivision_ticks: int
         if swing_type == "eighth":
-            subdivision_duration_ql = beat_len_ql / 2.0
+            subdivision_ticks = beat_ticks // 2
         elif swing_type == "sixteenth":
-            subdivision_duration_ql = beat_len_ql / 4.0
+            subdivision_ticks = beat_ticks // 4
         else:
-            logger.warning(f"DrumGen _swing: Unsupported swing_type '{swing_type}'. No swing applied.")
-            return rel_offset
-        if subdivision_duration_ql <= 0: return rel_offset # ゼロ除算防止
+            logger.warning(f"DrumGen _swing_ticks: Unsupported swing_type '{swing_type}'. No swing applied.")
+            return rel_tick
+        if subdivision_ticks <= 0: return rel_tick # ゼロ除算防止
 
-        effective_beat_for_swing_pair_ql = subdivision_duration_ql * 2.0
-
-        beat_num_in_bar = math.floor(rel_offset / effective_beat_for_swing_pair_ql)
-        offset_within_effective_beat = rel_offset - (beat_num_in_bar * effective_beat_for_swing_pair_ql)
-
-        epsilon = subdivision_duration_ql * 0.1 # 許容誤差
+        swing_pair_ticks = subdivision_ticks * 2
+        pair_index, tick_within_pair = divmod(rel_tick, swing_pair_ticks)
 
         # 2番目のサブディビジョン（遅延される方）かどうかを判定
-        # 例: 8分音符スウィングで、4分音符の真ん中（0.5拍目）に近いか
-        if abs(offset_within_effective_beat - subdivision_duration_ql) < epsilon:
-            new_offset_within_effective_beat = effective_beat_for_swing_pair_ql * swing_ratio
-            swung_rel_offset = (beat_num_in_bar * effective_beat_for_swing_pair_ql) + new_offset_within_effective_beat
-            return swung_rel_offset
-        return rel_offset
-
-    def _make_hit(self, name:str, vel:int, ql:float)->Optional[note.Note]:
+        # 例: 8分音符スウィングで、4分音符の真ん中（0.5拍目）に近いか。許容幅はサブディビジョンの1割
+        if abs(tick_within_pair - subdivision_ticks) * 10 < subdivision_ticks:
+            return pair_index * swing_pair_ticks + int(round(swing_pair_ticks * swing_ratio))
+        return rel_tick
+
+    def _drum_midi_for(self, name:str) -> Optional[int]:
         mapped_name = name.lower().replace(" ","_").replace("-","_")
         actual_name_for_midi = GHOST_ALIAS.get(mapped_name, mapped_name)
         midi = GM_DRUM_MAP.get(actual_name_for_midi)
         if midi is None:
-            logger.warning(f"DrumGen _make_hit: Unknown drum sound '{name}' (mapped to '{actual_name_for_midi}'). MIDI mapping not found.")
-            return None
+            logger.warning(f"DrumGen _drum_midi_for: Unknown drum sound '{name}' (mapped to '{actual_name_for_midi}'). MIDI mapping not found.")
+        return midi
+
+    def _make_hit_from_midi(self, midi:int, vel:int, ql:float) -> note.Note:
         n = note.Note()
         n.pitch = pitch.Pitch(midi=midi)
         n.duration = m21dur.Duration(quarterLength=max(MIN_NOTE_DURATION_QL / 8.0, ql))
@@ -1,6 +1,6 @@
 # --- START OF FILE generator/guitar_generator.py (感情スタイル選択機能・Override対応・copyインポート・rhythm_lib修正版) ---
 import music21
-from typing import List, Dict, Optional, Tuple, Any, Sequence, Union, cast
+from typing import List, Dict, Optional, Tuple, Any, Sequence, Union, cast, NamedTuple
 import copy
 
 # music21 のサブモジュールを正しい形式でインポート
@@ -22,12 +22,13 @@ import music21.volume as m21volume
 
 import random
 import logging
-import math
 
 try:
     from utilities.override_loader import get_part_override, Overrides # Overridesもインポート
-    from utilities.core_music_utils import MIN_NOTE_DURATION_QL, get_time_signature_object, sanitize_chord_label
+    from utilities.core_music_utils import (MIN_NOTE_DURATION_QL, get_time_signature_object, sanitize_chord_label,
+                                            PATTERN_ROLE_CODES, compile_pattern_roles, chord_role_table, parse_chord_pcs)
     from utilities.humanizer import apply_humanization_to_part, HUMANIZATION_TEMPLATES
+    from .chord_voicer import VoicingService, Voicing, VOICING_STYLE_CLOSED
 except ImportError:
     logger_fallback = logging.getLogger(__name__ + ".fallback_utils")
     logger_fallback.warning("GuitarGen: Could not import from utilities. Using fallbacks.")
@@ -41,6 +42,19 @@ except ImportError:
         return label.strip()
     def apply_humanization_to_part(part, template_name=None, custom_params=None): return part
     HUMANIZATION_TEMPLATES = {}
+    PATTERN_ROLE_CODES = {"root": 0, "fifth": 1, "third": 2, "octave_root": 3, "seventh": 4, "shell": 5, "full": 6}
+    def compile_pattern_roles(pattern, role_codes=None, default_role="root"): return tuple(PATTERN_ROLE_CODES["full"] for _ in pattern) # 全てフルボイシング
+    def chord_role_table(voicing, chord_pcs): return (tuple(sorted(voicing)),) * len(PATTERN_ROLE_CODES)
+    def parse_chord_pcs(label): return None
+    VOICING_STYLE_CLOSED = "closed"
+    class Voicing(NamedTuple): midis: Tuple[int, ...]; figure: str; style: str
+    class VoicingService: # ダミー: ルートを target_octave に置いたクローズ
+        def voice(self, cs_obj, style_name="closed", target_octave=3, num_voices=None, midi_range=None):
+            root_pc = cs_obj.root().pitchClass; root_midi = (target_octave + 1) * 12 + root_pc
+            midis = tuple(sorted({root_midi + (p.pitchClass - root_pc) % 12 for p in cs_obj.pitches}))
+            return Voicing(midis[:num_voices] if num_voices is not None else midis, cs_obj.figure, style_name)
+        @staticmethod
+        def pitches(voiced_midis, cs_obj): return [pitch.Pitch(midi=m) for m in voiced_midis]
     class DummyPartOverride: model_config = {}; model_fields = {}
     def get_part_override(overrides, section, part) -> DummyPartOverride: return DummyPartOverride()
     class Overrides: root = {} # ダミー
@@ -49,10 +63,13 @@ except ImportError:
 logger = logging.getLogger(__name__)
 
 DEFAULT_GUITAR_OCTAVE_RANGE: Tuple[int, int] = (2, 5)
+GUITAR_MIDI_RANGE: Tuple[int, int] = (40, 83) # E2 - B5
 GUITAR_STRUM_DELAY_QL: float = 0.02
 MIN_STRUM_NOTE_DURATION_QL: float = 0.05
 STYLE_BLOCK_CHORD = "block_chord"; STYLE_STRUM_BASIC = "strum_basic"; STYLE_ARPEGGIO = "arpeggio"
 STYLE_POWER_CHORDS = "power_chords"; STYLE_MUTED_RHYTHM = "muted_rhythm"; STYLE_SINGLE_NOTE_LINE = "single_note_line"
+# ギターのパターンイベントは "type" が無ければ (従来どおり) ボイシング全体を鳴らす
+_ROLE_FULL = PATTERN_ROLE_CODES["full"]
 
 EMOTION_INTENSITY_MAP: Dict[Tuple[str, str], str] = {
     ("quiet_pain_and_nascent_strength", "low"): "guitar_ballad_arpeggio",
@@ -135,7 +152,8 @@ class GuitarGenerator:
                  rhythm_library: Optional[Dict[str, Dict]] = None, # これは rhythm_library.json 全体
                  default_instrument=m21instrument.AcousticGuitar(),
                  global_tempo: int = 120,
-                 global_time_signature: str = "4/4"):
+                 global_time_signature: str = "4/4",
+                 voicing_service: Optional[VoicingService] = None):
         full_rhythm_library = rhythm_library if rhythm_library is not None else {}
         self.rhythm_library = full_rhythm_library.get("guitar_patterns", {}) # ★★★ ギター専用パターンを保持 ★★★
 
@@ -154,41 +172,22 @@ class GuitarGenerator:
         self.global_time_signature_str = global_time_signature
         self.global_time_signature_obj = get_time_signature_object(global_time_signature)
         self.style_selector = GuitarStyleSelector()
+        self.voicing_service = voicing_service if voicing_service is not None else VoicingService()
+        # パターンの "type" は読み込み時に役割コード (PATTERN_ROLE_CODES) にしておく
+        self._pattern_roles: Dict[str, Tuple[int, ...]] = {
+            key: compile_pattern_roles(details.get("pattern", []), default_role="full")
+            for key, details in self.rhythm_library.items() if isinstance(details, dict)
+        }
 
-    def _get_guitar_friendly_voicing(
-        self, cs: harmony.ChordSymbol, num_strings: int = 6,
-        preferred_octave_bottom: int = 2,
-    ) -> List[pitch.Pitch]:
-        if not cs or not cs.pitches: return []
-        original_pitches = list(cs.pitches);
-
-        try:
-            temp_chord = cs.closedPosition(forceOctave=preferred_octave_bottom, inPlace=False)
-            candidate_pitches = sorted(list(temp_chord.pitches), key=lambda p_sort: p_sort.ps)
-        except Exception as e_closed_pos:
-            logger.warning(f"GuitarGen: Error in closedPosition for {cs.figure}: {e_closed_pos}. Using original pitches.")
-            candidate_pitches = sorted(original_pitches, key=lambda p_sort:p_sort.ps)
-
-        if not candidate_pitches:
-            logger.warning(f"GuitarGen: No candidate pitches for {cs.figure} after closedPosition. Returning empty.")
-            return []
-
-        guitar_min_ps = pitch.Pitch(f"E{DEFAULT_GUITAR_OCTAVE_RANGE[0]}").ps
-        guitar_max_ps = pitch.Pitch(f"B{DEFAULT_GUITAR_OCTAVE_RANGE[1]}").ps
-
-        if candidate_pitches and candidate_pitches[0].ps < guitar_min_ps:
-            oct_shift = math.ceil((guitar_min_ps - candidate_pitches[0].ps) / 12.0)
-            candidate_pitches = [p_cand.transpose(int(oct_shift * 12)) for p_cand in candidate_pitches]
-            candidate_pitches.sort(key=lambda p_sort: p_sort.ps)
-
-        selected_dict: Dict[str, pitch.Pitch] = {}
-        for p_cand_select in candidate_pitches:
-            if guitar_min_ps <= p_cand_select.ps <= guitar_max_ps:
-                if p_cand_select.name not in selected_dict: # オクターブ違いは別として扱うため、nameでチェック
-                     selected_dict[p_cand_select.name] = p_cand_select
+    def _get_pattern_roles(self, rhythm_key: str, pattern_events: Sequence[Any]) -> Tuple[int, ...]:
+        roles = self._pattern_roles.get(rhythm_key)
+        if roles is None or len(roles) != len(pattern_events):
+            roles = compile_pattern_roles(pattern_events, default_role="full"); self._pattern_roles[rhythm_key] = roles
+        return roles
 
-        final_voiced_pitches = sorted(list(selected_dict.values()), key=lambda p_sort:p_sort.ps)
-        return final_voiced_pitches[:num_strings]
+    def _get_guitar_voicing(self, cs: harmony.ChordSymbol, num_strings: int = 6, preferred_octave_bottom: int = 2) -> Voicing:
+        """クローズボイシングをギターの音域 (GUITAR_MIDI_RANGE) に収め、弦の数までにしたもの。"""
+        return self.voicing_service.voice(cs, VOICING_STYLE_CLOSED, preferred_octave_bottom, num_strings, GUITAR_MIDI_RANGE)
 
 
     def _create_notes_from_event(
@@ -202,7 +201,12 @@ class GuitarGenerator:
         num_strings = guitar_params.get("guitar_num_strings", 6)
         preferred_octave_bottom = guitar_params.get("guitar_target_octave", 3)
 
-        chord_pitches = self._get_guitar_friendly_voicing(cs, num_strings, preferred_octave_bottom)
+        voiced_midis = self._get_guitar_voicing(cs, num_strings, preferred_octave_bottom).midis if cs and cs.pitches else ()
+        event_role = guitar_params.get("current_event_role", _ROLE_FULL)
+        if event_role != _ROLE_FULL and voiced_midis:
+            # ルート・シェル等の役割は整数の表から選ぶ
+            voiced_midis = chord_role_table(voiced_midis, parse_chord_pcs(cs.figure))[event_role] or voiced_midis
+        chord_pitches = self.voicing_service.pitches(voiced_midis, cs)
         if not chord_pitches:
             logger.debug(f"GuitarGen: No guitar-friendly pitches for {cs.figure} with style {style}. Skipping event.")
             return []
@@ -383,7 +387,8 @@ class GuitarGenerator:
             if pattern_ref_duration <= 0: pattern_ref_duration = self.global_time_signature_obj.barDuration.quarterLength if self.global_time_signature_obj else 4.0
 
 
-            for event_def in pattern_events:
+            event_roles = self._get_pattern_roles(final_rhythm_key_selected, pattern_events)
+            for event_idx, event_def in enumerate(pattern_events):
                 event_offset_in_pattern = float(event_def.get("offset", 0.0))
                 event_duration_in_pattern = float(event_def.get("duration", 1.0))
                 event_velocity_factor = float(event_def.get("velocity_factor", 1.0))
@@ -412,6 +417,7 @@ class GuitarGenerator:
                 event_specific_guitar_params = final_guitar_params.copy()
                 if event_stroke_direction:
                     event_specific_guitar_params["current_event_stroke"] = event_stroke_direction
+                event_specific_guitar_params["current_event_role"] = event_roles[event_idx]
 
                 generated_elements = self._create_notes_from_event(
                     cs_object, event_specific_guitar_params,
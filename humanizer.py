@@ -3,7 +3,7 @@ import music21 # name 'music21' is not defined エラー対策
 import random
 import math
 import copy
-from typing import List, Dict, Any, Union, Optional, cast 
+from typing import List, Dict, Any, Union, Optional, Sequence, Tuple, cast 
 
 # music21 のサブモジュールを正しい形式でインポート
 import music21.note as note 
@@ -68,6 +68,55 @@ HUMANIZATION_TEMPLATES: Dict[str, Dict[str, Any]] = {
     "vocal_pop_energetic": {"time_variation": 0.015, "duration_percentage": 0.02, "velocity_variation": 8, "use_fbm_time": True, "fbm_time_scale": 0.008},
 }
 
+def resolve_humanization_params(template_name: Optional[str] = None, custom_params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    actual_template_name = template_name if template_name and template_name in HUMANIZATION_TEMPLATES else "default_subtle"
+    params = HUMANIZATION_TEMPLATES.get(actual_template_name, {}).copy()
+    if custom_params:
+        params.update(custom_params)
+    return params
+
+def humanize_note_arrays(
+    offsets: Sequence[float],
+    durations: Sequence[float],
+    velocities: Sequence[int],
+    template_name: Optional[str] = None,
+    custom_params: Optional[Dict[str, Any]] = None
+) -> Tuple[List[float], List[float], List[int]]:
+    """
+    同じテンプレートでヒューマナイズする音符群を配列でまとめて処理する。
+    apply_humanization_to_element と同じパラメータ解釈で、Note の deepcopy を行わない。
+    戻り値は (offsets, durations, velocities)。
+    """
+    count = len(offsets)
+    if count == 0: return [], [], []
+    params = resolve_humanization_params(template_name, custom_params)
+    time_var = params.get('time_variation', 0.01)
+    dur_perc = params.get('duration_percentage', 0.03)
+    vel_var = int(params.get('velocity_variation', 5))
+    use_fbm = params.get('use_fbm_time', False)
+    fbm_scale = params.get('fbm_time_scale', 0.01)
+    fbm_h = params.get('fbm_hurst', 0.6)
+    min_dur = MIN_NOTE_DURATION_QL / 8
+
+    if NUMPY_AVAILABLE and np is not None:
+        offsets_arr = np.asarray(offsets, dtype=float)
+        durations_arr = np.asarray(durations, dtype=float)
+        velocities_arr = np.asarray(velocities, dtype=int)
+        if use_fbm:
+            time_shifts = np.asarray(generate_fractional_noise(count, hurst=fbm_h, scale_factor=fbm_scale))
+        else:
+            time_shifts = np.random.uniform(-time_var, time_var, count)
+        new_offsets = np.maximum(offsets_arr + time_shifts, 0.0)
+        new_durations = np.maximum(durations_arr * (1.0 + np.random.uniform(-dur_perc, dur_perc, count)), min_dur)
+        new_velocities = np.clip(velocities_arr + np.random.randint(-vel_var, vel_var + 1, count), 1, 127)
+        return new_offsets.tolist(), new_durations.tolist(), new_velocities.tolist()
+
+    time_shifts_list = generate_fractional_noise(count, hurst=fbm_h, scale_factor=fbm_scale) if use_fbm else [random.uniform(-time_var, time_var) for _ in range(count)]
+    new_offsets_list = [max(0.0, o + t) for o, t in zip(offsets, time_shifts_list)]
+    new_durations_list = [max(min_dur, d * (1.0 + random.uniform(-dur_perc, dur_perc))) for d in durations]
+    new_velocities_list = [max(1, min(127, int(v) + random.randint(-vel_var, vel_var))) for v in velocities]
+    return new_offsets_list, new_durations_list, new_velocities_list
+
 def apply_humanization_to_element(
     m21_element_obj: Union[note.Note, m21chord.Chord], 
     template_name: Optional[str] = None, 
@@ -77,11 +126,7 @@ def apply_humanization_to_element(
         logger.warning(f"Humanizer: apply_humanization_to_element received non-Note/Chord object: {type(m21_element_obj)}")
         return m21_element_obj
 
-    actual_template_name = template_name if template_name and template_name in HUMANIZATION_TEMPLATES else "default_subtle"
-    params = HUMANIZATION_TEMPLATES.get(actual_template_name, {}).copy()
-    
-    if custom_params: 
-        params.update(custom_params)
+    params = resolve_humanization_params(template_name, custom_params)
 
     element_copy = copy.deepcopy(m21_element_obj)
     time_var = params.get('time_variation', 0.01)
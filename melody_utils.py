@@ -78,9 +78,13 @@ def generate_melodic_pitches(
     avoid_deg = SR.avoid_degrees(mode)
 
     chord_pcs = {p.pitchClass for p in chord.pitches}
-    tension_pcs = {
-        scale_obj.pitchFromDegree(d).pitchClass for d in tensions_deg if d not in avoid_deg and hasattr(scale_obj, 'pitchFromDegree')
-    }
+    scale_desc = SR.get_descriptor(tonic, mode) if hasattr(SR, 'get_descriptor') else None
+    if scale_desc is not None:
+        tension_pcs = {scale_desc.pc_of_degree(d) for d in tensions_deg if d not in avoid_deg}
+    else:
+        tension_pcs = {
+            scale_obj.pitchFromDegree(d).pitchClass for d in tensions_deg if d not in avoid_deg and hasattr(scale_obj, 'pitchFromDegree')
+        }
 
     notes_out: List[note.Note] = [] # note を使用
     prev_pitch_obj: Optional[pitch.Pitch] = None # pitch を使用
@@ -17,11 +17,12 @@ from typing import List, Dict, Optional, Tuple, Any, cast, Sequence
 try:
     from utilities.rhythm_library_loader import load_rhythm_library as load_rhythm_lib_main_func
     from utilities.override_loader import load_overrides, Overrides as OverrideModelType, PartOverride as PartOverrideModelType
-    from utilities.core_music_utils import get_time_signature_object, sanitize_chord_label
+    from utilities.core_music_utils import get_time_signature_object, sanitize_chord_label, write_score_midi
     from generator import (
         PianoGenerator, DrumGenerator, GuitarGenerator, ChordVoicer,
         MelodyGenerator, BassGenerator, VocalGenerator
     )
+    from generator.chord_voicer import VoicingService
 except ImportError as e:
     print(f"CRITICAL ERROR: Could not import modules: {e}")
     sys.exit(1)
@@ -99,6 +100,23 @@ def load_yaml_file(file_path: Path, description: str) -> Optional[Dict]:
         logger.error(f"Error loading {description} from {file_path}: {e}", exc_info=True)
         sys.exit(1)
 
+def load_json_file(file_path: Path, description: str) -> Optional[Any]:
+    """JSON を読む。YAML と違い、無い・壊れている場合は None を返して呼び出し側に任せる (任意データ用)。"""
+    if not file_path.exists():
+        logger.error(f"{description} not found: {file_path}")
+        return None
+    try:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        logger.info(f"Loaded {description} from: {file_path}")
+        return data
+    except json.JSONDecodeError as e_json:
+        logger.error(f"Error decoding JSON from {description} at {file_path}: {e_json}")
+        return None
+    except Exception as e:
+        logger.error(f"Error loading {description} from {file_path}: {e}", exc_info=True)
+        return None
+
 def _get_humanize_params_for_final_touch( # 汎用ヒューマナイザ用のパラメータ取得（役割変更）
     instrument_final_params: Dict[str, Any], # 既に感情などが反映されたパラメータ
     default_cfg_instrument: Dict[str, Any] # DEFAULT_CONFIGの楽器設定
@@ -279,7 +297,9 @@ def run_composition(cli_args: argparse.Namespace, main_cfg: Dict,
     proc_blocks = prepare_stream_for_generators(processed_chordmap_data, main_cfg, rhythm_lib_data, arrangement_overrides)
     if not proc_blocks: logger.error("No blocks to process from processed_chordmap_data. Aborting."); return
 
-    cv_inst = ChordVoicer(global_tempo=global_tempo_val, global_time_signature=global_ts_str)
+    # ボイシングは曲ごとに1つのサービスで計算・キャッシュし、ピアノ・ギター・コードパートで共有する
+    voicing_service = VoicingService()
+    cv_inst = ChordVoicer(global_tempo=global_tempo_val, global_time_signature=global_ts_str, voicing_service=voicing_service)
     gens: Dict[str, Any] = {}
 
     for part_name, generate_flag in main_cfg.get("parts_to_generate", {}).items():
@@ -299,9 +319,9 @@ def run_composition(cli_args: argparse.Namespace, main_cfg: Dict,
         try: instrument_obj = m21instrument.fromString(instrument_str)
         except: instrument_obj = m21instrument.Piano()
 
-        if part_name == "piano": gens[part_name] = PianoGenerator(rhythm_library=rhythm_lib_for_instrument, chord_voicer_instance=cv_inst, default_instrument_rh=instrument_obj, default_instrument_lh=instrument_obj, global_tempo=global_tempo_val, global_time_signature=global_ts_str)
+        if part_name == "piano": gens[part_name] = PianoGenerator(rhythm_library=rhythm_lib_for_instrument, voicing_service=voicing_service, default_instrument_rh=instrument_obj, default_instrument_lh=instrument_obj, global_tempo=global_tempo_val, global_time_signature=global_ts_str)
         elif part_name == "drums": gens[part_name] = DrumGenerator(lib=rhythm_lib_for_instrument, tempo_bpm=global_tempo_val, time_sig=global_ts_str)
-        elif part_name == "guitar": gens[part_name] = GuitarGenerator(rhythm_library=rhythm_lib_for_instrument, default_instrument=instrument_obj, global_tempo=global_tempo_val, global_time_signature=global_ts_str)
+        elif part_name == "guitar": gens[part_name] = GuitarGenerator(rhythm_library=rhythm_lib_for_instrument, default_instrument=instrument_obj, global_tempo=global_tempo_val, global_time_signature=global_ts_str, voicing_service=voicing_service)
         elif part_name == "bass": gens[part_name] = BassGenerator(rhythm_library=rhythm_lib_for_instrument, default_instrument=instrument_obj, global_tempo=global_tempo_val, global_time_signature=global_ts_str, global_key_tonic=global_key_tonic_val, global_key_mode=global_key_mode_val, rng_seed=main_cfg.get("rng_seed"))
         elif part_name == "melody": gens[part_name] = MelodyGenerator(rhythm_library=rhythm_lib_for_instrument, default_instrument=instrument_obj, global_tempo=global_tempo_val, global_time_signature=global_ts_str, global_key_signature_tonic=global_key_tonic_val, global_key_signature_mode=global_key_mode_val)
         elif part_name == "vocal":
@@ -310,6 +330,17 @@ def run_composition(cli_args: argparse.Namespace, main_cfg: Dict,
             gens[part_name] = cv_inst
             if instrument_obj : cv_inst.default_instrument = instrument_obj
     
+    # ベースのボーカル回避用にボーカルデータを先に読んでおく (VocalGenerator とは別に1回だけ)
+    vocal_notes_for_bass: Optional[List[Dict]] = None
+    vocal_data_path_for_bass = cli_args.vocal_mididata_path or main_cfg["default_part_parameters"].get("vocal", {}).get("data_paths", {}).get("midivocal_data_path")
+    if "bass" in gens and vocal_data_path_for_bass:
+        try:
+            loaded_vocal_for_bass = load_json_file(Path(str(vocal_data_path_for_bass)), "Vocal MIDI Data for BassGenerator")
+            if isinstance(loaded_vocal_for_bass, list): vocal_notes_for_bass = loaded_vocal_for_bass
+            else: logger.warning(f"Bass vocal avoidance disabled: no usable vocal data in '{vocal_data_path_for_bass}'.")
+        except Exception as e_vocal_bass: # ボーカルデータが読めなくてもベースは回避なしで生成する
+            logger.warning(f"Bass vocal avoidance disabled: could not load '{vocal_data_path_for_bass}': {e_vocal_bass}")
+
     for p_n, p_g_inst in gens.items():
         if p_g_inst and main_cfg["parts_to_generate"].get(p_n):
             logger.info(f"Generating {p_n} part using processed chord events...")
@@ -343,6 +374,8 @@ def run_composition(cli_args: argparse.Namespace, main_cfg: Dict,
                         if p_n == "guitar" and 'cli_guitar_style_override' in sig.parameters:
                             cli_guitar_style = getattr(cli_args, "guitar_style", None)
                             compose_kwargs['cli_guitar_style_override'] = cli_guitar_style
+                        if p_n == "bass" and vocal_notes_for_bass and 'vocal_notes' in sig.parameters:
+                            compose_kwargs['vocal_notes'] = vocal_notes_for_bass
                         part_obj = p_g_inst.compose(*compose_args, **compose_kwargs)
                     else: logger.error(f"Generator for {p_n} does not have a compose method."); continue
                 
@@ -357,7 +390,7 @@ def run_composition(cli_args: argparse.Namespace, main_cfg: Dict,
     actual_out_fname = cli_args.output_filename if cli_args.output_filename else out_fname_template.format(song_title=title)
     out_fpath = cli_args.output_dir / actual_out_fname; out_fpath.parent.mkdir(parents=True,exist_ok=True)
     try:
-        if final_score.flatten().notesAndRests: final_score.write('midi',fp=str(out_fpath)); logger.info(f"🎉 MIDI exported to {out_fpath}")
+        if final_score.flatten().notesAndRests: write_score_midi(final_score, out_fpath); logger.info(f"🎉 MIDI exported to {out_fpath}")
         else: logger.warning(f"Score is empty. No MIDI file generated at {out_fpath}.")
     except Exception as e_w: logger.error(f"General MIDI write error to {out_fpath}: {e_w}", exc_info=True)
 
@@ -49,12 +49,19 @@ class PartOverride(BaseModel):
     weak_beat_style: Optional[str] = None
     approach_on_4th_beat: Optional[bool] = None
     approach_style_on_4th: Optional[str] = None
+    bass_range_min_midi: Optional[int] = Field(None, ge=0, le=127)
+    bass_range_max_midi: Optional[int] = Field(None, ge=0, le=127)
+    avoid_vocal_collisions: Optional[bool] = None
+    candidate_search: Optional[bool] = None
+    candidate_count: Optional[int] = Field(None, ge=1)
 
     # Piano specific
     weak_beat_style_rh: Optional[str] = None
     weak_beat_style_lh: Optional[str] = None
     fill_on_4th: Optional[bool] = None
     fill_length_beats: Optional[float] = None
+    apply_pedal: Optional[bool] = None
+    pedal_repedal_gap_ql: Optional[float] = Field(None, ge=0)
 
     # Drum specific
     ghost_hat_on_offbeat: Optional[bool] = None
@@ -1,6 +1,6 @@
 # --- START OF FILE generator/piano_generator.py (ヒューマナイズ外部化・.flat/.clone()修正・Override対応・copyインポート版) ---
 import music21
-from typing import cast, List, Dict, Optional, Tuple, Any, Sequence, Union
+from typing import cast, List, Dict, Optional, Tuple, Any, Sequence, Union, NamedTuple
 import copy # ★★★ import copy を追加 ★★★
 
 # music21 のサブモジュールを正しい形式でインポート
@@ -16,17 +16,29 @@ import music21.interval as interval
 import music21.tempo as tempo
 import music21.key as key
 import music21.chord      as m21chord
-import music21.expressions as expressions
 import music21.volume as m21volume
 from music21 import exceptions21
 
 import random
 import logging
+from functools import lru_cache
 
 try:
-    from utilities.override_loader import get_part_override # load_overrides はここでは不要
-    from utilities.core_music_utils import MIN_NOTE_DURATION_QL, get_time_signature_object, sanitize_chord_label
-    from utilities.humanizer import apply_humanization_to_part, HUMANIZATION_TEMPLATES
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import pretty_midi
+except ImportError:
+    pretty_midi = None
+
+try:
+    from utilities.override_loader import get_part_override, Overrides # load_overrides はここでは不要
+    from utilities.core_music_utils import (MIN_NOTE_DURATION_QL, get_time_signature_object, sanitize_chord_label, ControllerEvent, set_controller_events,
+                                            ChordPCs, parse_chord_pcs, chord_pcs_from_chord_symbol, compile_pattern_roles, chord_role_table)
+    from utilities.humanizer import humanize_note_arrays, HUMANIZATION_TEMPLATES
+    from .chord_voicer import VoicingService
 except ImportError:
     logger_fallback = logging.getLogger(__name__ + ".fallback_utils")
     logger_fallback.warning("PianoGen: Could not import from utilities. Using fallbacks.")
@@ -38,21 +50,231 @@ except ImportError:
     def sanitize_chord_label(label: Optional[str]) -> Optional[str]:
         if not label or label.strip().lower() in ["rest", "r", "n.c.", "nc", "none", "-"]: return None # "r", "-", "none" もRest扱いに
         return label.strip()
-    def apply_humanization_to_part(part, template_name=None, custom_params=None): return part
+    def humanize_note_arrays(offsets, durations, velocities, template_name=None, custom_params=None): return list(offsets), list(durations), list(velocities)
     HUMANIZATION_TEMPLATES = {}
     class DummyPartOverride: model_config = {}; model_fields = {}
     def get_part_override(overrides, section, part) -> DummyPartOverride: return DummyPartOverride()
+    class Overrides: # ダミー
+        def __init__(self, root: Optional[Dict] = None): self.root = root or {}
+    class ControllerEvent(NamedTuple): offset: float; controller: int; value: int # ダミー
+    def set_controller_events(part, events): pass
+    ChordPCs = Any
+    def parse_chord_pcs(label): return None
+    def chord_pcs_from_chord_symbol(cs): return None
+    def compile_pattern_roles(pattern, role_codes=None, default_role="root"): return tuple(0 for _ in pattern) # 全てルート
+    def chord_role_table(voicing, chord_pcs): # ダミー: ルート (最低音) / オクターブ / 全体のみ
+        low = min(voicing) if voicing else None
+        return ((low,),) * 3 + ((low, low + 12),) + ((low,),) * 2 + (tuple(sorted(voicing)),) if voicing else ((),) * 7
+    VoicingService = None # ボイシングは _get_piano_chord_midis の簡易クローズになる
 
 
 logger = logging.getLogger(__name__)
 
 DEFAULT_PIANO_LH_OCTAVE: int = 2
 DEFAULT_PIANO_RH_OCTAVE: int = 4
+DEFAULT_PIANO_HUMANIZE_TEMPLATES: Dict[str, str] = {"RH": "piano_gentle_arpeggio", "LH": "piano_block_chord"}
+
+# --- ボイシングの声部整理 (MIDI 整数で処理) ---
+PIANO_HAND_RANGES: Dict[str, Tuple[int, int]] = {"RH": (55, 96), "LH": (28, 64)} # (最低, 最高) MIDI。piano_rh_min_midi などで上書き可
+DEFAULT_PIANO_HAND_GAP_SEMITONES: int = 1 # 右手の最低音は左手の最高音よりこの半音数以上上
+# 低音域の音程限界 (Low Interval Limits): インデックスの音程 (半音, 1オクターブ未満) は、下の音がこの MIDI 番号未満だと濁る
+LOW_INTERVAL_LIMITS: Tuple[int, ...] = (0, 52, 51, 48, 46, 46, 47, 34, 43, 41, 41, 41)
+# 残す優先度 (小さいほど優先): ルート, 3度, 7度, テンション・6度, 5度。同じピッチクラスの重複はさらに後回し
+VOICE_PRIORITY_ROOT, VOICE_PRIORITY_THIRD, VOICE_PRIORITY_SEVENTH, VOICE_PRIORITY_EXTENSION, VOICE_PRIORITY_FIFTH = 0, 1, 2, 3, 4
+_VOICE_PRIORITY_DOUBLED: int = 5
+
+def voice_priority(pc: int, root_pc: int, third_pc: Optional[int], fifth_pc: Optional[int]) -> int:
+    """ピッチクラスのコード内での役割から声部を残す優先度を返す (減七の 6 度音程は 7 度扱い)。"""
+    interval_pc = (pc - root_pc) % 12
+    if interval_pc == 0: return VOICE_PRIORITY_ROOT
+    if pc == third_pc: return VOICE_PRIORITY_THIRD
+    if interval_pc in (10, 11) or (interval_pc == 9 and fifth_pc is not None and (fifth_pc - root_pc) % 12 == 6): return VOICE_PRIORITY_SEVENTH
+    if pc == fifth_pc: return VOICE_PRIORITY_FIFTH
+    return VOICE_PRIORITY_EXTENSION
+
+@lru_cache(maxsize=4096)
+def reduce_piano_voicing(midis: Tuple[int, ...], root_pc: Optional[int], third_pc: Optional[int], fifth_pc: Optional[int],
+                         num_voices: Optional[int], low: int, high: int) -> Tuple[int, ...]:
+    """
+    ボイシング (MIDI の整数タプル) を音域 [low, high] に収め、num_voices 声部まで役割の優先度順に間引き、
+    低音域で濁る音程 (LOW_INTERVAL_LIMITS) を上の音をオクターブ上げて (上げられなければ外して) 解消する。
+    結果は低い順。root_pc が None ならコードの役割は使わず低い音から残す。
+    """
+    if not midis or high < low: return ()
+    folded: List[int] = []
+    for m in midis:
+        if m < low: m += 12 * ((low - m + 11) // 12)
+        elif m > high: m -= 12 * ((m - high + 11) // 12)
+        if low <= m <= high and m not in folded: folded.append(m)
+    folded.sort()
+    seen_pcs = set(); ranked: List[Tuple[int, int]] = []
+    for m in folded:
+        prio = voice_priority(m % 12, root_pc, third_pc, fifth_pc) if root_pc is not None else VOICE_PRIORITY_EXTENSION
+        if m % 12 in seen_pcs: prio += _VOICE_PRIORITY_DOUBLED
+        seen_pcs.add(m % 12); ranked.append((prio, m))
+    if num_voices is not None and num_voices > 0 and len(ranked) > num_voices:
+        ranked = sorted(ranked)[:num_voices]
+    voices = sorted(ranked, key=lambda r: r[1])
+    changed = True
+    while changed:
+        changed = False
+        for i in range(len(voices) - 1):
+            (lower_prio, lower), (upper_prio, upper) = voices[i], voices[i + 1]
+            gap_semitones = upper - lower
+            if gap_semitones >= 12 or lower >= LOW_INTERVAL_LIMITS[gap_semitones]: continue
+            raised = upper + 12
+            if raised <= high and all(raised != v for _, v in voices): voices[i + 1] = (upper_prio, raised)
+            elif upper_prio >= lower_prio: del voices[i + 1]
+            else: del voices[i]
+            voices.sort(key=lambda r: r[1]); changed = True
+            break
+    return tuple(v for _, v in voices)
+
+# サステインペダル (CC64)
+SUSTAIN_PEDAL_CC: int = 64
+PEDAL_DOWN_VALUE: int = 127
+PEDAL_UP_VALUE: int = 0
+PEDAL_MIN_RANGE_QL: float = 0.25 # これより短いブロックには踏まない
+DEFAULT_PEDAL_REPEDAL_GAP_QL: float = 0.05 # 継ぎ目 (コードチェンジ) で上げてから踏み直すまでの QL。0 なら踏みっぱなし
+_PEDAL_MERGE_EPSILON_QL: float = 1e-6
+
+def merge_pedal_ranges(pedal_ranges: Sequence[Tuple[float, float, float]]) -> List[ControllerEvent]:
+    """
+    ペダル区間 (開始, 終了, 踏み替えギャップ) を CC64 のイベント列にする。
+    開始順に一度だけ走査し、重なる・接する区間は1本にまとめる。まとめた区間の継ぎ目ではその時刻で上げ、
+    継ぎ目から始まる区間のギャップ後に踏み直す (ギャップ 0 の継ぎ目は踏みっぱなし)。
+    """
+    cc_events: List[ControllerEvent] = []
+    if not pedal_ranges: return cc_events
+
+    def _flush(start: float, end: float, repedal_points: List[Tuple[float, float]]) -> None:
+        cc_events.append(ControllerEvent(start, SUSTAIN_PEDAL_CC, PEDAL_DOWN_VALUE)); last_down = start
+        for point, gap in repedal_points:
+            if gap <= 0 or point < last_down or point + gap >= end: continue
+            cc_events.append(ControllerEvent(point, SUSTAIN_PEDAL_CC, PEDAL_UP_VALUE))
+            cc_events.append(ControllerEvent(point + gap, SUSTAIN_PEDAL_CC, PEDAL_DOWN_VALUE)); last_down = point + gap
+        cc_events.append(ControllerEvent(end, SUSTAIN_PEDAL_CC, PEDAL_UP_VALUE))
+
+    ordered = sorted(pedal_ranges, key=lambda r: (r[0], r[1]))
+    cur_start, cur_end, _ = ordered[0]; repedal_points: List[Tuple[float, float]] = []
+    for start, end, gap in ordered[1:]:
+        if start <= cur_end + _PEDAL_MERGE_EPSILON_QL:
+            if start > cur_start + _PEDAL_MERGE_EPSILON_QL and (not repedal_points or start > repedal_points[-1][0] + _PEDAL_MERGE_EPSILON_QL):
+                repedal_points.append((start, gap))
+            cur_end = max(cur_end, end)
+        else:
+            _flush(cur_start, cur_end, repedal_points)
+            cur_start, cur_end, repedal_points = start, end, []
+    _flush(cur_start, cur_end, repedal_points)
+    return cc_events
+
+class PianoEvent(NamedTuple):
+    """ピアノの1イベント (単音・和音・休符)。pitches は MIDI 番号 (空なら休符)。offset はブロック内 QL、compose 後は絶対 QL。"""
+    offset: float
+    pitches: Tuple[int, ...]
+    duration: float
+    velocity: int
+
+class CompiledPianoPattern(NamedTuple):
+    """
+    ピアノのリズムパターンを特定のブロック長に展開したもの (NumPy が無い環境ではタプル)。
+    ブロックからはみ出す・短すぎるイベントは除外済みで、offsets/durations はスケーリング後のブロック内 QL。
+    weak_mask は 2・4 拍目開始のイベント、fourth_mask は 4 拍目頭 (フィル位置) のイベント。
+    roles はイベントの "type" を PATTERN_ROLE_CODES にしたもの (左手が chord_role_table を引くのに使う)。
+    """
+    offsets: Any
+    durations: Any
+    velocity_factors: Any
+    weak_mask: Any
+    fourth_mask: Any
+    roles: Any
+    scale_factor: float
+
+def compile_piano_pattern(pattern: Sequence[Dict[str, Any]], block_duration_ql: float, reference_duration_ql: float,
+                          ts_obj: Optional[meter.TimeSignature] = None) -> CompiledPianoPattern:
+    """rhythm_library のピアノパターンを block_duration_ql にスケーリングし、弱拍・4拍目のマスクとともに配列化する。"""
+    scale_factor = block_duration_ql / reference_duration_ql
+    default_dur = ts_obj.beatDuration.quarterLength if ts_obj else 1.0
+    four_beats = bool(ts_obj and ts_obj.beatCount == 4); beat_dur = ts_obj.beatDuration.quarterLength if four_beats else 0.0
+    offsets: List[float] = []; durations: List[float] = []; velocity_factors: List[float] = []
+    weak_mask: List[bool] = []; fourth_mask: List[bool] = []; kept_events: List[Dict[str, Any]] = []
+    for ev in pattern:
+        if not isinstance(ev, dict): continue
+        offset = float(ev.get("offset", 0.0)) * scale_factor
+        dur = float(ev.get("duration", default_dur)) * scale_factor
+        if offset >= block_duration_ql - (MIN_NOTE_DURATION_QL / 16.0): continue
+        dur = min(dur, block_duration_ql - offset)
+        if dur < MIN_NOTE_DURATION_QL / 4.0: continue
+        offsets.append(offset); durations.append(dur); velocity_factors.append(float(ev.get("velocity_factor", 1.0)))
+        # 4/4拍子を前提として、2拍目(1.0-)と4拍目(3.0-)を弱拍とする (スケーリング後のオフセットで判断)
+        weak_mask.append(four_beats and ((beat_dur <= offset < beat_dur * 2) or (beat_dur * 3 <= offset < beat_dur * 4)))
+        fourth_mask.append(four_beats and abs(offset - beat_dur * 3) < 0.1)
+        kept_events.append(ev)
+    roles = compile_pattern_roles(kept_events)
+    if np is not None:
+        return CompiledPianoPattern(np.asarray(offsets, dtype=np.float64), np.asarray(durations, dtype=np.float64),
+                                    np.asarray(velocity_factors, dtype=np.float64), np.asarray(weak_mask, dtype=bool),
+                                    np.asarray(fourth_mask, dtype=bool), np.asarray(roles, dtype=np.int8), scale_factor)
+    return CompiledPianoPattern(tuple(offsets), tuple(durations), tuple(velocity_factors), tuple(weak_mask), tuple(fourth_mask), roles, scale_factor)
+
+class PianoPatternLayout(NamedTuple):
+    """
+    CompiledPianoPattern に弱拍・フィル・アルペジオ刻みを適用した、ブロックの音配置 (乱数に依存しない部分)。
+    イベント単位の列は Python のリスト、arp_* はアルペジオ音 (main_indices のイベント順・時間順) の列。
+    arp_starts[j]:arp_starts[j+1] が main_indices[j] のアルペジオ音。
+    """
+    offsets: List[float]
+    durations: List[float]
+    keep_mask: List[bool]
+    fill_mask: List[bool]
+    main_mask: List[bool]
+    main_indices: List[int]
+    arp_counts: Any
+    arp_starts: List[int]
+    arp_positions: Any
+    arp_offsets: List[float]
+    arp_durations: List[float]
+
+def arpeggio_order(num_pitches: int, arp_type: str = "up") -> Any:
+    """アルペジオで鳴らすボイスのインデックス列 (ボイシング結果の並びに対する 1 周分)。"""
+    if np is not None:
+        up = np.arange(num_pitches, dtype=np.int64)
+        if arp_type == "down": return up[::-1]
+        if arp_type == "up_down" and num_pitches > 2: return np.concatenate((up, up[-2:0:-1]))
+        return up
+    up = list(range(num_pitches))
+    if arp_type == "down": return up[::-1]
+    if arp_type == "up_down" and num_pitches > 2: return up + up[-2:0:-1]
+    return up
+
+def piano_arpeggio_layout(durations: Sequence[float], note_ql: float) -> Tuple[Any, Any, Any]:
+    """
+    各イベントを note_ql 刻みのアルペジオに分割する。
+    戻り値は (イベントごとの音数, 全音のイベント内オフセット, 全音の長さ) で、音はイベント順・時間順に並ぶ。
+    イベント末尾で MIN_NOTE_DURATION_QL/4 より短くなる音は作らない。
+    """
+    min_dur = MIN_NOTE_DURATION_QL / 4.0
+    if np is not None:
+        durs = np.asarray(durations, dtype=np.float64)
+        if durs.size == 0 or note_ql < min_dur:
+            return np.zeros(durs.size, dtype=np.int64), np.zeros(0, dtype=np.float64), np.zeros(0, dtype=np.float64)
+        max_notes = int(np.ceil(durs.max() / note_ql)) + 1
+        steps = np.concatenate(([0.0], np.cumsum(np.full(max_notes - 1, note_ql)))) # 逐次加算と同じ丸め
+        remaining = durs[:, None] - steps[None, :]
+        valid = remaining >= min_dur
+        return valid.sum(axis=1), np.broadcast_to(steps, remaining.shape)[valid], np.minimum(note_ql, remaining[valid])
+    counts: List[int] = []; inner_offsets: List[float] = []; note_durs: List[float] = []
+    for dur in durations:
+        current = 0.0; n = 0
+        while current < dur and note_ql >= min_dur and min(note_ql, dur - current) >= min_dur:
+            inner_offsets.append(current); note_durs.append(min(note_ql, dur - current)); current += note_ql; n += 1
+        counts.append(n)
+    return counts, inner_offsets, note_durs
 
 class PianoGenerator:
     def __init__(self,
                  rhythm_library: Optional[Dict[str, Dict]] = None,
-                 chord_voicer_instance: Optional[Any] = None,
+                 voicing_service: Optional[Any] = None,
                  default_instrument_rh=m21instrument.Piano(),
                  default_instrument_lh=m21instrument.Piano(),
                  global_tempo: int = 120,
@@ -69,69 +291,124 @@ class PianoGenerator:
         for k, v_item in default_keys_to_add.items():
             if k not in self.rhythm_library: self.rhythm_library[k] = v_item; logger.info(f"PianoGen: Added '{k}' to rhythm_lib.")
 
-        self.chord_voicer = chord_voicer_instance
-        if not self.chord_voicer: logger.warning("PianoGen: No ChordVoicer. Using basic voicing.")
+        # modular_composer からは曲で共有する VoicingService が渡される (単体で使う場合は自前で作る)
+        self.voicing_service = voicing_service if voicing_service is not None else (VoicingService() if VoicingService is not None else None)
+        if self.voicing_service is None: logger.warning("PianoGen: No VoicingService. Using basic voicing.")
         self.instrument_rh = default_instrument_rh
         self.instrument_lh = default_instrument_lh
         self.global_tempo = global_tempo
         self.global_time_signature_str = global_time_signature
         self.global_time_signature_obj = get_time_signature_object(global_time_signature)
-
-    def _get_piano_chord_pitches(
-            self, cs: Optional[harmony.ChordSymbol],
-            num_voices_param: Optional[int], # Can be None
-            target_octave_param: int, voicing_style_name: str
-    ) -> List[pitch.Pitch]:
-        if cs is None or not cs.pitches: return []
-        final_num_voices = num_voices_param if num_voices_param is not None and num_voices_param > 0 else None # 0や負の場合はNone扱い
-        if self.chord_voicer and hasattr(self.chord_voicer, '_apply_voicing_style'):
+        self._compiled_piano_patterns: Dict[Tuple[str, float], CompiledPianoPattern] = {}
+        self._piano_pattern_layouts: Dict[Tuple[Any, ...], PianoPatternLayout] = {}
+        # 読み込み時に1小節長でコンパイルしておく (他のブロック長は初回に追加)
+        for rhythm_key_item, rhythm_details_item in self.rhythm_library.items():
+            if isinstance(rhythm_details_item, dict) and isinstance(rhythm_details_item.get("pattern"), list):
+                self._get_compiled_piano_pattern(rhythm_key_item, rhythm_details_item, bar_dur_for_default)
+
+    def _get_compiled_piano_pattern(self, rhythm_key: str, rhythm_details: Dict[str, Any], block_duration_ql: float) -> CompiledPianoPattern:
+        """(リズムキー, ブロック長) ごとに compile_piano_pattern の結果をキャッシュする。"""
+        cache_key = (rhythm_key, float(block_duration_ql))
+        compiled = self._compiled_piano_patterns.get(cache_key)
+        if compiled is None:
+            pattern_ref_duration = rhythm_details.get("reference_duration_ql", block_duration_ql)
+            if pattern_ref_duration <= 0: pattern_ref_duration = block_duration_ql # ゼロ除算防止
+            compiled = compile_piano_pattern(rhythm_details.get("pattern", []), block_duration_ql, pattern_ref_duration, self.global_time_signature_obj)
+            self._compiled_piano_patterns[cache_key] = compiled
+        return compiled
+
+    def _get_piano_pattern_layout(self, rhythm_key: str, block_duration_ql: float, compiled: CompiledPianoPattern,
+                                  weak_beat_style: str, fill_length_beats: Optional[float], arp_note_ql: Optional[float]) -> PianoPatternLayout:
+        """弱拍スタイル・フィル長 (None で無効)・アルペジオ刻み (None で和音) ごとに音配置を計算してキャッシュする。"""
+        cache_key = (rhythm_key, float(block_duration_ql), weak_beat_style, fill_length_beats, arp_note_ql)
+        layout = self._piano_pattern_layouts.get(cache_key)
+        if layout is not None: return layout
+        num_events = len(compiled.offsets)
+        keep_mask = [not (weak_beat_style == "rest" and bool(weak)) for weak in compiled.weak_mask]
+        fill_mask = [fill_length_beats is not None and bool(fourth) and keep for fourth, keep in zip(compiled.fourth_mask, keep_mask)]
+        if np is not None and num_events:
+            # フィル用のスペースを作るため元のイベントを短くする
+            durations = np.where(np.asarray(fill_mask, dtype=bool), np.maximum(MIN_NOTE_DURATION_QL, compiled.durations - (fill_length_beats or 0.0)), compiled.durations).tolist()
+        else:
+            durations = [max(MIN_NOTE_DURATION_QL, float(dur) - fill_length_beats) if fill else float(dur) for dur, fill in zip(compiled.durations, fill_mask)]
+        main_mask = [keep and dur >= MIN_NOTE_DURATION_QL / 4.0 for keep, dur in zip(keep_mask, durations)]
+        main_indices = [i for i in range(num_events) if main_mask[i]]
+        offsets = [float(off) for off in compiled.offsets]
+        arp_counts: Any = []; arp_positions: Any = []; arp_offsets: List[float] = []; arp_durations: List[float] = []
+        if arp_note_ql is not None:
+            arp_counts, arp_inner_offsets, arp_note_durs = piano_arpeggio_layout([durations[i] for i in main_indices], arp_note_ql)
+            if np is not None:
+                arp_event_offsets = np.repeat(np.asarray([offsets[i] for i in main_indices], dtype=np.float64), arp_counts)
+                arp_positions = np.arange(len(arp_inner_offsets)) - np.repeat(np.cumsum(arp_counts) - arp_counts, arp_counts) # イベント内の音番号
+                arp_offsets = (arp_event_offsets + arp_inner_offsets).tolist(); arp_durations = (arp_note_durs * 0.95).tolist()
+                arp_counts = arp_counts.tolist()
+            else:
+                arp_positions = [k for count in arp_counts for k in range(count)]
+                arp_event_offsets = [offsets[i] for i, count in zip(main_indices, arp_counts) for _ in range(count)]
+                arp_offsets = [off + inner for off, inner in zip(arp_event_offsets, arp_inner_offsets)]; arp_durations = [d * 0.95 for d in arp_note_durs]
+        arp_starts = [0]
+        for count in arp_counts: arp_starts.append(arp_starts[-1] + count)
+        layout = PianoPatternLayout(offsets, durations, keep_mask, fill_mask, main_mask, main_indices, arp_counts, arp_starts, arp_positions, arp_offsets, arp_durations)
+        self._piano_pattern_layouts[cache_key] = layout
+        return layout
+
+    def _get_piano_chord_midis(self, cs: Optional[harmony.ChordSymbol], target_octave_param: int, voicing_style_name: str) -> Tuple[int, ...]:
+        """
+        全ボイスの MIDI タプル (声部の整理は reduce_piano_voicing で行う)。共有の VoicingService のボイシングを使い、
+        無い・失敗した場合はルートを target_octave に置いたクローズにする。
+        """
+        if cs is None or not cs.pitches: return ()
+        if self.voicing_service is not None:
             try:
-                return self.chord_voicer._apply_voicing_style(cs, voicing_style_name, target_octave_for_bottom_note=target_octave_param, num_voices_target=final_num_voices)
-            except Exception as e_cv: logger.warning(f"PianoGen: Error in ChordVoicer for '{cs.figure}' with style '{voicing_style_name}': {e_cv}. Falling back to simple voicing.", exc_info=False) # exc_info=False for less verbose logs
-
-        # Simple fallback voicing
-        try:
-            temp_chord_obj = cs.closedPosition(inPlace=False) # Get a fresh copy
-            if not temp_chord_obj.pitches: return [] # Should not happen if cs.pitches exists
-
-            # Ensure root is present and adjust octave
-            root_pitch = cs.root()
-            if not root_pitch: return sorted(list(cs.pitches), key=lambda p_sort: p_sort.ps)[:final_num_voices or len(cs.pitches)] # Should not happen
-
-            # Transpose entire chord to target octave of the root
-            current_root_octave = root_pitch.octave
-            oct_diff = target_octave_param - current_root_octave
-            transposed_pitches = [p.transpose(oct_diff * 12) for p in temp_chord_obj.pitches]
-            voiced_pitches = sorted(transposed_pitches, key=lambda p_sort: p_sort.ps)
-
-            if final_num_voices is not None and len(voiced_pitches) > final_num_voices:
-                # A more musical way to reduce voices might be needed, e.g., keeping root, third, seventh
-                return voiced_pitches[:final_num_voices] # Simplistic cut
-            return voiced_pitches
-        except Exception as e_simple:
-            logger.warning(f"PianoGen: Simple voicing for '{cs.figure}' failed: {e_simple}. Returning raw pitches.", exc_info=False)
-            raw_pitches = sorted(list(cs.pitches), key=lambda p_sort: p_sort.ps)
-            if final_num_voices is not None and raw_pitches: return raw_pitches[:final_num_voices or len(raw_pitches)]
-            return raw_pitches if raw_pitches else []
-
-
-    def _apply_pedal_to_part(self, part_to_apply_pedal: stream.Part, block_offset: float, block_duration: float):
-        if block_duration > 0.25:
-            pedal_on = expressions.TextExpression("Ped."); pedal_off = expressions.TextExpression("*")
-            on_time = block_offset + 0.01
-            off_time = block_offset + block_duration - 0.05
-            if off_time > on_time:
-                part_to_apply_pedal.insert(on_time, pedal_on); part_to_apply_pedal.insert(off_time, pedal_off)
-
-    def _generate_piano_hand_part_for_block(
+                return self.voicing_service.voice(cs, voicing_style_name, target_octave_param).midis
+            except Exception as e_cv: logger.warning(f"PianoGen: Error in VoicingService for '{cs.figure}' with style '{voicing_style_name}': {e_cv}. Falling back to simple voicing.", exc_info=False)
+        root_pitch = cs.root()
+        root_pc = root_pitch.pitchClass if root_pitch is not None else min(p.pitchClass for p in cs.pitches)
+        root_midi = (target_octave_param + 1) * 12 + root_pc
+        return tuple(sorted({root_midi + (p.pitchClass - root_pc) % 12 for p in cs.pitches}))
+
+    def _voice_piano_hands(self, cs: harmony.ChordSymbol, params: Dict[str, Any]) -> Tuple[Tuple[int, ...], Tuple[int, ...]]:
+        """
+        両手のボイシング (RH, LH) を決める。各手の音域・声部数に整理し、右手は左手の最高音 + ギャップより上に置く。
+        """
+        chord_pcs = parse_chord_pcs(cs.figure) or chord_pcs_from_chord_symbol(cs)
+        root_pc, third_pc, fifth_pc = (chord_pcs.root_pc, chord_pcs.third_pc, chord_pcs.fifth_pc) if chord_pcs else (None, None, None)
+        voiced: Dict[str, Tuple[int, ...]] = {}
+        for hand_LR in ("LH", "RH"):
+            hand = hand_LR.lower()
+            target_octave = int(params.get(f"piano_{hand}_target_octave", DEFAULT_PIANO_RH_OCTAVE if hand_LR == "RH" else DEFAULT_PIANO_LH_OCTAVE))
+            num_voices = params.get(f"piano_{hand}_num_voices")
+            low = int(params.get(f"piano_{hand}_min_midi", PIANO_HAND_RANGES[hand_LR][0])); high = int(params.get(f"piano_{hand}_max_midi", PIANO_HAND_RANGES[hand_LR][1]))
+            if hand_LR == "RH" and voiced["LH"]:
+                low = max(low, voiced["LH"][-1] + int(params.get("piano_hand_gap_semitones", DEFAULT_PIANO_HAND_GAP_SEMITONES)))
+            full_midis = self._get_piano_chord_midis(cs, target_octave, params.get(f"piano_{hand}_voicing_style", "closed"))
+            voiced[hand_LR] = reduce_piano_voicing(full_midis, root_pc, third_pc, fifth_pc, int(num_voices) if num_voices else None, low, high)
+        return voiced["RH"], voiced["LH"]
+
+    @staticmethod
+    def _resolve_piano_humanize(params: Dict[str, Any], hand_LR: str, humanize_overridden: bool) -> Optional[Tuple[str, Dict[str, Any]]]:
+        """
+        ブロックの最終パラメータから片手のヒューマナイズ設定 (テンプレート名, custom_params) を決める。オフなら None。
+        セクションの override で humanize_opt が指定されていれば、chordmap 由来の humanize_rh_opt / humanize_lh_opt より優先する。
+        """
+        if humanize_overridden: enabled = params.get("humanize_opt", False)
+        else: enabled = params.get(f"humanize_{hand_LR.lower()}_opt", params.get("humanize_opt", False))
+        if not enabled: return None
+        return params.get("template_name") or DEFAULT_PIANO_HUMANIZE_TEMPLATES[hand_LR], dict(params.get("custom_params") or {})
+
+    def _generate_piano_hand_events_for_block(
             self, hand_LR: str,
             cs_or_rest: Optional[music21.Music21Object],
             block_duration_ql: float,
             hand_specific_params: Dict[str, Any],
-            rhythm_patterns_for_piano: Dict[str, Any]
-    ) -> stream.Part:
-
-        hand_part_obj = stream.Part(id=f"Piano{hand_LR}_temp_block_for_{id(cs_or_rest)}") # よりユニークなID
+            rhythm_patterns_for_piano: Dict[str, Any],
+            voiced_midis: Optional[Sequence[int]] = None
+    ) -> List[PianoEvent]:
+        """
+        1ブロック分の片手のイベントをブロック内オフセットで返す (Part は compose の最後にまとめて作る)。
+        voiced_midis は _voice_piano_hands で決めたその手のボイシング (省略時はここで決める)。
+        """
+        hand_events: List[PianoEvent] = []
 
         rhythm_key = hand_specific_params.get(f"piano_{hand_LR.lower()}_rhythm_key")
         # velocity は override で直接指定される可能性も考慮
@@ -143,9 +420,6 @@ class PianoGenerator:
             vel_max = hand_specific_params.get(f"piano_velocity_{hand_LR.lower()}_max", 70)
             velocity = random.randint(min(vel_min, vel_max), max(vel_min, vel_max)) # min/maxが逆でもOK
 
-        voicing_style = hand_specific_params.get(f"piano_{hand_LR.lower()}_voicing_style", "closed")
-        target_octave = int(hand_specific_params.get(f"piano_{hand_LR.lower()}_target_octave", DEFAULT_PIANO_RH_OCTAVE if hand_LR == "RH" else DEFAULT_PIANO_LH_OCTAVE))
-        num_voices = hand_specific_params.get(f"piano_{hand_LR.lower()}_num_voices")
         arp_note_ql = float(hand_specific_params.get("piano_arp_note_ql", 0.5))
         perform_style_keyword = hand_specific_params.get(f"piano_{hand_LR.lower()}_style_keyword", "simple_block")
 
@@ -157,131 +431,134 @@ class PianoGenerator:
 
 
         if isinstance(cs_or_rest, note.Rest):
-            rest_obj = note.Rest(quarterLength=block_duration_ql)
-            hand_part_obj.insert(0, rest_obj)
-            return hand_part_obj
+            return [PianoEvent(0.0, (), block_duration_ql, 0)]
 
         if not cs_or_rest or not isinstance(cs_or_rest, harmony.ChordSymbol) or not cs_or_rest.pitches:
-            rest_obj = note.Rest(quarterLength=block_duration_ql)
-            hand_part_obj.insert(0, rest_obj)
-            return hand_part_obj
+            return [PianoEvent(0.0, (), block_duration_ql, 0)]
 
         cs_current: harmony.ChordSymbol = cast(harmony.ChordSymbol, cs_or_rest)
-        base_voiced_pitches = self._get_piano_chord_pitches(cs_current, num_voices, target_octave, voicing_style)
-        if not base_voiced_pitches:
-            rest_obj = note.Rest(quarterLength=block_duration_ql)
-            hand_part_obj.insert(0, rest_obj)
-            return hand_part_obj
-
-        rhythm_details = rhythm_patterns_for_piano.get(rhythm_key if rhythm_key else "")
+        if voiced_midis is None:
+            rh_midis, lh_midis = self._voice_piano_hands(cs_current, hand_specific_params)
+            voiced_midis = rh_midis if hand_LR == "RH" else lh_midis
+        base_voiced_midis = list(voiced_midis)
+        if not base_voiced_midis:
+            return [PianoEvent(0.0, (), block_duration_ql, 0)]
+
+        resolved_rhythm_key = rhythm_key if rhythm_key else ""
+        rhythm_details = rhythm_patterns_for_piano.get(resolved_rhythm_key)
         if not rhythm_details or "pattern" not in rhythm_details:
             logger.warning(f"PianoGen: Rhythm key '{rhythm_key}' not found or invalid for {hand_LR}. Using fallback 'piano_fallback_block'.")
+            resolved_rhythm_key = "piano_fallback_block"
             rhythm_details = rhythm_patterns_for_piano.get("piano_fallback_block", {"pattern": [{"offset":0.0, "duration": block_duration_ql, "velocity_factor":0.7}], "reference_duration_ql": block_duration_ql})
 
-        pattern_events = rhythm_details.get("pattern", [])
-        pattern_ref_duration = rhythm_details.get("reference_duration_ql", block_duration_ql)
-        if pattern_ref_duration <= 0: pattern_ref_duration = block_duration_ql # ゼロ除算防止
-
         # EDMスタイルなどの特殊処理 (現状のrhythm_libraryにはないが将来用)
         is_edm_bounce_style = "edm_bounce" in (rhythm_key or "").lower() or "bounce" in perform_style_keyword.lower()
         is_edm_spread_style = "edm_spread" in (rhythm_key or "").lower() or "spread" in perform_style_keyword.lower()
         if is_edm_bounce_style or is_edm_spread_style:
             # ... (EDMスタイルのロジックは変更なし) ...
-            return hand_part_obj
-
-        for event_idx, event_params in enumerate(pattern_events):
-            event_offset_in_pattern = float(event_params.get("offset", 0.0))
-            event_dur_from_pattern = float(event_params.get("duration", self.global_time_signature_obj.beatDuration.quarterLength if self.global_time_signature_obj else 1.0))
-            event_vf = float(event_params.get("velocity_factor", 1.0))
-
-            scale_factor = block_duration_ql / pattern_ref_duration
-            abs_event_start_offset_in_block = event_offset_in_pattern * scale_factor
-            actual_event_duration = event_dur_from_pattern * scale_factor
-
-            if abs_event_start_offset_in_block >= block_duration_ql - (MIN_NOTE_DURATION_QL / 16.0) : continue
-            actual_event_duration = min(actual_event_duration, block_duration_ql - abs_event_start_offset_in_block)
-
-            if actual_event_duration < MIN_NOTE_DURATION_QL / 4.0: continue
-            current_event_vel = int(velocity * event_vf)
-            current_event_vel = max(1, min(127, current_event_vel)) # ベロシティを範囲内に収める
-
-            # 弱拍処理 (arrangement_overrides.json からの指定を考慮)
-            # 4/4拍子を前提として、2拍目(1.0-)と4拍目(3.0-)を弱拍とする
-            # これはリズムパターンのオフセットに基づくべき
-            is_weak_beat_event = False
-            if self.global_time_signature_obj and self.global_time_signature_obj.beatCount == 4:
-                beat_duration = self.global_time_signature_obj.beatDuration.quarterLength
-                # パターンイベントの開始が、ブロック内の2拍目または4拍目に該当するか
-                # スケーリング後のオフセットで判断
-                if (beat_duration <= abs_event_start_offset_in_block < beat_duration * 2) or \
-                   (beat_duration * 3 <= abs_event_start_offset_in_block < beat_duration * 4):
-                    is_weak_beat_event = True
-            
-            if is_weak_beat_event:
-                if weak_beat_style_hand == "rest": continue # イベントをスキップ
-                if weak_beat_style_hand == "ghost": current_event_vel = max(1, int(current_event_vel * 0.5))
-                # "none" は何もしない
-
-            # 4拍目のフィル処理 (arrangement_overrides.json からの指定を考慮)
-            is_on_4th_beat_start = False
-            if self.global_time_signature_obj and self.global_time_signature_obj.beatCount == 4:
-                beat_duration = self.global_time_signature_obj.beatDuration.quarterLength
-                if abs(abs_event_start_offset_in_block - (beat_duration * 3)) < 0.1: # 4拍目の開始に近いか
-                    is_on_4th_beat_start = True
-            
-            if fill_on_4th_hand and is_on_4th_beat_start and hand_LR == "RH": # 通常RHがフィルを担当
-                # 簡単なフィルとして、短いアルペジオや装飾音を入れる
-                # ここでは元のイベントを短くして、フィル用のスペースを作る
-                original_event_dur_for_fill = actual_event_duration
-                actual_event_duration = max(MIN_NOTE_DURATION_QL, original_event_dur_for_fill - fill_length_beats_hand)
-                
-                fill_start_offset = abs_event_start_offset_in_block + actual_event_duration
-                fill_pitches = base_voiced_pitches[-2:] # 上の2音など
-                if fill_pitches:
-                    for i, p_fill in enumerate(fill_pitches):
-                        fill_note = note.Note(p_fill)
-                        fill_note.quarterLength = (fill_length_beats_hand / len(fill_pitches)) * 0.9
-                        fill_note.volume.velocity = current_event_vel + 5 # 少し強調
-                        hand_part_obj.insert(fill_start_offset + i * (fill_length_beats_hand / len(fill_pitches)), fill_note)
-                if actual_event_duration < MIN_NOTE_DURATION_QL / 4.0: continue # 元のイベントが短すぎたらスキップ
-
-
-            if hand_LR == "RH" and "arpeggio" in perform_style_keyword.lower() and base_voiced_pitches:
-                arp_type = rhythm_details.get("arpeggio_type", "up")
-                ordered_arp_pitches = list(reversed(base_voiced_pitches)) if arp_type == "down" else (base_voiced_pitches + list(reversed(base_voiced_pitches[1:-1])) if arp_type == "up_down" and len(base_voiced_pitches)>2 else base_voiced_pitches)
-                current_offset_in_arp = 0.0; arp_idx = 0
-                current_arp_note_ql_scaled = (rhythm_details.get("note_duration_ql", arp_note_ql)) * scale_factor
-
-                while current_offset_in_arp < actual_event_duration and ordered_arp_pitches:
-                    p_arp_note = ordered_arp_pitches[arp_idx % len(ordered_arp_pitches)]
-                    single_arp_dur = min(current_arp_note_ql_scaled, actual_event_duration - current_offset_in_arp)
-                    if single_arp_dur < MIN_NOTE_DURATION_QL / 4.0: break
-                    arp_note_created = note.Note(p_arp_note, quarterLength=single_arp_dur * 0.95)
-                    arp_note_created.volume = m21volume.Volume(velocity=current_event_vel + random.randint(-3,3))
-                    hand_part_obj.insert(abs_event_start_offset_in_block + current_offset_in_arp, arp_note_created)
-                    current_offset_in_arp += current_arp_note_ql_scaled; arp_idx += 1
+            return hand_events
+
+        compiled = self._get_compiled_piano_pattern(resolved_rhythm_key, rhythm_details, block_duration_ql)
+        num_events = len(compiled.offsets)
+        if num_events == 0: return hand_events
+
+        apply_fill = bool(fill_on_4th_hand) and hand_LR == "RH" # 通常RHがフィルを担当
+        is_arpeggio = hand_LR == "RH" and "arpeggio" in perform_style_keyword.lower()
+        arp_note_ql_scaled = (rhythm_details.get("note_duration_ql", arp_note_ql)) * compiled.scale_factor if is_arpeggio else None
+        layout = self._get_piano_pattern_layout(resolved_rhythm_key, block_duration_ql, compiled, weak_beat_style_hand,
+                                                fill_length_beats_hand if apply_fill else None, arp_note_ql_scaled)
+
+        if np is not None:
+            event_vels = np.clip((velocity * compiled.velocity_factors).astype(np.int64), 1, 127) # ベロシティを範囲内に収める
+            if weak_beat_style_hand == "ghost": event_vels = np.where(compiled.weak_mask, np.maximum(1, (event_vels * 0.5).astype(np.int64)), event_vels)
+            event_vels = event_vels.tolist()
+        else:
+            event_vels = [max(1, min(127, int(velocity * vf))) for vf in compiled.velocity_factors]
+            if weak_beat_style_hand == "ghost": event_vels = [max(1, int(v * 0.5)) if weak else v for v, weak in zip(event_vels, compiled.weak_mask)]
+
+        fill_midis = base_voiced_midis[-2:] # 上の2音など
+
+        if is_arpeggio:
+            # アルペジオの音は配列でまとめて作り、イベントごとのスライスで並べる
+            arp_order = arpeggio_order(len(base_voiced_midis), rhythm_details.get("arpeggio_type", "up"))
+            num_arp_notes = len(layout.arp_positions)
+            arp_jitters = [random.randint(-3,3) for _ in range(num_arp_notes)]
+            if np is not None:
+                arp_midis = np.asarray(base_voiced_midis)[np.asarray(arp_order)[layout.arp_positions % len(arp_order)]].tolist()
+                arp_vels = (np.repeat(np.asarray([event_vels[i] for i in layout.main_indices], dtype=np.int64), layout.arp_counts) + arp_jitters).tolist()
+            else:
+                arp_midis = [base_voiced_midis[arp_order[k % len(arp_order)]] for k in layout.arp_positions]
+                arp_vels = [event_vels[i] + jitter for i, jitter in zip((i for i, count in zip(layout.main_indices, layout.arp_counts) for _ in range(count)), arp_jitters)]
+            arp_events = list(map(PianoEvent, layout.arp_offsets, [(m,) for m in arp_midis], layout.arp_durations, arp_vels))
+
+        main_slot = 0
+        if hand_LR == "LH":
+            # 左手は役割コード -> 音の表を一度作り、イベントごとに引くだけ
+            role_table = chord_role_table(tuple(base_voiced_midis), parse_chord_pcs(cs_current.figure) or chord_pcs_from_chord_symbol(cs_current))
+            event_roles = compiled.roles.tolist() if np is not None else list(compiled.roles)
+        for i in range(num_events):
+            if not layout.keep_mask[i]: continue # 弱拍 "rest" はイベントをスキップ
+            event_offset = layout.offsets[i]; actual_event_duration = layout.durations[i]; current_event_vel = event_vels[i]
+            if layout.fill_mask[i] and fill_midis:
+                fill_start_offset = event_offset + actual_event_duration
+                fill_step = fill_length_beats_hand / len(fill_midis)
+                for k, fill_midi in enumerate(fill_midis):
+                    hand_events.append(PianoEvent(fill_start_offset + k * fill_step, (fill_midi,), fill_step * 0.9, current_event_vel + 5)) # 少し強調
+            if not layout.main_mask[i]: continue # 元のイベントが短すぎたらスキップ
+
+            if is_arpeggio:
+                hand_events.extend(arp_events[layout.arp_starts[main_slot]:layout.arp_starts[main_slot + 1]]); main_slot += 1
             else:
-                pitches_to_play = []
-                if hand_LR == "LH":
-                    lh_event_type = event_params.get("type", "root").lower()
-                    lh_root_pitch = min(base_voiced_pitches, key=lambda p:p.ps) if base_voiced_pitches else (cs_current.root() if cs_current and cs_current.root() else pitch.Pitch(f"C{DEFAULT_PIANO_LH_OCTAVE}"))
-                    if lh_event_type == "root" and lh_root_pitch: pitches_to_play.append(lh_root_pitch)
-                    elif lh_event_type == "octave_root" and lh_root_pitch: pitches_to_play.extend([lh_root_pitch, lh_root_pitch.transpose(12)])
-                    elif base_voiced_pitches: pitches_to_play.append(min(base_voiced_pitches, key=lambda p:p.ps))
-                else: pitches_to_play = base_voiced_pitches
-
-                if pitches_to_play:
-                    el_play = m21chord.Chord(pitches_to_play) if len(pitches_to_play) > 1 else note.Note(pitches_to_play[0])
-                    el_play.quarterLength = actual_event_duration * 0.9
-                    for n_in_chord in el_play.notes if isinstance(el_play, m21chord.Chord) else [el_play]: n_in_chord.volume = m21volume.Volume(velocity=current_event_vel)
-                    hand_part_obj.insert(abs_event_start_offset_in_block, el_play)
-        return hand_part_obj
-
-
-    def compose(self, processed_chord_stream: List[Dict], overrides: Optional[Any] = None) -> stream.Score:
+                midis_to_play = role_table[event_roles[i]] if hand_LR == "LH" else tuple(base_voiced_midis)
+                hand_events.append(PianoEvent(event_offset, midis_to_play, actual_event_duration * 0.9, current_event_vel))
+        return hand_events
+
+    @staticmethod
+    def _events_to_part(events: Sequence[PianoEvent], part_id: str, instrument_obj: m21instrument.Instrument) -> stream.Part:
+        """イベント列から Part を一度に組み立てる (要素はまとめて insert する)。"""
+        part = stream.Part(id=part_id)
+        part.insert(0, instrument_obj)
+        offsets_and_elements: List[Any] = []
+        for ev in events:
+            if not ev.pitches:
+                el = note.Rest(quarterLength=ev.duration)
+            elif len(ev.pitches) == 1:
+                el = note.Note(pitch.Pitch(midi=ev.pitches[0]), quarterLength=ev.duration)
+                el.volume = m21volume.Volume(velocity=ev.velocity)
+            else:
+                el = m21chord.Chord([pitch.Pitch(midi=m) for m in ev.pitches], quarterLength=ev.duration)
+                for n_in_chord in el.notes: n_in_chord.volume = m21volume.Volume(velocity=ev.velocity)
+            offsets_and_elements.extend((ev.offset, el))
+        if offsets_and_elements: part.insert(offsets_and_elements)
+        return part
+
+    def _events_to_pretty_midi(self, events: Sequence[PianoEvent], program: int, name: str,
+                               cc_events: Sequence[ControllerEvent] = ()) -> Any:
+        """イベント列 (と CC) を pretty_midi.Instrument に変換する (music21 を経由しない)。"""
+        seconds_per_ql = 60.0 / float(self.global_tempo or 120)
+        inst = pretty_midi.Instrument(program=program, name=name)
+        for ev in events:
+            start = ev.offset * seconds_per_ql; end = (ev.offset + ev.duration) * seconds_per_ql
+            for midi_val in ev.pitches:
+                inst.notes.append(pretty_midi.Note(velocity=max(1, min(127, int(ev.velocity))), pitch=int(midi_val), start=start, end=end))
+        for cc in cc_events:
+            inst.control_changes.append(pretty_midi.ControlChange(number=int(cc.controller), value=int(cc.value), time=cc.offset * seconds_per_ql))
+        return inst
+
+
+    def compose(self, processed_chord_stream: List[Dict], overrides: Optional[Any] = None,
+                return_events: bool = False, return_pretty_midi: bool = False) -> Any:
+        """
+        ピアノ (RH/LH) を生成する。既定では music21 の Score を返す。
+        return_events=True なら {"RH": [...], "LH": [...], "pedal": [...]} (PianoEvent は絶対オフセット、pedal は CC64 の ControllerEvent)、
+        return_pretty_midi=True なら (RH, LH) の pretty_midi.Instrument (CC64 付き) を返す。
+        ヒューマナイズはブロック (セクション) ごとの設定でイベントバッファに適用するので、どの戻り値にも含まれる。
+        ペダルは両手の Part に CC64 として付け、write_score_midi で MIDI に書き出される。
+        """
+        rh_events: List[PianoEvent] = []; lh_events: List[PianoEvent] = []; pedal_ranges: List[Tuple[float, float, float]] = []
+        # (手, テンプレート, custom_params) -> (テンプレート, custom_params, その手のイベントのインデックス)
+        humanize_groups: Dict[Tuple[str, str, str], Tuple[str, Dict[str, Any], List[int]]] = {}
         piano_score = stream.Score(id="PianoScore")
-        piano_rh_part = stream.Part(id="PianoRH"); piano_rh_part.insert(0, self.instrument_rh)
-        piano_lh_part = stream.Part(id="PianoLH"); piano_lh_part.insert(0, self.instrument_lh)
         piano_score.insert(0, tempo.MetronomeMark(number=self.global_tempo))
 
         if self.global_time_signature_obj:
@@ -291,10 +568,6 @@ class PianoGenerator:
             logger.warning("PianoGen: global_time_signature_obj is None. Defaulting to 4/4 for piano_score.")
             piano_score.insert(0, meter.TimeSignature("4/4"))
 
-        if not processed_chord_stream:
-            piano_score.append(piano_rh_part); piano_score.append(piano_lh_part)
-            return piano_score
-
         logger.info(f"PianoGen: Starting for {len(processed_chord_stream)} blocks.")
 
         for blk_idx, blk_data_original in enumerate(processed_chord_stream):
@@ -312,6 +585,7 @@ class PianoGenerator:
 
             piano_params_from_chordmap = blk_data.get("part_params", {}).get("piano", {})
             final_piano_params = piano_params_from_chordmap.copy()
+            override_dict: Dict[str, Any] = {}
             if part_specific_overrides_model:
                 override_dict = part_specific_overrides_model.model_dump(exclude_unset=True)
                 final_piano_params.update(override_dict)
@@ -336,36 +610,52 @@ class PianoGenerator:
                         logger.error(f"PianoGen Blk {blk_idx+1}: Error parsing ChordSymbol '{sanitized_label}': {e_parse}. Treating as Rest.")
                         cs_or_rest_current = note.Rest(quarterLength=block_dur)
 
-            rh_block_part = self._generate_piano_hand_part_for_block("RH", cs_or_rest_current, block_dur, final_piano_params, self.rhythm_library)
-            lh_block_part = self._generate_piano_hand_part_for_block("LH", cs_or_rest_current, block_dur, final_piano_params, self.rhythm_library)
-
-            for el_rh_final in rh_block_part.flatten().notesAndRests:
-                piano_rh_part.insert(block_offset_abs + el_rh_final.offset, el_rh_final)
-            for el_lh_final in lh_block_part.flatten().notesAndRests:
-                piano_lh_part.insert(block_offset_abs + el_lh_final.offset, el_lh_final)
-
-            if final_piano_params.get("piano_apply_pedal", final_piano_params.get("apply_pedal", True)) and not isinstance(cs_or_rest_current, note.Rest):
-                self._apply_pedal_to_part(piano_lh_part, block_offset_abs, block_dur)
-
-        global_piano_params_for_humanize = processed_chord_stream[0].get("part_params", {}).get("piano", {}) if processed_chord_stream else {}
-
-        # ヒューマナイズの on/off は final_piano_params (override適用済み) から取得
-        # humanize_opt は translate_keywords_to_params で解決されているので、それを参照
-        if global_piano_params_for_humanize.get("humanize_rh_opt", False): # humanize_opt を直接参照
-            rh_template = global_piano_params_for_humanize.get("template_name", "piano_gentle_arpeggio")
-            rh_custom = global_piano_params_for_humanize.get("custom_params", {})
-            logger.info(f"PianoGen: Humanizing RH part (template: {rh_template}, custom: {rh_custom})")
-            piano_rh_part = apply_humanization_to_part(piano_rh_part, template_name=rh_template, custom_params=rh_custom)
-            piano_rh_part.id = "PianoRH"
-
-        if global_piano_params_for_humanize.get("humanize_lh_opt", False): # humanize_opt を直接参照
-            lh_template = global_piano_params_for_humanize.get("template_name", "piano_block_chord")
-            lh_custom = global_piano_params_for_humanize.get("custom_params", {})
-            logger.info(f"PianoGen: Humanizing LH part (template: {lh_template}, custom: {lh_custom})")
-            piano_lh_part = apply_humanization_to_part(piano_lh_part, template_name=lh_template, custom_params=lh_custom)
-            piano_lh_part.id = "PianoLH"
+            rh_midis: Optional[Tuple[int, ...]] = None; lh_midis: Optional[Tuple[int, ...]] = None
+            if isinstance(cs_or_rest_current, harmony.ChordSymbol):
+                rh_midis, lh_midis = self._voice_piano_hands(cs_or_rest_current, final_piano_params)
+            rh_block_events = self._generate_piano_hand_events_for_block("RH", cs_or_rest_current, block_dur, final_piano_params, self.rhythm_library, rh_midis)
+            lh_block_events = self._generate_piano_hand_events_for_block("LH", cs_or_rest_current, block_dur, final_piano_params, self.rhythm_library, lh_midis)
+            for hand_LR, hand_events, block_events in (("RH", rh_events, rh_block_events), ("LH", lh_events, lh_block_events)):
+                humanize_setting = self._resolve_piano_humanize(final_piano_params, hand_LR, "humanize_opt" in override_dict)
+                if humanize_setting:
+                    template_name, custom_params = humanize_setting
+                    group = humanize_groups.setdefault((hand_LR, template_name, repr(sorted(custom_params.items()))), (template_name, custom_params, []))
+                    group[2].extend(len(hand_events) + i for i, ev in enumerate(block_events) if ev.pitches) # 休符は動かさない
+                hand_events.extend(ev._replace(offset=block_offset_abs + ev.offset) for ev in block_events)
+
+            if final_piano_params.get("piano_apply_pedal", final_piano_params.get("apply_pedal", True)) and not isinstance(cs_or_rest_current, note.Rest) \
+                    and block_dur > PEDAL_MIN_RANGE_QL:
+                repedal_gap = float(final_piano_params.get("piano_pedal_repedal_gap_ql", final_piano_params.get("pedal_repedal_gap_ql", DEFAULT_PEDAL_REPEDAL_GAP_QL)))
+                pedal_ranges.append((block_offset_abs, block_offset_abs + block_dur, repedal_gap))
+
+        # ヒューマナイズ: 同じ設定の音をまとめて1回の配列処理で揺らす (Part の作り直しは行わない)
+        for (hand_LR, _, _), (template_name, custom_params, indices) in humanize_groups.items():
+            if not indices: continue
+            hand_events = rh_events if hand_LR == "RH" else lh_events
+            logger.info(f"PianoGen: Humanizing {len(indices)} {hand_LR} events (template: {template_name}, custom: {custom_params})")
+            try:
+                new_offsets, new_durations, new_velocities = humanize_note_arrays(
+                    [hand_events[i].offset for i in indices], [hand_events[i].duration for i in indices], [hand_events[i].velocity for i in indices],
+                    template_name=template_name, custom_params=custom_params)
+                for i, o, d, v in zip(indices, new_offsets, new_durations, new_velocities):
+                    hand_events[i] = hand_events[i]._replace(offset=o, duration=d, velocity=int(v))
+            except Exception as e_hum: logger.error(f"PianoGen: Error during {hand_LR} humanization: {e_hum}", exc_info=True)
+
+        pedal_cc_events = merge_pedal_ranges(pedal_ranges)
+        if return_events:
+            return {"RH": rh_events, "LH": lh_events, "pedal": pedal_cc_events}
+        if return_pretty_midi:
+            if pretty_midi is None:
+                logger.warning("PianoGen: pretty_midi is not installed. Returning a music21 Score instead.")
+            else:
+                return (self._events_to_pretty_midi(rh_events, self.instrument_rh.midiProgram or 0, "PianoRH", pedal_cc_events),
+                        self._events_to_pretty_midi(lh_events, self.instrument_lh.midiProgram or 0, "PianoLH", pedal_cc_events))
 
+        piano_rh_part = self._events_to_part(rh_events, "PianoRH", self.instrument_rh)
+        piano_lh_part = self._events_to_part(lh_events, "PianoLH", self.instrument_lh)
 
+        # ペダルは両手に効くので両方の Part に付ける (同じチャンネルなら同じ値の重複になるだけ)
+        set_controller_events(piano_rh_part, pedal_cc_events); set_controller_events(piano_lh_part, pedal_cc_events)
         piano_score.append(piano_rh_part); piano_score.append(piano_lh_part)
         logger.info(f"PianoGen: Finished. RH notes: {len(list(piano_rh_part.flatten().notesAndRests))}, LH notes: {len(list(piano_lh_part.flatten().notesAndRests))}")
         return piano_score
@@ -1,6 +1,13 @@
 # --- START OF FILE utilities/scale_registry.py (ペンタトニック互換性向上版) ---
 import logging
-from typing import Optional, Dict, Any, List, Tuple
+import threading
+from collections import OrderedDict
+from typing import Optional, Dict, Any, List, Tuple, NamedTuple, Union
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 # music21 のサブモジュールを個別にインポート
 from music21 import pitch
@@ -10,19 +17,152 @@ from music21 import common # common.classTools.isNum などで使う可能性（
 logger = logging.getLogger(__name__)
 
 # スケールオブジェクトをキャッシュするための辞書 (モジュールレベル)
-_scale_cache: Dict[Tuple[str, str], scale.ConcreteScale] = {}
+# プールでの並列レンダリングから呼ばれるので、上限付き LRU とし、アクセスはロックで保護する
+SCALE_CACHE_MAX_SIZE = 256
+SCALE_PITCH_RANGE_CACHE_MAX_SIZE = 512
+_cache_lock = threading.RLock()
+_scale_cache: "OrderedDict[Tuple[str, str], scale.ConcreteScale]" = OrderedDict()
+
+def _cache_put(cache: "OrderedDict[Any, Any]", cache_key: Any, value: Any, max_size: int) -> None:
+    """_cache_lock を保持した状態で呼ぶこと。"""
+    cache[cache_key] = value
+    cache.move_to_end(cache_key)
+    while len(cache) > max_size:
+        cache.popitem(last=False)
+
+
+class ScaleDescriptor(NamedTuple):
+    """
+    スケールの整数表現 (不変)。所属判定や度数の変換を music21 を介さずに O(1) で行うためのもの。
+    - mask: ピッチクラスの 12bit マスク (bit n = pc n)
+    - degree_to_pc: 度数 (1 始まり) -> ピッチクラス。添字 0 が 1 度
+    - pc_to_degree: ピッチクラス -> 度数 (1 始まり)。スケール外は 0
+    """
+    tonic_pc: int
+    mask: int
+    degree_to_pc: Tuple[int, ...]
+    pc_to_degree: Tuple[int, ...]
+
+    def contains(self, pc: int) -> bool:
+        return bool((self.mask >> (pc % 12)) & 1)
+
+    def degree_of(self, pc: int) -> Optional[int]:
+        """getScaleDegreeFromPitch 相当。スケール外なら None。"""
+        return self.pc_to_degree[pc % 12] or None
+
+    def pc_of_degree(self, degree: int) -> int:
+        """pitchFromDegree 相当 (9, 11, 13 度などはオクターブ内に折り返す)。"""
+        return self.degree_to_pc[(degree - 1) % len(self.degree_to_pc)]
+
+
+# (tonic, mode) -> ScaleDescriptor。_scale_cache と同じキーを使う
+_descriptor_cache: "OrderedDict[Tuple[str, str], ScaleDescriptor]" = OrderedDict()
+
+def build_scale_descriptor(tonic_str: Optional[str], mode_str: Optional[str]) -> ScaleDescriptor:
+    """build_scale_object のスケールから ScaleDescriptor を作る。music21 を読むのは (tonic, mode) ごとに初回だけ。"""
+    cache_key = ((tonic_str or "C").capitalize(), (mode_str or "major").lower())
+    with _cache_lock:
+        cached = _descriptor_cache.get(cache_key)
+        if cached is not None:
+            _descriptor_cache.move_to_end(cache_key)
+            return cached
+
+    scl = build_scale_object(tonic_str, mode_str)
+    degree_to_pc: List[int] = []
+    try:
+        for p in scl.getPitches():
+            if p.pitchClass not in degree_to_pc:
+                degree_to_pc.append(p.pitchClass)
+    except Exception as e_pitches:
+        logger.error(f"ScaleRegistry: Could not read pitches of {scl} for descriptor: {e_pitches}. Using C major.")
+    if not degree_to_pc:
+        degree_to_pc = [0, 2, 4, 5, 7, 9, 11]
+
+    mask = 0
+    pc_to_degree = [0] * 12
+    for degree_idx, pc in enumerate(degree_to_pc):
+        mask |= 1 << pc
+        pc_to_degree[pc] = degree_idx + 1
+    descriptor = ScaleDescriptor(degree_to_pc[0], mask, tuple(degree_to_pc), tuple(pc_to_degree))
+    with _cache_lock:
+        _cache_put(_descriptor_cache, cache_key, descriptor, SCALE_CACHE_MAX_SIZE)
+    return descriptor
+
+
+class ScalePitchRange:
+    """
+    get_pitch_range の結果。midi は読み取り専用の int 配列 (NumPy が無い環境ではタプル)。
+    music21 の Pitch が必要な場合だけ pitches を参照すると、その時点でスケールの綴りで生成される (以後は再利用)。
+    """
+    __slots__ = ("tonic", "mode", "min_octave", "max_octave", "midi", "_pitches")
+
+    def __init__(self, tonic: str, mode: str, min_octave: int, max_octave: int, midi_values: List[int]):
+        self.tonic = tonic; self.mode = mode; self.min_octave = min_octave; self.max_octave = max_octave
+        if np is not None:
+            midi_arr = np.asarray(midi_values, dtype=np.int16)
+            midi_arr.setflags(write=False)
+            self.midi: Union["np.ndarray", Tuple[int, ...]] = midi_arr
+        else:
+            self.midi = tuple(midi_values)
+        self._pitches: Optional[Tuple[pitch.Pitch, ...]] = None
+
+    def __len__(self) -> int:
+        return len(self.midi)
+
+    @property
+    def pitches(self) -> Tuple[pitch.Pitch, ...]:
+        if self._pitches is None:
+            scl = build_scale_object(self.tonic, self.mode)
+            try:
+                p_start = pitch.Pitch(f'{scl.tonic.name}{self.min_octave}')
+                p_end = pitch.Pitch(f'{scl.tonic.name}{self.max_octave + 1}')
+                spelled = {p.midi: p for p in scl.getPitches(p_start, p_end)}
+            except Exception as e_spell:
+                logger.debug(f"ScaleRegistry: Could not spell pitches from scale {scl}: {e_spell}. Using MIDI defaults.")
+                spelled = {}
+            self._pitches = tuple(spelled.get(int(m)) or pitch.Pitch(midi=int(m)) for m in self.midi)
+        return self._pitches
+
+
+_pitch_range_cache: "OrderedDict[Tuple[str, str, int, int], ScalePitchRange]" = OrderedDict()
+
+def build_scale_pitch_range(tonic_str: Optional[str], mode_str: Optional[str], min_octave: int, max_octave: int) -> ScalePitchRange:
+    """トニックの min_octave から max_octave+1 までのスケール音 (両端を含む) を ScaleDescriptor から整数で求め、キャッシュする。"""
+    tonic_name = (tonic_str or "C").capitalize(); mode_name = (mode_str or "major").lower()
+    cache_key = (tonic_name, mode_name, min_octave, max_octave)
+    with _cache_lock:
+        cached = _pitch_range_cache.get(cache_key)
+        if cached is not None:
+            _pitch_range_cache.move_to_end(cache_key)
+            return cached
+
+    descriptor = build_scale_descriptor(tonic_name, mode_name)
+    scl = build_scale_object(tonic_name, mode_name)
+    try: start_midi = pitch.Pitch(f'{scl.tonic.name}{min_octave}').midi
+    except Exception: start_midi = (min_octave + 1) * 12 + descriptor.tonic_pc
+    end_midi = start_midi + 12 * (max_octave + 1 - min_octave)
+    midi_values = [m for m in range(start_midi, end_midi + 1) if descriptor.contains(m)]
+    pitch_range = ScalePitchRange(tonic_name, mode_name, min_octave, max_octave, midi_values)
+    with _cache_lock:
+        _cache_put(_pitch_range_cache, cache_key, pitch_range, SCALE_PITCH_RANGE_CACHE_MAX_SIZE)
+    return pitch_range
 
 def build_scale_object(tonic_str: Optional[str], mode_str: Optional[str]) -> scale.ConcreteScale:
     """
     指定されたトニックとモードに基づいてmusic21のScaleオブジェクトを生成またはキャッシュから取得します。
     ペンタトニックやブルーススケールはAbstractScaleから派生させることで互換性を高めています。
     """
+    with _cache_lock:
+        return _build_scale_object_locked(tonic_str, mode_str)
+
+def _build_scale_object_locked(tonic_str: Optional[str], mode_str: Optional[str]) -> scale.ConcreteScale:
     tonic_name = (tonic_str or "C").capitalize()
     mode_name = (mode_str or "major").lower()
 
     cache_key = (tonic_name, mode_name)
     if cache_key in _scale_cache:
         logger.debug(f"ScaleRegistry: Returning cached scale for {tonic_name} {mode_name}.")
+        _scale_cache.move_to_end(cache_key)
         return _scale_cache[cache_key]
 
     try:
@@ -133,12 +273,12 @@ def build_scale_object(tonic_str: Optional[str], mode_str: Optional[str]) -> sca
 
     if scl_obj: # scl_obj が正常に作成された場合のみキャッシュ
         logger.info(f"ScaleRegistry: Created and cached scale {scl_obj} for {tonic_name} {mode_name}.")
-        _scale_cache[cache_key] = scl_obj
+        _cache_put(_scale_cache, cache_key, scl_obj, SCALE_CACHE_MAX_SIZE)
         return scl_obj
     else: # 万が一 scl_obj が None のままだった場合 (ありえないはずだが念のため)
         logger.error(f"ScaleRegistry: Failed to create any scale for {tonic_name} {mode_name}. Returning emergency C Major.")
         emergency_fallback = scale.MajorScale(pitch.Pitch("C"))
-        _scale_cache[cache_key] = emergency_fallback # エラーでもキャッシュ
+        _cache_put(_scale_cache, cache_key, emergency_fallback, SCALE_CACHE_MAX_SIZE) # エラーでもキャッシュ
         return emergency_fallback
 
 
@@ -149,29 +289,20 @@ class ScaleRegistry:
         return build_scale_object(tonic, mode)
 
     @staticmethod
-    def get_pitches(tonic: str, mode: str, min_octave: int = 2, max_octave: int = 5) -> List[pitch.Pitch]:
-        """指定された範囲のスケール構成音を取得します。"""
-        scl = build_scale_object(tonic, mode)
-        try:
-            if not isinstance(scl.tonic, pitch.Pitch): # scl.tonic がNoneや文字列でないことを確認
-                logger.error(f"ScaleRegistry (get_pitches): Tonic for scale {tonic} {mode} is not a Pitch object: {scl.tonic}. Using C.")
-                effective_tonic_name = "C"
-            else:
-                effective_tonic_name = scl.tonic.name
-
-            p_start = pitch.Pitch(f'{effective_tonic_name}{min_octave}')
-            p_end = pitch.Pitch(f'{effective_tonic_name}{max_octave+1}') # max_octaveを含むように+1
-            
-            # getPitchesが空を返す場合があるのでチェック
-            pitches_result = scl.getPitches(p_start, p_end)
-            if not pitches_result:
-                 logger.warning(f"ScaleRegistry: getPitches returned empty for {tonic} {mode} in range {min_octave}-{max_octave}. Scale might be abstract or range too narrow.")
-                 # AbstractScaleの場合、deriveAll() や getPitchFromDegree() を使う必要があるかもしれない
-                 if hasattr(scl, 'deriveAll'): # AbstractScaleの場合
-                     return scl.deriveAll(tonicPitch=p_start, minPitch=p_start, maxPitch=p_end)
+    def get_descriptor(tonic: str, mode: str) -> ScaleDescriptor:
+        """指定されたトニックとモードの ScaleDescriptor (ピッチクラスマスクと度数表) を取得します。"""
+        return build_scale_descriptor(tonic, mode)
 
-            return pitches_result
+    @staticmethod
+    def get_pitch_range(tonic: str, mode: str, min_octave: int = 2, max_octave: int = 5) -> ScalePitchRange:
+        """指定された範囲のスケール構成音を ScalePitchRange (MIDI の読み取り専用配列 + 遅延 Pitch ビュー) で取得します。"""
+        return build_scale_pitch_range(tonic, mode, min_octave, max_octave)
 
+    @staticmethod
+    def get_pitches(tonic: str, mode: str, min_octave: int = 2, max_octave: int = 5) -> List[pitch.Pitch]:
+        """指定された範囲のスケール構成音を取得します。Pitch はキャッシュで共有されるため、変更する場合はコピーしてください。"""
+        try:
+            return list(build_scale_pitch_range(tonic, mode, min_octave, max_octave).pitches)
         except Exception as e_get_pitches:
             logger.error(f"ScaleRegistry: Error in get_pitches for {tonic} {mode}: {e_get_pitches}. Returning empty list.", exc_info=True)
             return []